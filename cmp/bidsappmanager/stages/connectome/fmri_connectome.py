@@ -22,7 +22,11 @@ class ConnectomeConfigUI(ConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gPickle', 'mat', 'cff', 'graphml'
+        'gPickle', 'mat', 'cff', 'graphml', 'npz'
+
+    connectivity_metrics : list of string
+        A list of functional connectivity metrics. Valid metrics are
+        'corr', 'partial_corr', 'ledoit_wolf_corr', 'tangent', 'lagged_corr', 'coherence'
 
     traits_view : traits.ui.View
         TraitsUI view that displays the Attributes of this class
@@ -33,13 +37,29 @@ class ConnectomeConfigUI(ConnectomeConfig):
     """
 
     output_types = List(['gPickle'], editor=CheckListEditor(
-        values=['gPickle', 'mat', 'cff', 'graphml'], cols=4))
+        values=['gPickle', 'mat', 'cff', 'graphml', 'npz'], cols=5))
+
+    connectivity_metrics = List(['corr'], editor=CheckListEditor(
+        values=['corr', 'partial_corr', 'ledoit_wolf_corr', 'tangent', 'lagged_corr', 'coherence'], cols=3))
 
     traits_view = View(VGroup('apply_scrubbing',
                               VGroup(Item('FD_thr', label='FD threshold'),
                                      Item('DVARS_thr', label='DVARS threshold'),
+                                     Item('scrubbing_interpolation', label='Interpolation'),
                                      visible_when="apply_scrubbing==True")),
-                       Item('output_types', style='custom'))
+                       Group(Item('connectivity_metrics', label='Metrics', style='custom'),
+                             Item('max_lag', label='Maximal lag (time points)',
+                                  visible_when="'lagged_corr' in connectivity_metrics"),
+                             Item('coherence_segment_length', label='Coherence segment length (time points)',
+                                  visible_when="'coherence' in connectivity_metrics"),
+                             label='Connectivity matrix', show_border=True),
+                       Group(Item('dynamic_fc', label='Sliding-window correlation'),
+                             Item('window_length', label='Window length (time points)', enabled_when='dynamic_fc'),
+                             Item('window_step', label='Window step (time points)', enabled_when='dynamic_fc'),
+                             Item('window_taper', label='Window taper', enabled_when='dynamic_fc'),
+                             label='Dynamic connectivity', show_border=True),
+                       Item('dense_only', label='Dense matrix only'),
+                       Item('output_types', style='custom', enabled_when='not dense_only'))
 
 
 class ConnectomeStageUI(ConnectomeStage):
@@ -28,6 +28,10 @@ class Dipy_recon_configUI(Dipy_recon_config):
         List of axis to flip in the gradient table. Valid values are
         'x', 'y', 'z'
 
+    mapmri_metrics : list of string
+        List of scalar maps computed from the MAP-MRI fit. Valid values are
+        'rtop', 'rtap', 'rtpp', 'msd', 'qiv', 'ng', 'ng_perp', 'ng_para'
+
     traits_view : traits.ui.View
         TraitsUI view that displays the attributes of this class, e.g. 
         the parameters for diffusion reconstruction using Dipy
@@ -40,6 +44,10 @@ class Dipy_recon_configUI(Dipy_recon_config):
     flip_table_axis = List(editor=CheckListEditor(
         values=['x', 'y', 'z'], cols=3))
 
+    mapmri_metrics = List(['rtop', 'rtap', 'rtpp', 'msd', 'qiv', 'ng', 'ng_perp', 'ng_para'],
+                          editor=CheckListEditor(
+                              values=['rtop', 'rtap', 'rtpp', 'msd', 'qiv', 'ng', 'ng_perp', 'ng_para'], cols=4))
+
     traits_view = View(  # Item('gradient_table',label='Gradient table (x,y,z,b):'),
         Item('flip_table_axis', style='custom', label='Flip bvecs:'),
         # Item('custom_gradient_table',enabled_when='gradient_table_file=="Custom..."'),
@@ -78,8 +86,11 @@ class Dipy_recon_configUI(Dipy_recon_config):
                 Item('laplacian_regularization'), Item('laplacian_weighting')
             ),
             Item('positivity_constraint'),
+            Item('mapmri_metrics', label='Maps', style='custom'),
             label="MAP_MRI settings",
-            visible_when='mapmri')
+            visible_when='mapmri'),
+        Item('n_procs', label='Number of processes',
+             visible_when='imaging_model == "DSI" or mapmri')
     )
 
 
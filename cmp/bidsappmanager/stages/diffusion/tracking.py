@@ -33,6 +33,8 @@ class Dipy_tracking_configUI(Dipy_tracking_config):
             Item('max_angle', label="Max angle (degree)"),
             Item('fa_thresh', label="FA threshold (classifier)",
                  visible_when='seed_from_gmwmi is False'),
+            Item('n_procs', label="Number of processes"),
+            Item('use_precomputed_sh', label="Reuse CSD SH coefficients", visible_when='SD'),
             label='Streamlines settings',
             orientation='vertical'
         ),
@@ -44,7 +44,11 @@ class FunctionalMRIConfigUI(FunctionalMRIConfig):
         HGroup(
             Item('lowpass_filter', label='Low cutoff (volumes)'),
             Item('highpass_filter', label='High cutoff (volumes)'),
-            label="Bandpass filtering", show_border=True))
+            label="Bandpass filtering", show_border=True),
+        HGroup(
+            Item('fused_cleaning', label='Fused cleaning'),
+            Item('masked_timeseries', label='Masked time series', enabled_when='not fused_cleaning'),
+            label='Memory', show_border=True))
 
 
 class FunctionalMRIStageUI(FunctionalMRIStage):
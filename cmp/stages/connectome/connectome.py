@@ -31,7 +31,7 @@ class ConnectomeConfig(HasTraits):
     compute_curvature : traits.Bool
         Compute fiber curvature (Default: False)
 
-    output_types : ['gPickle', 'mat', 'graphml']
+    output_types : ['gPickle', 'mat', 'graphml', 'npz']
         Output connectome format
 
     connectivity_metrics : ['Fiber number', 'Fiber length', 'Fiber density', 'Fiber proportion', 'Normalized fiber density', 'ADC', 'gFA']
@@ -49,6 +49,25 @@ class ConnectomeConfig(HasTraits):
     subject : traits.Str
         BIDS subject ID (in the form ``sub-XX``)
 
+    streaming : traits.Bool
+        Read the tractogram in chunks of fibers to bound memory usage.
+        The medians of the additional maps along the fibers of each edge
+        are then approximated from 256-bin histograms (Default: False)
+
+    chunk_size : traits.Int
+        Number of fibers per chunk when `streaming` is enabled (Default: 100000)
+
+    store_streamlines : traits.Bool
+        Save fiber points, endpoints, lengths, curvature and labels in a single
+        memory-mappable store file (Default: False)
+
+    endpoints_dtype : ['float64', 'int32']
+        Data type of the fiber endpoint voxel indices (Default: 'float64')
+
+    n_procs : traits.Int
+        Number of processes used to compute the connectomes of all
+        resolutions and maps in parallel (Default: 1)
+
     See Also
     --------
     cmp.stages.connectome.connectome.ConnectomeStage
@@ -62,6 +81,11 @@ class ConnectomeConfig(HasTraits):
     log_visualization = Bool(True)
     circular_layout = Bool(False)
     subject = Str
+    streaming = Bool(False)
+    chunk_size = Int(100000)
+    store_streamlines = Bool(False)
+    endpoints_dtype = Enum('float64', ['float64', 'int32'])
+    n_procs = Int(1)
 
 
 class ConnectomeStage(Stage):
@@ -111,6 +135,11 @@ class ConnectomeStage(Stage):
         cmtk_cmat = pe.Node(interface=cmtklib.connectome.CMTK_cmat(), name='compute_matrice')
         cmtk_cmat.inputs.compute_curvature = self.config.compute_curvature
         cmtk_cmat.inputs.output_types = self.config.output_types
+        cmtk_cmat.inputs.streaming = self.config.streaming
+        cmtk_cmat.inputs.chunk_size = self.config.chunk_size
+        cmtk_cmat.inputs.store_streamlines = self.config.store_streamlines
+        cmtk_cmat.inputs.endpoints_dtype = self.config.endpoints_dtype
+        cmtk_cmat.inputs.n_procs = self.config.n_procs
 
         # Additional maps
         map_merge = pe.Node(interface=util.Merge(
@@ -43,9 +43,46 @@ class ConnectomeConfig(HasTraits):
         DVARS (RMS of variance over voxels) threshold
         (Default: 4.0)
 
-    output_types : ['gPickle', 'mat', 'cff', 'graphml']
+    scrubbing_interpolation : ['none', 'linear', 'spectral']
+        Interpolation of the censored time points, which are discarded if 'none'
+        (Default: 'none')
+
+    output_types : ['gPickle', 'mat', 'cff', 'graphml', 'npz']
         Output connectome format
 
+    connectivity_metrics : ['corr', 'partial_corr', 'ledoit_wolf_corr', 'tangent', 'lagged_corr', 'coherence']
+        Functional connectivity metrics computed between the ROI time-series
+        (Default: ['corr'])
+
+    max_lag : traits.Int
+        Maximal lag in number of time points of the lagged correlation
+        (Default: 3)
+
+    coherence_segment_length : traits.Int
+        Number of time points of the Welch segments of the coherence
+        (Default: 64)
+
+    dynamic_fc : traits.Bool
+        Also compute the correlations of the ROI pairs in sliding windows
+        (Default: False)
+
+    window_length : traits.Int
+        Number of time points of the sliding windows
+        (Default: 30)
+
+    window_step : traits.Int
+        Number of time points between two sliding windows
+        (Default: 1)
+
+    window_taper : ['none', 'hamming', 'hann', 'tukey']
+        Taper of the sliding windows
+        (Default: 'none')
+
+    dense_only : traits.Bool
+        Only save the dense float32 matrix of each resolution and connectivity metric,
+        with the TSV edge list, instead of the connectome graph in the `output_types` formats
+        (Default: False)
+
     log_visualization : traits.Bool
         Log visualization that might be obsolete as this has been detached
         after creation of the bidsappmanager (Default: True)
@@ -65,7 +102,16 @@ class ConnectomeConfig(HasTraits):
     apply_scrubbing = Bool(False)
     FD_thr = Float(0.2)
     DVARS_thr = Float(4.0)
+    scrubbing_interpolation = Enum('none', ['none', 'linear', 'spectral'])
     output_types = List(['gPickle', 'mat', 'cff', 'graphml'])
+    connectivity_metrics = List(['corr'])
+    max_lag = Int(3)
+    coherence_segment_length = Int(64)
+    dynamic_fc = Bool(False)
+    window_length = Int(30)
+    window_step = Int(1)
+    window_taper = Enum('none', ['none', 'hamming', 'hann', 'tukey'])
+    dense_only = Bool(False)
     log_visualization = Bool(True)
     circular_layout = Bool(False)
     subject = Str()
@@ -115,6 +161,15 @@ class ConnectomeStage(Stage):
         cmtk_cmat.inputs.apply_scrubbing = self.config.apply_scrubbing
         cmtk_cmat.inputs.FD_th = self.config.FD_thr
         cmtk_cmat.inputs.DVARS_th = self.config.DVARS_thr
+        cmtk_cmat.inputs.scrubbing_interpolation = self.config.scrubbing_interpolation
+        cmtk_cmat.inputs.connectivity_metrics = self.config.connectivity_metrics
+        cmtk_cmat.inputs.max_lag = self.config.max_lag
+        cmtk_cmat.inputs.coherence_segment_length = self.config.coherence_segment_length
+        cmtk_cmat.inputs.dynamic_fc = self.config.dynamic_fc
+        cmtk_cmat.inputs.window_length = self.config.window_length
+        cmtk_cmat.inputs.window_step = self.config.window_step
+        cmtk_cmat.inputs.window_taper = self.config.window_taper
+        cmtk_cmat.inputs.dense_only = self.config.dense_only
 
         flow.connect([
             (inputnode, cmtk_cmat, [('func_file', 'func_file'), ("FD", "FD"), ("DVARS", "DVARS"),
@@ -148,24 +203,32 @@ class ConnectomeStage(Stage):
 
             mat = func_outputs['func.@connectivity_matrices']
 
+            metric_names = {'corr': 'Correlation', 'partial_corr': 'Partial correlation',
+                            'ledoit_wolf_corr': 'Ledoit-Wolf correlation', 'tangent': 'Tangent',
+                            'lagged_corr': 'Lagged correlation', 'coherence': 'Coherence'}
+
             if isinstance(mat, str):
                 if 'gpickle' in mat:
                     con_name = os.path.basename(mat).split(".")[
                         0].split("_")[-1]
                     if os.path.exists(mat):
-                        self.inspect_outputs_dict[
-                            'ROI-average time-series correlation - Connectome %s' % os.path.basename(mat)] = [
-                            "showmatrix_gpickle", layout, mat, "corr", "False",
-                            self.config.subject + ' - ' + con_name + ' - Correlation', map_scale]
+                        for metric in self.config.connectivity_metrics:
+                            self.inspect_outputs_dict[
+                                'ROI-average time-series %s - Connectome %s' % (
+                                    metric_names[metric].lower(), os.path.basename(mat))] = [
+                                "showmatrix_gpickle", layout, mat, metric, "False",
+                                self.config.subject + ' - ' + con_name + ' - ' + metric_names[metric], map_scale]
             else:
                 for mat in func_outputs['func.@connectivity_matrices']:
                     if 'gpickle' in mat:
                         con_name = os.path.basename(mat).split(".")[
                             0].split("_")[-1]
                         if os.path.exists(mat):
-                            self.inspect_outputs_dict['ROI-average time-series correlation - Connectome %s' % con_name] = [
-                                "showmatrix_gpickle", layout, mat, "corr", "False",
-                                self.config.subject + ' - ' + con_name + ' - Correlation', map_scale]
+                            for metric in self.config.connectivity_metrics:
+                                self.inspect_outputs_dict['ROI-average time-series %s - Connectome %s' % (
+                                    metric_names[metric].lower(), con_name)] = [
+                                    "showmatrix_gpickle", layout, mat, metric, "False",
+                                    self.config.subject + ' - ' + con_name + ' - ' + metric_names[metric], map_scale]
 
             self.inspect_outputs = sorted([key for key in list(self.inspect_outputs_dict.keys())],
                                           key=str.lower)
@@ -479,6 +479,16 @@ class DiffusionStage(Stage):
                     # (recon_flow, track_flow,[('outputnode.SD','inputnode.SD')]),
                 ])
 
+            # The coefficients are only saved in the basis of the Dipy direction getters if
+            # the reconstruction is configured for Dipy tracking
+            if self.config.diffusion_imaging_model != 'DSI' and self.config.recon_processing_tool == 'Dipy' and \
+                    self.config.dipy_recon_config.tracking_processing_tool == 'Dipy' and \
+                    self.config.dipy_tracking_config.SD and self.config.dipy_tracking_config.use_precomputed_sh:
+                flow.connect([
+                    (recon_flow, track_flow, [
+                     ('outputnode.fod', 'inputnode.fod_file')]),
+                ])
+
             if self.config.dipy_tracking_config.use_act and self.config.dipy_tracking_config.seed_from_gmwmi:
                 flow.connect([
                     (inputnode, track_flow, [
@@ -87,6 +87,11 @@ class Dipy_recon_config(HasTraits):
         Big data for gradient table (time interval) used by MAP-MRI
         (Default: 0.5)
 
+    mapmri_metrics : traits.List
+        Scalar maps computed from the MAP-MRI fit, among
+        'rtop', 'rtap', 'rtpp', 'msd', 'qiv', 'ng', 'ng_perp' and 'ng_para'
+        (Default: all)
+
     radial_order_values : traits.List([2, 4, 6, 8, 10, 12])
         Choices of radial order values used by SHORE
 
@@ -118,6 +123,10 @@ class Dipy_recon_config(HasTraits):
     shore_positive_constraint : traits.Bool
         Constrain the SHORE propagator to be positive
         (Default: False)
+
+    n_procs : traits.Int
+        Number of processes fitting chunks of voxels of the SHORE and MAP-MRI models in parallel
+        (Default: 1)
     """
 
     imaging_model = Str
@@ -154,6 +163,9 @@ class Dipy_recon_config(HasTraits):
     big_delta = traits.Float(0.5, mandatory=True,
                              desc='Small data for gradient table (time interval)')
 
+    mapmri_metrics = List(['rtop', 'rtap', 'rtpp', 'msd', 'qiv', 'ng', 'ng_perp', 'ng_para'],
+                          desc='Scalar maps computed from the MAP-MRI fit')
+
     radial_order_values = traits.List([2, 4, 6, 8, 10, 12])
     shore_radial_order = Enum(6, values='radial_order_values', usedefault=True,
                               desc='Even number that represents the order of the basis')
@@ -170,6 +182,9 @@ class Dipy_recon_config(HasTraits):
     shore_positive_constraint = traits.Bool(
         False, usedefault=True, desc='Constrain the propagator to be positive.')
 
+    n_procs = traits.Int(
+        1, usedefault=True, desc='Number of processes fitting chunks of voxels in parallel')
+
     def _imaging_model_changed(self, new):
         """Update ``local_model_editor`` and ``self.local_model`` when ``imaging_model`` is updated.
 
@@ -388,7 +403,8 @@ def create_dipy_recon_flow(config):
                 ])
             else:
                 flow.connect([
-                    (inputnode, outputnode, [('diffusion_resampled', 'DWI')])
+                    (inputnode, outputnode, [('diffusion_resampled', 'DWI')]),
+                    (dipy_CSD, outputnode, [('out_shm_coeff', 'fod')])
                 ])
     else:
         # Perform SHORE reconstruction (DSI)
@@ -411,6 +427,7 @@ def create_dipy_recon_flow(config):
         dipy_SHORE.inputs.tau = config.shore_tau
         dipy_SHORE.inputs.constrain_e0 = config.shore_constrain_e0
         dipy_SHORE.inputs.positive_constraint = config.shore_positive_constraint
+        dipy_SHORE.inputs.n_procs = config.n_procs
         # dipy_SHORE.inputs.save_shm_coeff = True
         # dipy_SHORE.inputs.out_shm_coeff = 'diffusion_shore_shm_coeff.nii.gz'
 
@@ -451,12 +468,15 @@ def create_dipy_recon_flow(config):
         dipy_MAPMRI.inputs.radial_order = config.radial_order
         dipy_MAPMRI.inputs.small_delta = config.small_delta
         dipy_MAPMRI.inputs.big_delta = config.big_delta
+        dipy_MAPMRI.inputs.metrics = config.mapmri_metrics
+        dipy_MAPMRI.inputs.n_procs = config.n_procs
 
         mapmri_maps_merge = pe.Node(
             interface=util.Merge(8), name='merge_mapmri_maps')
 
         flow.connect([
             (inputnode, dipy_MAPMRI, [('diffusion_resampled', 'in_file')]),
+            (inputnode, dipy_MAPMRI, [('brain_mask_resampled', 'in_mask')]),
             (inputnode, dipy_MAPMRI, [('bvals', 'in_bval')]),
             (flip_bvecs, dipy_MAPMRI, [('bvecs_flipped', 'in_bvec')])
         ])
@@ -74,6 +74,16 @@ class Dipy_tracking_config(HasTraits):
         Seed from Grey Matter / White Matter interface
         (requires Anatomically-Constrained Tractography (ACT))
         (Default: False)
+
+    n_procs : traits.Int
+        Number of processes tracking shards of the seeds in parallel
+        (Default: 1)
+
+    use_precomputed_sh : traits.Bool
+        Reuse the spherical harmonics coefficients of the fODFs computed by the
+        Dipy CSD reconstruction configured for Dipy tracking instead of fitting
+        the CSD model again. The coefficients are only reused if their basis
+        and order match the ones of the tracking (Default: False)
     """
 
     imaging_model = Str
@@ -92,6 +102,11 @@ class Dipy_tracking_config(HasTraits):
                           desc='Use FAST for partial volume estimation and Anatomically-Constrained Tractography (ACT) tissue classifier')
     seed_from_gmwmi = traits.Bool(False,
                                   desc="Seed from Grey Matter / White Matter interface (requires Anatomically-Constrained Tractography (ACT))")
+    n_procs = Int(1,
+                  desc='Number of processes tracking shards of the seeds in parallel')
+    use_precomputed_sh = Bool(False,
+                              desc='Reuse the spherical harmonics coefficients of the fODFs computed by the '
+                                   'CSD reconstruction instead of fitting the CSD model again')
 
     # fast_number_of_classes = Int(3)
 
@@ -337,6 +352,7 @@ def create_dipy_tracking_flow(config):
             dipy_tracking.inputs.use_act = config.use_act
             dipy_tracking.inputs.use_act = config.seed_from_gmwmi
             dipy_tracking.inputs.seed_density = config.seed_density
+            dipy_tracking.inputs.n_procs = config.n_procs
 
             # dipy_tracking.inputs.fast_number_of_classes = config.fast_number_of_classes
 
@@ -345,6 +361,10 @@ def create_dipy_tracking_flow(config):
             else:
                 dipy_tracking.inputs.recon_model = 'CSD'
                 dipy_tracking.inputs.recon_order = config.sh_order
+                if config.use_precomputed_sh:
+                    flow.connect([
+                        (inputnode, dipy_tracking, [('fod_file', 'sh_coeff_file')]),
+                    ])
 
             if config.imaging_model == 'DSI':
                 flow.connect([
@@ -378,6 +398,7 @@ def create_dipy_tracking_flow(config):
             dipy_tracking.inputs.use_act = config.use_act
             dipy_tracking.inputs.seed_from_gmwmi = config.seed_from_gmwmi
             dipy_tracking.inputs.seed_density = config.seed_density
+            dipy_tracking.inputs.n_procs = config.n_procs
             # dipy_tracking.inputs.fast_number_of_classes = config.fast_number_of_classes
 
             if config.imaging_model == 'DSI':
@@ -385,6 +406,10 @@ def create_dipy_tracking_flow(config):
             else:
                 dipy_tracking.inputs.recon_model = 'CSD'
                 dipy_tracking.inputs.recon_order = config.sh_order
+                if config.use_precomputed_sh:
+                    flow.connect([
+                        (inputnode, dipy_tracking, [('fod_file', 'sh_coeff_file')]),
+                    ])
 
             # flow.connect([
             #               (inputnode,dipy_tracking,[("bvals","bvals")]),
@@ -19,7 +19,7 @@ from nipype.interfaces import afni
 
 # Own imports
 from cmp.stages.common import Stage
-from cmtklib.functionalMRI import Scrubbing, Detrending, Nuisance_regression
+from cmtklib.functionalMRI import Scrubbing, Detrending, Nuisance_regression, Cleaning
 
 
 class FunctionalMRIConfig(HasTraits):
@@ -47,8 +47,8 @@ class FunctionalMRIConfig(HasTraits):
         Perform detrending
         (Default: True)
 
-    detrending_mode = Enum("linear", "quadratic")
-        Detrending mode
+    detrending_mode = Enum("linear", "quadratic", "cubic")
+        Detrending mode, where "cubic" removes a cubic spline
         (Default: "Linear")
 
     lowpass_filter = Float
@@ -63,6 +63,21 @@ class FunctionalMRIConfig(HasTraits):
         Perform scrubbing
         (Default: True)
 
+    standardized_dvars = Bool
+        Also compute the standardized and voxelwise standardized DVARS
+        during scrubbing
+        (Default: False)
+
+    masked_timeseries = Bool
+        Pass the detrended fMRI to the nuisance regression as memory-mappable
+        masked time series instead of a NIfTI volume
+        (Default: False)
+
+    fused_cleaning = Bool
+        Perform detrending, nuisance regression and bandpass filtering
+        in a single node that only saves the cleaned fMRI volume,
+        instead of a chain of nodes (Default: False)
+
     See Also
     --------
     cmp.stages.functional.functionalMRI.FunctionalMRIStage
@@ -77,12 +92,16 @@ class FunctionalMRIConfig(HasTraits):
     motion = Bool(True)
 
     detrending = Bool(True)
-    detrending_mode = Enum("linear", "quadratic")
+    detrending_mode = Enum("linear", "quadratic", "cubic")
 
     lowpass_filter = Float(0.01)
     highpass_filter = Float(0.1)
 
     scrubbing = Bool(True)
+    standardized_dvars = Bool(False)
+
+    masked_timeseries = Bool(False)
+    fused_cleaning = Bool(False)
 
 
 class FunctionalMRIStage(Stage):
@@ -126,6 +145,7 @@ class FunctionalMRIStage(Stage):
         """
         if self.config.scrubbing:
             scrubbing = pe.Node(interface=Scrubbing(), name='scrubbing')
+            scrubbing.inputs.standardized_dvars = self.config.standardized_dvars
             flow.connect([
                 (inputnode, scrubbing, [("preproc_file", "in_file")]),
                 (inputnode, scrubbing, [("registered_wm", "wm_mask")]),
@@ -137,11 +157,35 @@ class FunctionalMRIStage(Stage):
                 (scrubbing, outputnode, [("dvars_npy", "DVARS")])
             ])
 
+        if self.config.fused_cleaning:
+            cleaning = pe.Node(interface=Cleaning(), name='cleaning')
+            cleaning.inputs.detrending = self.config.detrending
+            cleaning.inputs.mode = self.config.detrending_mode
+            cleaning.inputs.global_nuisance = self.config.global_nuisance
+            cleaning.inputs.csf_nuisance = self.config.csf
+            cleaning.inputs.wm_nuisance = self.config.wm
+            cleaning.inputs.motion_nuisance = self.config.motion
+            # Same cutoffs as the 3dBandpass node of the chained mode
+            cleaning.inputs.highpass = self.config.lowpass_filter
+            cleaning.inputs.lowpass = self.config.highpass_filter
+            flow.connect([
+                (inputnode, cleaning, [("preproc_file", "in_file")]),
+                (inputnode, cleaning, [("registered_roi_volumes", "gm_file")]),
+                (inputnode, cleaning, [("eroded_brain", "brainfile")]),
+                (inputnode, cleaning, [("eroded_csf", "csf_file")]),
+                (inputnode, cleaning, [("registered_wm", "wm_file")]),
+                (inputnode, cleaning, [("motion_par_file", "motion_file")]),
+                (cleaning, outputnode, [("out_file", "func_file")])
+            ])
+            return
+
         detrending_output = pe.Node(interface=util.IdentityInterface(fields=["detrending_output"]),
                                     name="detrending_output")
         if self.config.detrending:
             detrending = pe.Node(interface=Detrending(), name='detrending')
             detrending.inputs.mode = self.config.detrending_mode
+            detrending.inputs.save_masked_timeseries = self.config.masked_timeseries and (
+                self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion)
             flow.connect([
                 (inputnode, detrending, [("preproc_file", "in_file")]),
                 (inputnode, detrending, [
@@ -219,21 +263,27 @@ class FunctionalMRIStage(Stage):
 
         It contains a dictionary of stage outputs with corresponding commands for visual inspection.
         """
-        if self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
+        if self.config.fused_cleaning:
+            clean = os.path.join(self.stage_dir, "cleaning", "fMRI_cleaned.nii.gz")
+            if os.path.exists(clean):
+                self.inspect_outputs_dict['Cleaning output'] = ['fsleyes', '-sdefault', clean,
+                                                                '-cm', 'brain_colours_blackbdy_iso']
+
+        elif self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
             res_dir = os.path.join(self.stage_dir, "nuisance_regression")
             nuis = os.path.join(res_dir, "fMRI_nuisance.nii.gz")
             if os.path.exists(nuis):
                 self.inspect_outputs_dict['Regression output'] = [
                     'fsleyes', '-sdefault', nuis]
 
-        if self.config.detrending:
+        if self.config.detrending and not self.config.fused_cleaning:
             res_dir = os.path.join(self.stage_dir, "detrending")
             detrend = os.path.join(res_dir, "fMRI_detrending.nii.gz")
             if os.path.exists(detrend):
                 self.inspect_outputs_dict['Detrending output'] = ['fsleyes', '-sdefault', detrend,
                                                                   '-cm', 'brain_colours_blackbdy_iso']
 
-        if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
+        if (self.config.lowpass_filter > 0 or self.config.highpass_filter > 0) and not self.config.fused_cleaning:
             res_dir = os.path.join(self.stage_dir, "converter")
             filt = os.path.join(res_dir, "fMRI_bandpass.nii.gz")
             if os.path.exists(filt):
@@ -253,7 +303,9 @@ class FunctionalMRIStage(Stage):
         -------
         `True` if the stage has been run successfully
         """
-        if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
+        if self.config.fused_cleaning:
+            return os.path.exists(os.path.join(self.stage_dir, "cleaning", "result_cleaning.pklz"))
+        elif self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
             return os.path.exists(os.path.join(self.stage_dir, "temporal_filter", "result_temporal_filter.pklz"))
         elif self.config.detrending:
             return os.path.exists(os.path.join(self.stage_dir, "detrending", "result_detrending.pklz"))
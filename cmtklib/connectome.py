@@ -10,7 +10,9 @@ from os import path as op
 import csv
 import glob
 import os
-import copy
+import multiprocessing
+import shutil
+import tempfile
 
 from traits.api import *
 
@@ -19,6 +21,9 @@ import numpy as np
 import networkx as nx
 
 import scipy.io as sio
+from scipy import sparse
+from scipy.signal import get_window
+from scipy.linalg import blas
 
 from nipype.interfaces.base import traits, \
     File, TraitedSpec, BaseInterface, \
@@ -27,8 +32,10 @@ from nipype.interfaces.base import traits, \
 from nipype.interfaces import cmtk
 from nipype.utils.filemanip import split_filename
 
-from .util import mean_curvature, length
+from .util import iter_fiber_chunks, save_fibers_subset, \
+    save_array_store, load_array_store, SizedIterable
 from .parcellation import get_parcellation
+from .functionalMRI import MaskedTimeSeries, interpolate_censored_timepoints
 
 
 def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
@@ -37,24 +44,24 @@ def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
 
 
 def compute_curvature_array(fib):
-    """Computes the curvature array."""
-    print("Compute curvature ...")
+    """Computes the curvature array.
 
-    n = len(fib)
-    pc = -1
-    meancurv = np.zeros((n, 1))
-    for i, fi in enumerate(fib):
-        # Percent counter
-        pcN = int(round(float(100 * i) / n))
-        if pcN > pc and pcN % 1 == 0:
-            pc = pcN
-            print('%4.0f%%' % pc)
-        meancurv[i, 0] = mean_curvature(fi[0])
+    Parameters
+    ----------
+    fib : the fibers data
+        Input fibers as returned by ``nibabel.trackvis.read``
 
-    return meancurv
+    Returns
+    -------
+    meancurv : numpy.ndarray
+        Matrix of size [#fibers, 1] containing the mean curvature of each fiber
+        (See :func:`compute_fiber_curvatures`)
+    """
+    print("Compute curvature ...")
+    return compute_fiber_curvatures(*pack_fibers(fib))
 
 
-def create_endpoints_array(fib, voxelSize, print_info):
+def create_endpoints_array(fib, voxelSize, print_info, dtype=np.float64):
     """Create the endpoints arrays for each fiber.
 
     Parameters
@@ -67,6 +74,10 @@ def create_endpoints_array(fib, voxelSize, print_info):
     print_info : bool
         If True, print extra information
 
+    dtype : numpy.dtype
+        Data type of the voxel index endpoints, such as ``numpy.int32``
+        to reduce memory usage (Default: numpy.float64)
+
     Returns
     -------
     (endpoints: matrix of size [#fibers, 2, 3] containing for each fiber the
@@ -78,48 +89,8 @@ def create_endpoints_array(fib, voxelSize, print_info):
         print("========================")
         print("create_endpoints_array")
 
-    # Init
-    n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
-    endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
-
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
-
-        # Percent counter
-        if print_info:
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 20 == 0:
-                pc = pcN
-                print('%4.0f%%' % pc)
-
-        f = fi[0]
-
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
-
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
-
-        # print 'endpoints (mm) : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
-
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
-
-        # print 'endpoints : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
-
-    # Return the matrices
-    return endpoints, endpointsmm
+    points, offsets = pack_fibers(fib)
+    return compute_endpoints(points, offsets, voxelSize, dtype)
 
 
 def save_fibers(oldhdr, oldfib, fname, indices):
@@ -153,8 +124,1568 @@ def save_fibers(oldhdr, oldfib, fname, indices):
     nib.trackvis.write(fname, outstreams, hdrnew)
 
 
+def pack_fibers(fib):
+    """Concatenate the points of all fibers in a single array.
+
+    Parameters
+    ----------
+    fib : the fibers data
+        Input fibers as returned by ``nibabel.trackvis.read``
+
+    Returns
+    -------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] such that the points of the i-th fiber
+        are ``points[offsets[i]:offsets[i + 1]]``
+    """
+    n = len(fib)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(fi[0]) for fi in fib])
+    if n > 0:
+        points = np.concatenate([fi[0] for fi in fib])
+    else:
+        points = np.zeros((0, 3), dtype=np.float32)
+    return points, offsets
+
+
+def unpack_fibers(points, offsets, indices=None):
+    """Iterate over fibers packed by :func:`pack_fibers`.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points`
+
+    indices : list
+        Indices of the fibers to iterate over. All fibers if None (Default: None)
+
+    Yields
+    ------
+    fiber : tuple
+        Fiber as ``(points, None, None)``, as returned by ``nibabel.trackvis.read``
+        for tractograms without scalars and properties
+    """
+    if indices is None:
+        indices = range(offsets.shape[0] - 1)
+    for i in indices:
+        yield np.asarray(points[offsets[i]:offsets[i + 1]]), None, None
+
+
+def iter_packed_chunks(points, offsets, chunk_size=100000):
+    """Iterate over fibers packed by :func:`pack_fibers` by chunks of fibers.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points`
+
+    chunk_size : int
+        Maximal number of fibers per chunk (Default: 100000)
+
+    Yields
+    ------
+    (points, offsets) : tuple
+        Points and offsets of the fibers of the chunk, in the format of :func:`pack_fibers`
+    """
+    for start in range(0, offsets.shape[0] - 1, chunk_size):
+        chunk_offsets = np.asarray(offsets[start:start + chunk_size + 1])
+        yield np.asarray(points[chunk_offsets[0]:chunk_offsets[-1]]), chunk_offsets - chunk_offsets[0]
+
+
+def save_packed_fibers(oldhdr, points, offsets, fname, indices):
+    """Stores a new trackvis file fname using only given indices of fibers packed by :func:`pack_fibers`.
+
+    Only the points of the fibers are written, so the number of scalars
+    and properties is set to zero in the new header.
+
+    Parameters
+    ----------
+    oldhdr : the tractogram header
+        Tractogram header to use as reference
+
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points`
+
+    fname : string
+        Output tractogram filename
+
+    indices : list
+        Indices of fibers included
+    """
+    hdrnew = oldhdr.copy()
+    hdrnew['n_count'] = len(indices)
+    hdrnew['n_scalars'] = 0
+    hdrnew['n_properties'] = 0
+
+    print("Writing final no orphan fibers: %s" % fname)
+    nib.trackvis.write(fname, SizedIterable(unpack_fibers(points, offsets, indices), len(indices)), hdrnew)
+
+
+def compute_fiber_lengths(points, offsets):
+    """Compute the Euclidean length of all fibers at once.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers (See :func:`pack_fibers`)
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points` (See :func:`pack_fibers`)
+
+    Returns
+    -------
+    lengths : numpy.ndarray
+        Length of each fiber in single precision, as returned by
+        :func:`~cmtklib.util.length` for the float32 points of a tractogram
+    """
+    n = offsets.shape[0] - 1
+    point_fiber = np.repeat(np.arange(n), np.diff(offsets))
+    # Segments between the last point of a fiber and the first point of the next one are ignored
+    same_fiber = point_fiber[1:] == point_fiber[:-1]
+    segments = np.sqrt((np.diff(points.astype(np.float64), axis=0) ** 2).sum(axis=1))
+    lengths = np.bincount(point_fiber[1:][same_fiber], weights=segments[same_fiber], minlength=n)
+    return lengths.astype(np.float32)
+
+
+def compute_endpoints(points, offsets, voxel_size, dtype=np.float64):
+    """Gather the first and last point of all fibers at once.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers (See :func:`pack_fibers`)
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points` (See :func:`pack_fibers`)
+
+    voxel_size : 3-tuple
+        Voxel size of the ROI image
+
+    dtype : numpy.dtype
+        Data type of the voxel index endpoints (Default: numpy.float64)
+
+    Returns
+    -------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the
+        index of its first and last point in the `voxel_size` volume,
+        truncated towards zero
+
+    endpointsmm : numpy.ndarray
+        Endpoints in milimeter coordinates
+    """
+    offsets = np.asarray(offsets)
+    endpointsmm = np.empty((offsets.shape[0] - 1, 2, 3))
+    endpointsmm[:, 0, :] = points[offsets[:-1]]
+    endpointsmm[:, 1, :] = points[offsets[1:] - 1]
+    endpoints = np.trunc(endpointsmm / np.asarray(voxel_size, dtype=np.float64))
+    # Coordinates in ]-1, 0[ give 0 as with int(), not -0
+    endpoints[endpoints == 0] = 0
+    return endpoints.astype(dtype), endpointsmm
+
+
+def _packed_gradient(values, first, last):
+    """Gradient of packed per-fiber values along each fiber, as ``numpy.gradient(values)[0]`` for each fiber."""
+    grad = np.zeros_like(values)
+    grad[1:-1] = (values[2:] - values[:-2]) / 2.0
+    # One-sided differences at both ends of the fibers with more than one point
+    multi = last > first
+    grad[first[multi]] = values[first[multi] + 1] - values[first[multi]]
+    grad[last[multi]] = values[last[multi]] - values[last[multi] - 1]
+    grad[first[~multi]] = 0
+    return grad
+
+
+def compute_fiber_curvatures(points, offsets):
+    """Compute the mean curvature of all fibers at once.
+
+    The first and second derivatives are computed along all fibers at once
+    with central differences that do not cross fiber boundaries, as
+    :func:`~cmtklib.util.mean_curvature` does for each fiber.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers (See :func:`pack_fibers`)
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points` (See :func:`pack_fibers`)
+
+    Returns
+    -------
+    meancurv : numpy.ndarray
+        Matrix of size [#fibers, 1] containing the mean curvature of each fiber
+        (0 for fibers with less than two points)
+    """
+    offsets = np.asarray(offsets)
+    n = offsets.shape[0] - 1
+    n_points = np.diff(offsets)
+    first = offsets[:-1][n_points > 0]
+    last = offsets[1:][n_points > 0] - 1
+
+    xyz = np.asarray(points, dtype=np.float64)
+    dxyz = _packed_gradient(xyz, first, last)
+    ddxyz = _packed_gradient(dxyz, first, last)
+
+    eps = np.finfo(float).eps
+    cross_norm = np.sqrt((np.cross(dxyz, ddxyz) ** 2).sum(axis=1))
+    cross_norm[cross_norm == 0] = eps
+    dxyz_norm = np.sqrt((dxyz ** 2).sum(axis=1))
+    dxyz_norm[dxyz_norm == 0] = eps
+    k = cross_norm / dxyz_norm ** 3
+
+    point_fiber = np.repeat(np.arange(n), n_points)
+    meancurv = np.zeros((n, 1))
+    meancurv[:, 0] = np.bincount(point_fiber, weights=k, minlength=n) / np.maximum(n_points, 1)
+    meancurv[n_points < 2] = 0
+    return meancurv
+
+
+def sample_scalar_map(points, offsets, map_data, voxel_size):
+    """Sample a scalar map at the points of all fibers with a single gather.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers
+        in millimeter coordinates (See :func:`pack_fibers`)
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points` (See :func:`pack_fibers`)
+
+    map_data : numpy.ndarray
+        3D scalar map image data
+
+    voxel_size : 3-tuple
+        Voxel size of the scalar map
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Value of the map at each point (0 for points outside the volume)
+
+    valid_fibers : numpy.ndarray
+        Boolean array of size [#fibers] which is False for
+        fibers with at least one point outside the volume
+    """
+    vox = points / voxel_size
+    in_bounds = np.all((vox > -1) & (vox < np.array(map_data.shape[:3])), axis=1)
+
+    idx = np.zeros(vox.shape, dtype=np.int64)
+    idx[in_bounds] = vox[in_bounds].astype(np.int64)
+    values = map_data[idx[:, 0], idx[:, 1], idx[:, 2]]
+    values[~in_bounds] = 0
+
+    n_out = np.zeros(points.shape[0] + 1, dtype=np.int64)
+    n_out[1:] = np.cumsum(~in_bounds)
+    valid_fibers = (n_out[offsets[1:]] - n_out[offsets[:-1]]) == 0
+
+    return values, valid_fibers
+
+
+def compute_edge_scalar_metrics(values, point_edge, n_edges):
+    """Compute the mean, standard deviation and median of a scalar map along the fibers of all edges at once.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Value of the map at each fiber point (See :func:`sample_scalar_map`)
+
+    point_edge : numpy.ndarray
+        Index of the edge of each fiber point (-1 for points to be ignored)
+
+    n_edges : int
+        Number of edges
+
+    Returns
+    -------
+    count : numpy.ndarray
+        Number of values of each edge
+
+    mean : numpy.ndarray
+        Mean of the values of each edge
+
+    std : numpy.ndarray
+        Standard deviation of the values of each edge
+
+    median : numpy.ndarray
+        Median of the values of each edge
+    """
+    keep = np.flatnonzero(point_edge >= 0)
+    point_edge = point_edge[keep]
+    values = values[keep].astype(np.float64)
+
+    count = np.bincount(point_edge, minlength=n_edges)
+    safe_count = np.maximum(count, 1)
+    mean = np.bincount(point_edge, weights=values, minlength=n_edges) / safe_count
+    std = np.sqrt(np.bincount(point_edge, weights=(values - mean[point_edge]) ** 2,
+                              minlength=n_edges) / safe_count)
+
+    # Median from values sorted by edge then by value
+    median = np.zeros(n_edges)
+    if values.size > 0:
+        sorted_values = values[np.lexsort((values, point_edge))]
+        starts = np.cumsum(count) - count
+        median = 0.5 * (sorted_values[np.minimum(starts + (safe_count - 1) // 2, values.size - 1)] +
+                        sorted_values[np.minimum(starts + safe_count // 2, values.size - 1)])
+
+    return count, mean, std, median
+
+
+class EdgeScalarAccumulator(object):
+    """Accumulate the values of a scalar map along the fibers of all edges, chunk by chunk.
+
+    Mean and standard deviation are accumulated exactly from sums of the
+    values (shifted to the center of `value_range` for numerical stability).
+    The median is interpolated from a per-edge histogram of `n_bins` bins
+    spanning `value_range`. Histograms are stored sparsely as the counts of
+    the (edge, bin) pairs that received values, so that memory is bounded by
+    the number of such pairs instead of the number of fibers or of
+    ``n_edges * n_bins``.
+
+    Parameters
+    ----------
+    n_edges : int
+        Number of edges
+
+    value_range : tuple
+        (min, max) values of the scalar map
+
+    n_bins : int
+        Number of histogram bins used to estimate the median (Default: 256)
+    """
+
+    def __init__(self, n_edges, value_range, n_bins=256):
+        self.n_edges = n_edges
+        self.n_bins = n_bins
+        self.vmin = float(value_range[0])
+        self.bin_width = max(float(value_range[1]) - self.vmin, np.finfo(float).eps) / n_bins
+        self.shift = 0.5 * (self.vmin + float(value_range[1]))
+        self.count = np.zeros(n_edges, dtype=np.int64)
+        self.sum = np.zeros(n_edges)
+        self.sum_sq = np.zeros(n_edges)
+        # Sorted keys ``edge * n_bins + bin`` of the non-empty histogram bins and their counts
+        self.hist_keys = np.zeros(0, dtype=np.int64)
+        self.hist_counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, values, point_edge):
+        """Add the values of a chunk of fiber points.
+
+        Parameters
+        ----------
+        values : numpy.ndarray
+            Value of the map at each fiber point (See :func:`sample_scalar_map`)
+
+        point_edge : numpy.ndarray
+            Index of the edge of each fiber point (-1 for points to be ignored)
+        """
+        keep = np.flatnonzero(point_edge >= 0)
+        point_edge = point_edge[keep]
+        values = values[keep].astype(np.float64)
+        shifted = values - self.shift
+
+        self.count += np.bincount(point_edge, minlength=self.n_edges)
+        self.sum += np.bincount(point_edge, weights=shifted, minlength=self.n_edges)
+        self.sum_sq += np.bincount(point_edge, weights=shifted ** 2, minlength=self.n_edges)
+
+        bins = np.clip(((values - self.vmin) / self.bin_width).astype(np.int64), 0, self.n_bins - 1)
+        keys, counts = np.unique(point_edge.astype(np.int64) * self.n_bins + bins, return_counts=True)
+        # Merge the bins of the chunk with the accumulated ones
+        keys = np.concatenate((self.hist_keys, keys))
+        counts = np.concatenate((self.hist_counts, counts))
+        self.hist_keys, inverse = np.unique(keys, return_inverse=True)
+        self.hist_counts = np.bincount(inverse, weights=counts).astype(np.int64)
+
+    def get_metrics(self):
+        """Return the metrics accumulated for each edge.
+
+        Returns
+        -------
+        count : numpy.ndarray
+            Number of values of each edge
+
+        mean : numpy.ndarray
+            Mean of the values of each edge
+
+        std : numpy.ndarray
+            Standard deviation of the values of each edge
+
+        median : numpy.ndarray
+            Median of the values of each edge, estimated from its histogram
+            (accurate to about one bin width)
+        """
+        safe_count = np.maximum(self.count, 1)
+        shifted_mean = self.sum / safe_count
+        mean = self.shift + shifted_mean
+        std = np.sqrt(np.maximum(self.sum_sq / safe_count - shifted_mean ** 2, 0.0))
+
+        # Bins are sorted by edge then by bin, so the two middle values of an
+        # edge are located by their rank in the cumulated counts of all edges,
+        # and placed assuming values evenly spread within their bin
+        cumulative = np.cumsum(self.hist_counts)
+        edge_start = np.concatenate(([0], np.cumsum(self.count)[:-1]))
+        bins = self.hist_keys % self.n_bins
+        median = np.full(self.n_edges, self.vmin + 0.5 * self.bin_width)
+        filled = np.flatnonzero(self.count > 0)
+        if filled.size:
+            median[filled] = 0.0
+            for rank in [(self.count[filled] - 1) // 2, self.count[filled] // 2]:
+                idx = np.searchsorted(cumulative, edge_start[filled] + rank, side='right')
+                below = cumulative[idx] - self.hist_counts[idx] - edge_start[filled]
+                fraction = (rank - below + 0.5) / self.hist_counts[idx]
+                median[filled] += 0.5 * (self.vmin + (bins[idx] + fraction) * self.bin_width)
+
+        return self.count, mean, std, median
+
+
+def compute_fiber_labels(endpoints, roi_data, n_rois):
+    """Label the start and end ROI of all fibers at once.
+
+    The ROI volume is read once with fancy indexing at the voxel
+    coordinates of all fiber endpoints. Fibers with an endpoint outside
+    the volume are skipped, fibers with an endpoint in an unlabeled voxel
+    are marked as orphans (label -1), and fibers with a label higher than
+    `n_rois` are skipped.
+
+    Parameters
+    ----------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the
+        voxel index of its first and last point (See :func:`create_endpoints_array`)
+
+    roi_data : numpy.ndarray
+        3D parcellation image data
+
+    n_rois : int
+        Number of ROIs of the parcellation
+
+    Returns
+    -------
+    fiberlabels : numpy.ndarray
+        Matrix of size [#fibers, 2] containing for each fiber its
+        (startROI, endROI) labels with startROI <= endROI
+
+    final_fiberlabels : numpy.ndarray
+        Matrix of size [#final_fibers, 2] containing the
+        (startROI, endROI) labels of the fibers kept (no orphans)
+
+    final_fibers_idx : numpy.ndarray
+        Indices of the fibers kept (no orphans)
+
+    n_orphans : int
+        Number of fibers that start or terminate in a voxel which is not labeled
+
+    n_outside : int
+        Number of fibers that start or terminate outside the volume
+    """
+    roi_data = np.asanyarray(roi_data)
+    return compute_multiscale_fiber_labels(endpoints, roi_data[np.newaxis, ...], [n_rois])[0]
+
+
+def compute_multiscale_fiber_labels(endpoints, roi_stack, n_rois):
+    """Label the start and end ROI of all fibers for several parcellation scales at once.
+
+    The parcellation volumes of all scales are stacked in a single label
+    tensor so that the endpoint labels of every scale are obtained
+    with one fancy-indexed read (See :func:`compute_fiber_labels`).
+
+    Parameters
+    ----------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the
+        voxel index of its first and last point (See :func:`create_endpoints_array`)
+
+    roi_stack : numpy.ndarray
+        Label tensor of size [#scales, X, Y, Z] stacking the
+        parcellation image data of each scale
+
+    n_rois : list of int
+        Number of ROIs of the parcellation of each scale
+
+    Returns
+    -------
+    scale_labels : list of tuple
+        List of (fiberlabels, final_fiberlabels, final_fibers_idx, n_orphans, n_outside)
+        for each scale as returned by :func:`compute_fiber_labels`
+    """
+    n = endpoints.shape[0]
+
+    # Negative indices within the volume are allowed as they were
+    # when each voxel was read one at a time
+    vox = endpoints.astype(np.int64)
+    shape = np.array(roi_stack.shape[1:4])
+    inside = np.all((vox >= -shape) & (vox < shape), axis=(1, 2))
+    n_outside = int(n - np.count_nonzero(inside))
+
+    vox_inside = vox[inside]
+    labels_inside = roi_stack[:, vox_inside[..., 0],
+                              vox_inside[..., 1],
+                              vox_inside[..., 2]].astype(np.int64)
+
+    scale_labels = []
+    for s, n_rois_scale in enumerate(n_rois):
+        labels = np.zeros((n, 2), dtype=np.int64)
+        labels[inside] = labels_inside[s]
+
+        orphans = inside & np.any(labels == 0, axis=1)
+        valid = inside & ~orphans & np.all(labels <= n_rois_scale, axis=1)
+
+        # Enforce startROI <= endROI
+        final_fiberlabels = np.sort(labels[valid], axis=1).astype(np.int32)
+
+        fiberlabels = np.zeros((n, 2))
+        fiberlabels[orphans, 0] = -1
+        fiberlabels[valid] = final_fiberlabels
+
+        final_fibers_idx = np.flatnonzero(valid)
+
+        scale_labels.append((fiberlabels, final_fiberlabels, final_fibers_idx,
+                             int(np.count_nonzero(orphans)), n_outside))
+
+    return scale_labels
+
+
+def group_fibers_by_edge(final_fiberlabels, n_rois):
+    """Group fibers by their (startROI, endROI) pair.
+
+    Each label pair is encoded once as a single integer so that
+    the grouping is done with one call to ``numpy.unique``.
+
+    Parameters
+    ----------
+    final_fiberlabels : numpy.ndarray
+        Matrix of size [#final_fibers, 2] containing the
+        (startROI, endROI) labels of each fiber with startROI <= endROI
+
+    n_rois : int
+        Number of ROIs of the parcellation
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the (startROI, endROI)
+        labels of each edge, in order of first appearance in `final_fiberlabels`
+
+    fiber_edge : numpy.ndarray
+        Index in `edges` of the edge of each fiber, such that the fibers
+        of edge ``e`` are ``numpy.flatnonzero(fiber_edge == e)``
+    """
+    final_fiberlabels = np.asarray(final_fiberlabels, dtype=np.int64).reshape(-1, 2)
+    edge_codes = final_fiberlabels[:, 0] * (int(n_rois) + 1) + final_fiberlabels[:, 1]
+    _, edge_first, edge_inverse = np.unique(edge_codes, return_index=True, return_inverse=True)
+
+    # Renumber edges in order of first appearance
+    order = np.argsort(edge_first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
+    fiber_edge = rank[edge_inverse.ravel()]
+    edges = final_fiberlabels[edge_first[order]]
+
+    return edges, fiber_edge
+
+
+def compute_roi_positions(roi_data, roi_ids):
+    """Compute the mean voxel position and the volume of several ROIs at once.
+
+    Parameters
+    ----------
+    roi_data : numpy.ndarray
+        Parcellation image data
+
+    roi_ids : list of int
+        Label of each ROI in `roi_data`
+
+    Returns
+    -------
+    positions : numpy.ndarray
+        Matrix of size [#rois, 3] containing the mean voxel coordinates of each ROI
+        (NaN for empty ROIs)
+
+    volumes : numpy.ndarray
+        Number of voxels of each ROI
+    """
+    roi_ids = np.asarray(roi_ids)
+    voxels = np.nonzero(roi_data)
+    voxel_labels, voxel_roi = np.unique(np.asarray(roi_data)[voxels], return_inverse=True)
+    voxel_roi = voxel_roi.ravel()
+    n_labels = voxel_labels.shape[0]
+
+    label_volumes = np.bincount(voxel_roi, minlength=n_labels)
+    label_sums = np.stack([np.bincount(voxel_roi, weights=coords, minlength=n_labels) for coords in voxels],
+                          axis=1)
+
+    # Position of each ROI label among the labels present in the volume
+    roi_label = np.searchsorted(voxel_labels, roi_ids)
+    present = (roi_label < n_labels) & (roi_ids != 0)
+    present[present] = voxel_labels[roi_label[present]] == roi_ids[present]
+
+    volumes = np.zeros(roi_ids.shape[0], dtype=np.int64)
+    volumes[present] = label_volumes[roi_label[present]]
+    positions = np.full((roi_ids.shape[0], 3), np.nan)
+    positions[present] = label_sums[roi_label[present]] / volumes[present, np.newaxis]
+    return positions, volumes
+
+
+def compute_roi_timeseries(timeseries, roi_stack, n_rois, chunk_size=100):
+    """Compute the average time series of all the ROIs of several parcellation scales at once.
+
+    The voxels of every ROI of all scales are gathered in a single sparse
+    label-indicator matrix of size [sum(n_rois), #voxels], so that the sums
+    of the voxel time series of all ROIs are obtained with one sparse matrix
+    product, computed by chunks of `chunk_size` time points.
+
+    Parameters
+    ----------
+    timeseries : cmtklib.functionalMRI.MaskedTimeSeries
+        Voxel time series of the fMRI volume, whose mask should contain
+        the voxels of all the ROIs
+
+    roi_stack : numpy.ndarray
+        Label tensor of size [#scales, X, Y, Z] stacking the
+        parcellation image data of each scale
+
+    n_rois : list of int
+        Number of ROIs of the parcellation of each scale
+
+    chunk_size : int
+        Number of time points averaged at once
+        (Default: 100)
+
+    Returns
+    -------
+    scale_timeseries : list of numpy.ndarray
+        Matrix of size [#rois, #timepoints] containing the average time series
+        of the ROIs labelled from 1 to n_rois for each scale (NaN for empty ROIs)
+    """
+    n_rois = [int(n) for n in n_rois]
+    offsets = np.concatenate(([0], np.cumsum(n_rois)))
+    n_voxels = timeseries.data.shape[0]
+
+    # Row of each (scale, ROI) pair in the indicator matrix for each voxel of the mask
+    voxel_labels = roi_stack[:, timeseries.mask].astype(np.int64)
+    rows, cols = [], []
+    for s, n_rois_scale in enumerate(n_rois):
+        labelled = np.flatnonzero((voxel_labels[s] > 0) & (voxel_labels[s] <= n_rois_scale))
+        rows.append(offsets[s] + voxel_labels[s][labelled] - 1)
+        cols.append(labelled)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    indicator = sparse.csr_matrix((np.ones(rows.shape[0]), (rows, cols)), shape=(offsets[-1], n_voxels))
+    volumes = np.bincount(rows, minlength=offsets[-1])
+
+    roi_sums = np.empty((offsets[-1], timeseries.n_timepoints))
+    for start in range(0, timeseries.n_timepoints, chunk_size):
+        roi_sums[:, start:start + chunk_size] = indicator.dot(timeseries.data[:, start:start + chunk_size])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        roi_means = (roi_sums / volumes[:, np.newaxis]).astype(np.float32)
+    return [roi_means[offsets[s]:offsets[s + 1]] for s in range(len(n_rois))]
+
+
+FUNCTIONAL_CONNECTIVITY_METRICS = ['corr', 'partial_corr', 'ledoit_wolf_corr', 'tangent', 'lagged_corr', 'coherence']
+
+
+def ledoit_wolf_correlation(zts):
+    """Compute the Ledoit-Wolf shrunk correlation matrix of standardized time series.
+
+    The sample correlation matrix is shrunk towards the identity with the
+    optimal shrinkage intensity of Ledoit and Wolf (2004), which gives a
+    well-conditioned estimate when the number of time points is small
+    compared to the number of ROIs.
+
+    Parameters
+    ----------
+    zts : numpy.ndarray
+        Matrix of size [#rois, #timepoints] of time series with null mean and unit variance
+
+    Returns
+    -------
+    lw_corr : numpy.ndarray
+        Shrunk correlation matrix of size [#rois, #rois]
+
+    shrinkage : float
+        Shrinkage intensity between 0 and 1
+    """
+    n_rois, n_timepoints = zts.shape
+    emp_corr = zts.dot(zts.T) / n_timepoints
+    # The mean of the eigenvalues of a correlation matrix is 1
+    delta = (np.sum(emp_corr ** 2) - n_rois) / n_rois
+    zts2 = zts ** 2
+    beta = (np.sum(zts2.dot(zts2.T)) / n_timepoints - np.sum(emp_corr ** 2)) / (n_rois * n_timepoints)
+    beta = min(beta, delta)
+    shrinkage = 0. if beta == 0 else beta / delta
+    lw_corr = (1. - shrinkage) * emp_corr
+    lw_corr[np.diag_indices(n_rois)] += shrinkage
+    return lw_corr, shrinkage
+
+
+def lagged_correlation(zts, max_lag):
+    """Compute the lagged correlation of maximal magnitude between all pairs of standardized time series.
+
+    Parameters
+    ----------
+    zts : numpy.ndarray
+        Matrix of size [#rois, #timepoints] of time series with null mean and unit variance
+
+    max_lag : int
+        Maximal lag in number of time points, in both directions
+
+    Returns
+    -------
+    lagged_corr : numpy.ndarray
+        Matrix of size [#rois, #rois] containing for each pair of ROIs
+        the cross-correlation of maximal magnitude over the lags
+
+    lags : numpy.ndarray
+        Matrix of size [#rois, #rois] containing the lag at which the
+        time series of the row ROI follows the one of the column ROI
+    """
+    n_timepoints = zts.shape[1]
+    lagged_corr = zts.dot(zts.T) / n_timepoints
+    lags = np.zeros(lagged_corr.shape, dtype=np.int64)
+    for lag in range(1, min(max_lag, n_timepoints - 1) + 1):
+        # Biased cross-correlation estimate, normalized by the full number of time points
+        lag_corr = zts[:, lag:].dot(zts[:, :-lag].T) / n_timepoints
+        for corr, signed_lag in ((lag_corr, lag), (lag_corr.T, -lag)):
+            larger = np.abs(corr) > np.abs(lagged_corr)
+            lagged_corr[larger] = corr[larger]
+            lags[larger] = signed_lag
+    return lagged_corr, lags
+
+
+def mean_coherence(ts, segment_length):
+    """Compute the magnitude-squared coherence averaged over frequencies between all pairs of time series.
+
+    Cross-spectral densities are estimated with the Welch method, using
+    Hann-windowed segments of `segment_length` time points overlapping
+    by half. The coherence is averaged over the non-null frequencies.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        Matrix of size [#rois, #timepoints] of time series
+
+    segment_length : int
+        Number of time points of the Welch segments, reduced to the number of time points if larger
+
+    Returns
+    -------
+    coherence : numpy.ndarray
+        Matrix of size [#rois, #rois] of mean coherence
+    """
+    n_rois, n_timepoints = ts.shape
+    segment_length = min(segment_length, n_timepoints)
+    starts = np.arange(0, n_timepoints - segment_length + 1, max(segment_length // 2, 1))
+    segments = ts[:, starts[:, np.newaxis] + np.arange(segment_length)]
+    segments = segments - segments.mean(axis=2, keepdims=True)
+    spectra = np.fft.rfft(segments * np.hanning(segment_length), axis=2)
+
+    n_frequencies = spectra.shape[2] - 1
+    coherence = np.zeros((n_rois, n_rois))
+    for f in range(1, spectra.shape[2]):
+        csd = spectra[:, :, f].dot(spectra[:, :, f].conj().T)
+        psd = np.real(np.diag(csd))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            coherence += np.abs(csd) ** 2 / np.outer(psd, psd)
+    return coherence / max(n_frequencies, 1)
+
+
+def compute_functional_connectivity(ts, metrics=('corr',), max_lag=3, coherence_segment_length=64):
+    """Compute several functional connectivity matrices from the same ROI time series.
+
+    Intermediate results, as the standardized time series or the shrunk
+    correlation matrix, are computed once and shared by the metrics.
+    Except for ``corr``, the matrices are estimated on the ROIs whose time
+    series are finite and not constant, and are NaN for the other ROIs.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        Matrix of size [#rois, #timepoints] of ROI average time series
+
+    metrics : list of string
+        Connectivity metrics to compute among:
+
+            * 'corr': Pearson's correlation
+            * 'partial_corr': Partial correlation, from the pseudo-inverse of the correlation matrix
+            * 'ledoit_wolf_corr': Ledoit-Wolf shrunk correlation (See :func:`ledoit_wolf_correlation`)
+            * 'tangent': Tangent space projection of the shrunk correlation matrix at the identity,
+              i.e. its matrix logarithm. It can be moved to a group reference afterwards.
+            * 'lagged_corr': Lagged correlation of maximal magnitude (See :func:`lagged_correlation`)
+            * 'coherence': Mean magnitude-squared coherence (See :func:`mean_coherence`)
+
+    max_lag : int
+        Maximal lag in number of time points of the ``lagged_corr`` metric
+        (Default: 3)
+
+    coherence_segment_length : int
+        Number of time points of the Welch segments of the ``coherence`` metric
+        (Default: 64)
+
+    Returns
+    -------
+    matrices : dict
+        Connectivity matrix of size [#rois, #rois] of each metric
+    """
+    unknown_metrics = set(metrics) - set(FUNCTIONAL_CONNECTIVITY_METRICS)
+    if unknown_metrics:
+        raise ValueError('Unknown functional connectivity metrics: %s' % ', '.join(sorted(unknown_metrics)))
+
+    matrices = {}
+    if 'corr' in metrics:
+        matrices['corr'] = np.corrcoef(ts)
+    if set(metrics) == {'corr'}:
+        return matrices
+
+    ts = np.asarray(ts, dtype=np.float64)
+    std = ts.std(axis=1)
+    valid = np.isfinite(std) & (std > 0)
+    zts = (ts[valid] - ts[valid].mean(axis=1, keepdims=True)) / std[valid, np.newaxis]
+    valid_pairs = np.ix_(valid, valid)
+
+    def _full(valid_matrix):
+        matrix = np.full((ts.shape[0], ts.shape[0]), np.nan)
+        matrix[valid_pairs] = valid_matrix
+        return matrix
+
+    if 'partial_corr' in metrics:
+        precision = np.linalg.pinv(zts.dot(zts.T) / zts.shape[1])
+        scale = 1. / np.sqrt(np.abs(np.diag(precision)))
+        partial_corr = -precision * np.outer(scale, scale)
+        partial_corr[np.diag_indices_from(partial_corr)] = 1.
+        matrices['partial_corr'] = _full(partial_corr)
+    if 'ledoit_wolf_corr' in metrics or 'tangent' in metrics:
+        lw_corr, _ = ledoit_wolf_correlation(zts)
+        if 'ledoit_wolf_corr' in metrics:
+            matrices['ledoit_wolf_corr'] = _full(lw_corr)
+        if 'tangent' in metrics:
+            eigenvalues, eigenvectors = np.linalg.eigh(lw_corr)
+            eigenvalues = np.log(np.clip(eigenvalues, np.finfo(np.float64).tiny, None))
+            matrices['tangent'] = _full((eigenvectors * eigenvalues).dot(eigenvectors.T))
+    if 'lagged_corr' in metrics:
+        matrices['lagged_corr'] = _full(lagged_correlation(zts, max_lag)[0])
+    if 'coherence' in metrics:
+        matrices['coherence'] = _full(mean_coherence(zts, coherence_segment_length))
+    return matrices
+
+
+def sliding_window_correlation(ts, window_length, step=1, taper='none', out=None):
+    """Compute the Pearson's correlation between all pairs of ROI time series in sliding windows.
+
+    Without taper, the sums and cross-products of the time series are
+    updated from one window to the next with the `step` time points
+    entering and leaving the window, so that each window costs
+    O(#rois^2 x step) instead of O(#rois^2 x window_length).
+    Tapered windows are computed with one weighted product per window.
+    Windows are computed one at a time and written in `out`, which can be
+    a memory-mapped array, so that memory usage does not depend on the
+    number of windows.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        Matrix of size [#rois, #timepoints] of ROI average time series
+
+    window_length : int
+        Number of time points of the windows
+
+    step : int
+        Number of time points between the start of two consecutive windows
+        (Default: 1)
+
+    taper : 'none', 'hamming', 'hann' or 'tukey'
+        Taper applied to the time points of the windows, with a cosine
+        fraction of 0.5 for 'tukey'
+        (Default: 'none')
+
+    out : numpy.ndarray
+        Optional array of size [#windows, #rois * (#rois - 1) / 2] in which the correlations are written
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Matrix of size [#windows, #rois * (#rois - 1) / 2] containing for each window, starting
+        at time point ``window * step``, the correlations of the ROI pairs in the order of
+        ``numpy.triu_indices(#rois, 1)`` (float32 if `out` is not given)
+    """
+    n_rois, n_timepoints = ts.shape
+    n_windows = max((n_timepoints - window_length) // step + 1, 0)
+    upper = np.triu(np.ones((n_rois, n_rois), dtype=bool), 1)
+    if out is None:
+        out = np.empty((n_windows, np.count_nonzero(upper)), dtype=np.float32)
+
+    # Centering the time series limits the cancellation errors of the updates
+    x = np.asarray(ts, dtype=np.float64)
+    x = x - x.mean(axis=1, keepdims=True)
+
+    weights = None
+    if taper != 'none':
+        weights = get_window(('tukey', 0.5) if taper == 'tukey' else taper, window_length, fftbins=False)
+    total_weight = window_length if weights is None else weights.sum()
+    rolling = weights is None and step < window_length
+
+    # The symmetric matrices are updated in place by BLAS through their
+    # transpose, which is a Fortran-ordered view of the same memory
+    corr = np.empty((n_rois, n_rois))
+    for window in range(n_windows):
+        start = window * step
+        if rolling and window > 0:
+            entering = x[:, start + window_length - step:start + window_length]
+            leaving = x[:, start - step:start]
+            sums += entering.sum(axis=1) - leaving.sum(axis=1)
+            products = blas.dgemm(1., np.hstack((entering, leaving)), np.hstack((entering, -leaving)),
+                                  beta=1., c=products.T, overwrite_c=1, trans_b=1).T
+        else:
+            x_window = x[:, start:start + window_length]
+            weighted = x_window if weights is None else x_window * weights
+            sums = weighted.sum(axis=1)
+            products = weighted.dot(x_window.T)
+
+        # corr = (products - sums sums^T / W) / (std std^T)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scale = 1. / np.sqrt(np.diag(products) - sums ** 2 / total_weight)
+        np.multiply(products, scale[:, np.newaxis], out=corr)
+        corr *= scale
+        scaled_sums = sums * scale
+        corr = blas.dger(-1. / total_weight, scaled_sums, scaled_sums, a=corr.T, overwrite_a=1).T
+        out[window] = corr[upper]
+    return out
+
+
+def order_graph_edges(node_ids, edges):
+    """Order edges as they are iterated by ``networkx.Graph.edges()``.
+
+    For an undirected graph whose nodes are added in the order of `node_ids`
+    and edges in the order of `edges`, networkx iterates over the edges of
+    each node in node order, skipping the edges of the previous nodes.
+
+    Parameters
+    ----------
+    node_ids : list
+        Identifier of each node, in the order they are added to the graph
+
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the nodes of each edge, in the
+        order they are added to the graph
+
+    Returns
+    -------
+    order : numpy.ndarray
+        Index in `edges` of each edge in iteration order
+
+    ordered_edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the nodes of each edge in iteration
+        order, starting with the node that comes first in `node_ids`
+    """
+    rows, cols = _edge_indices(node_ids, edges)
+    order = np.argsort(np.minimum(rows, cols), kind='stable')
+    ordered_edges = edges[order].copy()
+    flip = rows[order] > cols[order]
+    ordered_edges[flip] = ordered_edges[flip][:, ::-1]
+    return order, ordered_edges
+
+
+def compute_edge_fiber_metrics(edges, fiber_edge, final_fiberlength, node_volumes, total_volume):
+    """Compute the fiber metrics of all edges at once.
+
+    Fibers are sorted once by edge (and by length for the median), and
+    all metrics are then obtained by grouped reductions over the fibers.
+
+    Parameters
+    ----------
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the (startROI, endROI) labels of each edge
+
+    fiber_edge : numpy.ndarray
+        Index in `edges` of the edge of each fiber (See :func:`group_fibers_by_edge`)
+
+    final_fiberlength : numpy.ndarray
+        Length of each fiber
+
+    node_volumes : numpy.ndarray
+        Volume of each ROI indexed by its label
+
+    total_volume : float
+        Total volume of the ROIs involved in the connectome
+
+    Returns
+    -------
+    metrics : dict
+        Dictionary of arrays of size [#edges] for each metric
+        ('number_of_fibers', 'fiber_length_mean', 'fiber_length_median',
+        'fiber_length_std', 'fiber_proportion', 'fiber_density',
+        'normalized_fiber_density')
+    """
+    n_edges = edges.shape[0]
+    total_fibers = fiber_edge.shape[0]
+    final_fiberlength = np.asarray(final_fiberlength, dtype=np.float64)
+
+    number_of_fibers = np.bincount(fiber_edge, minlength=n_edges)
+    counts = np.maximum(number_of_fibers, 1)
+
+    length_mean = np.bincount(fiber_edge, weights=final_fiberlength, minlength=n_edges) / counts
+    length_std = np.sqrt(np.bincount(fiber_edge,
+                                     weights=(final_fiberlength - length_mean[fiber_edge]) ** 2,
+                                     minlength=n_edges) / counts)
+
+    # Median from fiber lengths sorted by edge then by length
+    sorted_length = final_fiberlength[np.lexsort((final_fiberlength, fiber_edge))]
+    starts = np.cumsum(number_of_fibers) - number_of_fibers
+    low = starts + (counts - 1) // 2
+    high = starts + counts // 2
+    length_median = np.zeros(n_edges)
+    if total_fibers > 0:
+        length_median = 0.5 * (sorted_length[low] + sorted_length[high])
+
+    fiber_proportion = 100.0 * (number_of_fibers / float(max(total_fibers, 1)))
+
+    # Compute density
+    # density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
+    edge_volumes = (node_volumes[edges[:, 0]] + node_volumes[edges[:, 1]]).astype(np.float64)
+    positive = length_mean > 0.0
+    fiber_density = np.zeros(n_edges)
+    normalized_fiber_density = np.zeros(n_edges)
+    fiber_density[positive] = (number_of_fibers[positive] / length_mean[positive]) * \
+        (2.0 / edge_volumes[positive])
+    normalized_fiber_density[positive] = ((number_of_fibers[positive] / float(max(total_fibers, 1))) /
+                                          length_mean[positive]) * \
+        ((2.0 * float(total_volume)) / edge_volumes[positive])
+
+    metrics = {'number_of_fibers': number_of_fibers,
+               'fiber_length_mean': length_mean,
+               'fiber_length_median': length_median,
+               'fiber_length_std': length_std,
+               'fiber_proportion': fiber_proportion,
+               'fiber_density': fiber_density,
+               'normalized_fiber_density': normalized_fiber_density}
+
+    return metrics
+
+
+def _edge_indices(node_ids, edges):
+    """Return the positions of the source and target nodes of `edges` in `node_ids`."""
+    node_index = dict((u, i) for i, u in enumerate(node_ids))
+    rows = np.array([node_index[u] for u in edges[:, 0].tolist()], dtype=np.int64)
+    cols = np.array([node_index[v] for v in edges[:, 1].tolist()], dtype=np.int64)
+    return rows, cols
+
+
+def create_connectome_graph(node_ids, node_data, edges, edge_attrs):
+    """Create the networkx graph of a connectome from its node and edge arrays.
+
+    Parameters
+    ----------
+    node_ids : list
+        Identifier of each node
+
+    node_data : list of dict
+        Attributes of each node. Nodes beyond the length of `node_data` have no attributes
+
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the source and target node of each edge
+
+    edge_attrs : dict
+        Dictionary of metric name / ``numpy.ma.MaskedArray`` of size [#edges]
+        where masked values are missing
+
+    Returns
+    -------
+    G : networkx.Graph
+        Connectome graph
+    """
+    G = nx.Graph()
+    G.add_nodes_from((u, node_data[n_node] if n_node < len(node_data) else {})
+                     for n_node, u in enumerate(node_ids))
+    keys = list(edge_attrs.keys())
+    values = [np.ma.getdata(edge_attrs[key]).tolist() for key in keys]
+    missing = [np.ma.getmaskarray(edge_attrs[key]).tolist() for key in keys]
+    G.add_edges_from((u, v, dict((key, values[k][e]) for k, key in enumerate(keys) if not missing[k][e]))
+                     for e, (u, v) in enumerate(edges.tolist()))
+    return G
+
+
+def save_connectome_tsv(fname, edges, edge_attrs):
+    """Save the edges of a connectome and their metrics in TSV format.
+
+    Each edge line stops at its first missing metric, as with ``networkx.write_edgelist``.
+
+    Parameters
+    ----------
+    fname : string
+        Output TSV filename
+
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the source and target node of each edge
+
+    edge_attrs : dict
+        Dictionary of metric name / ``numpy.ma.MaskedArray`` of size [#edges]
+        where masked values are missing
+    """
+    with open(fname, 'w') as out_file:
+        tsv_writer = csv.writer(out_file, delimiter='\t')
+        tsv_writer.writerow(['source', 'target'] + list(edge_attrs.keys()))
+
+    columns = [list(map(str, edges[:, 0].tolist())), list(map(str, edges[:, 1].tolist()))]
+    columns += [list(map(str, np.ma.getdata(values).tolist())) for values in list(edge_attrs.values())]
+    n_fields = np.full(edges.shape[0], len(columns), dtype=np.int64)
+    if len(edge_attrs) > 0:
+        missing = np.column_stack([np.ma.getmaskarray(values) for values in list(edge_attrs.values())])
+        n_fields = np.where(missing.any(axis=1), 2 + missing.argmax(axis=1), n_fields)
+    with open(fname, 'a') as out_file:
+        for fields, n_field in zip(zip(*columns), n_fields.tolist()):
+            out_file.write('\t'.join(fields[:n_field]) + '\n')
+
+
+def save_connectome_mat(fname, node_ids, node_attrs, edges, edge_attrs, long_field_names=False):
+    """Save a connectome in MATLAB format, with a dense matrix per metric.
+
+    Parameters
+    ----------
+    fname : string
+        Output MATLAB filename
+
+    node_ids : list
+        Identifier of each node, in the order of the matrix rows and columns
+
+    node_attrs : dict
+        Dictionary of node attribute name / list of values of each node
+
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the source and target node of each edge
+
+    edge_attrs : dict
+        Dictionary of metric name / ``numpy.ma.MaskedArray`` of size [#edges].
+        As with ``networkx.to_numpy_matrix``, a missing metric is stored as 1
+
+    long_field_names : bool
+        Passed to ``scipy.io.savemat`` (Default: False)
+    """
+    n_nodes = len(node_ids)
+    rows, cols = _edge_indices(node_ids, edges)
+    edge_struct = {}
+    for key, values in list(edge_attrs.items()):
+        matrix = np.zeros((n_nodes, n_nodes))
+        weights = np.ma.filled(values.astype(np.float64), 1.0)
+        matrix[rows, cols] = weights
+        matrix[cols, rows] = weights
+        edge_struct[key] = matrix
+
+    node_struct = {}
+    for key, values in list(node_attrs.items()):
+        if key == 'dn_position':
+            node_arr = np.zeros([n_nodes, 3], dtype=np.float)
+        else:
+            node_arr = np.zeros(n_nodes, dtype=np.object_)
+        for node_n, value in enumerate(values):
+            node_arr[node_n] = value
+        node_struct[key] = node_arr
+
+    sio.savemat(fname, long_field_names=long_field_names,
+                mdict={'sc': edge_struct, 'nodes': node_struct})
+
+
+def save_connectome_graphml(fname, node_ids, node_attrs, edges, edge_attrs, parcellation_scheme,
+                            nodes_first=False):
+    """Save a connectome in GraphML format.
+
+    Parameters
+    ----------
+    fname : string
+        Output GraphML filename
+
+    node_ids : list
+        Identifier of each node
+
+    node_attrs : dict
+        Dictionary of node attribute name / list of values of each node
+
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the source and target node of each edge
+
+    edge_attrs : dict
+        Dictionary of metric name / ``numpy.ma.MaskedArray`` of size [#edges]
+        where masked values are missing
+
+    parcellation_scheme : ['NativeFreesurfer','Lausanne2008','Lausanne2018','Custom']
+
+    nodes_first : bool
+        If True, nodes are added to the graph before the edges, which sets the
+        order of the nodes in the file (Default: False)
+    """
+    id_key = 'dn_multiscaleID' if parcellation_scheme == "Lausanne2018" else 'dn_correspondence_id'
+    node_data = []
+    for n in range(len(node_ids)):
+        d = {id_key: node_attrs[id_key][n]}
+        for key in ['dn_fsname', 'dn_hemisphere', 'dn_name']:
+            d[key] = node_attrs[key][n]
+        d['dn_position_x'] = node_attrs['dn_position'][n][0]
+        d['dn_position_y'] = node_attrs['dn_position'][n][1]
+        d['dn_position_z'] = node_attrs['dn_position'][n][2]
+        d['dn_region'] = node_attrs['dn_region'][n]
+        node_data.append(d)
+
+    keys = list(edge_attrs.keys())
+    values = [np.ma.getdata(edge_attrs[key]).tolist() for key in keys]
+    missing = [np.ma.getmaskarray(edge_attrs[key]).tolist() for key in keys]
+    edge_data = []
+    for e in range(edges.shape[0]):
+        edge_data.append(dict((key, values[k][e]) for k, key in enumerate(keys) if not missing[k][e]))
+
+    g2 = nx.Graph()
+    if nodes_first:
+        g2.add_nodes_from(zip(node_ids, node_data))
+        g2.add_edges_from((u, v, d) for (u, v), d in zip(edges.tolist(), edge_data))
+    else:
+        g2.add_edges_from((u, v, d) for (u, v), d in zip(edges.tolist(), edge_data))
+        g2.add_nodes_from(zip(node_ids, node_data))
+    nx.write_graphml(g2, fname)
+
+
+def save_connectome_npz(fname, node_ids, node_attrs, edges, edge_attrs):
+    """Save a connectome as sparse matrices in a compressed Numpy ``.npz`` file.
+
+    Each edge metric is stored as a symmetric ``scipy.sparse`` CSR matrix whose
+    rows and columns follow the order of `node_ids`, with missing metrics left
+    out. Node attributes are stored as a table of one array per attribute.
+    The file is read back with :func:`load_connectome_npz`.
+
+    Parameters
+    ----------
+    fname : string
+        Output filename
+
+    node_ids : list
+        Identifier of each node
+
+    node_attrs : dict
+        Dictionary of node attribute name / list of values of each node
+
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] containing the source and target node of each edge
+
+    edge_attrs : dict
+        Dictionary of metric name / ``numpy.ma.MaskedArray`` of size [#edges]
+        where masked values are missing
+    """
+    n_nodes = len(node_ids)
+    rows, cols = _edge_indices(node_ids, edges)
+    arrays = {'node_ids': np.asarray(node_ids)}
+    for key, values in list(node_attrs.items()):
+        arrays['node.' + key] = np.asarray(values)
+    for key, values in list(edge_attrs.items()):
+        present = ~np.ma.getmaskarray(values)
+        r, c, w = rows[present], cols[present], np.ma.getdata(values)[present]
+        off_diagonal = r != c
+        matrix = sparse.coo_matrix((np.concatenate((w, w[off_diagonal])),
+                                    (np.concatenate((r, c[off_diagonal])), np.concatenate((c, r[off_diagonal])))),
+                                   shape=(n_nodes, n_nodes)).tocsr()
+        matrix.sort_indices()
+        arrays['edge.' + key + '.data'] = matrix.data
+        arrays['edge.' + key + '.indices'] = matrix.indices
+        arrays['edge.' + key + '.indptr'] = matrix.indptr
+    np.savez_compressed(fname, **arrays)
+
+
+def load_connectome_npz(fname):
+    """Load a connectome saved by :func:`save_connectome_npz`.
+
+    Parameters
+    ----------
+    fname : string
+        Connectome filename
+
+    Returns
+    -------
+    node_ids : numpy.ndarray
+        Identifier of each node, in the order of the matrix rows and columns
+
+    node_attrs : dict
+        Dictionary of node attribute name / array of values of each node
+
+    matrices : dict
+        Dictionary of metric name / ``scipy.sparse.csr_matrix``
+    """
+    with np.load(fname) as npz:
+        node_ids = npz['node_ids']
+        n_nodes = node_ids.shape[0]
+        node_attrs = {}
+        matrices = {}
+        for name in npz.files:
+            if name.startswith('node.'):
+                node_attrs[name[len('node.'):]] = npz[name]
+            elif name.startswith('edge.') and name.endswith('.data'):
+                key = name[len('edge.'):-len('.data')]
+                matrices[key] = sparse.csr_matrix((npz[name], npz['edge.' + key + '.indices'],
+                                                   npz['edge.' + key + '.indptr']), shape=(n_nodes, n_nodes))
+    return node_ids, node_attrs, matrices
+
+
+def compute_map_edge_metrics(points, offsets, map_data, voxel_size, scale_fiber_edge, scale_n_edges):
+    """Compute the metrics of a scalar map along the fibers of all edges of all resolutions.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Matrix of size [#points, 3] containing the points of all fibers (See :func:`pack_fibers`)
+
+    offsets : numpy.ndarray
+        Per-fiber offsets in `points` (See :func:`pack_fibers`)
+
+    map_data : numpy.ndarray
+        Scalar map image data
+
+    voxel_size : 3-tuple
+        Voxel size of the scalar map
+
+    scale_fiber_edge : list of numpy.ndarray
+        Index of the edge of each fiber (-1 for fibers not in the connectome) for each resolution
+
+    scale_n_edges : list of int
+        Number of edges of each resolution
+
+    Returns
+    -------
+    n_discarded : int
+        Number of fibers with a point outside the map, that are not sampled
+
+    scale_metrics : list of tuple
+        Edge metrics of each resolution as returned by :func:`compute_edge_scalar_metrics`
+    """
+    offsets = np.asarray(offsets)
+    values, valid_fibers = sample_scalar_map(points, offsets, map_data, voxel_size)
+    point_fiber = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    valid_points = valid_fibers[point_fiber]
+    scale_metrics = [compute_edge_scalar_metrics(values, np.where(valid_points, fiber_edge[point_fiber], -1), n_edges)
+                     for fiber_edge, n_edges in zip(scale_fiber_edge, scale_n_edges)]
+    return int(np.count_nonzero(~valid_fibers)), scale_metrics
+
+
+def _share_array(array, work_dir, name):
+    """Save an array in `work_dir` so that worker processes can memory-map it instead of receiving a copy."""
+    fname = op.join(work_dir, name + '.npy')
+    np.save(fname, array)
+    return fname
+
+
+class _DiskArrayWriter(object):
+    """Append chunks of an array along its first axis to a raw file of `work_dir`.
+
+    The array is never held entirely in memory: :meth:`finalize` returns it
+    memory-mapped from the file once all chunks have been written.
+    """
+
+    def __init__(self, work_dir, name, dtype, shape=()):
+        self.fname = op.join(work_dir, name + '.dat')
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.n = 0
+        self._fp = open(self.fname, 'wb')
+
+    def append(self, chunk):
+        chunk = np.ascontiguousarray(chunk, dtype=self.dtype).reshape((-1,) + self.shape)
+        chunk.tofile(self._fp)
+        self.n += chunk.shape[0]
+
+    def finalize(self):
+        self._fp.close()
+        if self.n == 0:
+            return np.zeros((0,) + self.shape, dtype=self.dtype)
+        return np.memmap(self.fname, dtype=self.dtype, mode='r', shape=(self.n,) + self.shape)
+
+
+def _load_shared_array(source):
+    """Memory-map an array shared with :func:`_share_array` or a column ``(store, name)`` of a streamline store."""
+    if isinstance(source, tuple):
+        return load_array_store(source[0], [source[1]])[source[1]]
+    return np.load(source, mmap_mode='r')
+
+
+def _compute_map_edge_metrics_worker(args):
+    """Worker process of :func:`cmat` computing the edge metrics of one scalar map."""
+    map_fname, points_source, offsets_source, fiber_edge_sources, scale_n_edges = args
+    da = nib.load(map_fname)
+    mdata = np.nan_to_num(da.get_data())
+    return compute_map_edge_metrics(_load_shared_array(points_source), _load_shared_array(offsets_source),
+                                    mdata, da.get_header().get_zooms(),
+                                    [_load_shared_array(source) for source in fiber_edge_sources], scale_n_edges)
+
+
+def _create_scale_connectome_worker(args):
+    """Worker process of :func:`cmat` creating the connectome of one resolution."""
+    (parkey, parval, roi_fname, parcellation_scheme, label_sources, n_orphans, n_outside,
+     fiberlength_source, map_metrics, output_types) = args
+    fiberlabels, final_fiberlabels, final_fibers_idx = [_load_shared_array(source) for source in label_sources]
+    labels = (fiberlabels, final_fiberlabels, final_fibers_idx, n_orphans, n_outside)
+    create_scale_connectome(parkey, parval, nib.load(roi_fname).get_data(), parcellation_scheme, labels,
+                            group_fibers_by_edge(final_fiberlabels, parval['number_of_regions']),
+                            _load_shared_array(fiberlength_source), map_metrics, output_types)
+
+
+def create_scale_connectome(parkey, parval, roi_data, parcellation_scheme, labels, edge_groups,
+                            fiberlength, map_metrics, output_types):
+    """Create and save the connectome of one parcellation resolution.
+
+    Parameters
+    ----------
+    parkey : string
+        Name of the resolution
+
+    parval : dict
+        Resolution information with the number of regions and the node graphml
+
+    roi_data : numpy.ndarray
+        Parcellation image data of the resolution
+
+    parcellation_scheme : ['NativeFreesurfer','Lausanne2008','Lausanne2018','Custom']
+
+    labels : tuple
+        Fiber labels of the resolution as returned by :func:`compute_fiber_labels`
+
+    edge_groups : tuple
+        Fibers grouped by edge as returned by :func:`group_fibers_by_edge`
+
+    fiberlength : numpy.ndarray
+        Length of each fiber
+
+    map_metrics : dict
+        Dictionary of map name / edge metrics as returned by :func:`compute_edge_scalar_metrics`
+
+    output_types : ['gPickle','mat','graphml','npz']
+    """
+    n = fiberlength.shape[0]
+
+    print("------------------------")
+    print("Resolution = " + parkey)
+    print("------------------------")
+
+    # Create the matrix
+    print("  >> Create the connection matrix (%s rois)" %
+          parval['number_of_regions'])
+
+    # add node information from parcellation
+    gp = nx.read_graphml(parval['node_information_graphml'])
+    node_ids = [int(u) for u in gp.nodes()]
+    # compute a position for the node based on the mean position of the
+    # ROI in voxel coordinates (segmentation volume )
+    id_key = 'dn_multiscaleID' if parcellation_scheme == "Lausanne2018" else 'dn_correspondence_id'
+    roi_positions, roi_volumes = compute_roi_positions(
+        roi_data, [int(d[id_key]) for _, d in gp.nodes(data=True)])
+
+    node_data = []
+    for n_node, (_, d) in enumerate(gp.nodes(data=True)):
+        d = dict(d)
+        d['dn_position'] = tuple(roi_positions[n_node])
+        d['roi_volume'] = roi_volumes[n_node]
+        node_data.append(d)
+    node_attrs = {}
+    if node_data:
+        node_attrs = dict((key, [d[key] for d in node_data]) for key in node_data[0])
+
+    print("  >> Processing fibers and computing metrics (%s fibers)" % n)
+    (fiberlabels, final_fiberlabels_array, final_fibers_idx,
+     dis, n_outside) = labels
+
+    if n_outside > 0:
+        print(
+            "  ... ERROR: An index error occured for %i fibers. This means that the fiber start or endpoint is outside the volume. Continue." % n_outside)
+
+    # Edges in order of first appearance of each (startROI, endROI) pair.
+    # Fiber membership stays in the fiber_edge array
+    edges, fiber_edge = edge_groups
+    edges = edges.astype(np.int64)
+
+    # Nodes without information in the parcellation graphml are added as the edges refer to them
+    known_nodes = set(node_ids)
+    for u in edges.ravel().tolist():
+        if u not in known_nodes:
+            node_ids.append(u)
+            known_nodes.add(u)
+
+    print(
+        "  ... INFO - Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (
+            dis, dis * 100.0 / n, n))
+    print("  ... INFO - Valid fibers: %i (%f percent)" %
+          (n - dis, 100 - dis * 100.0 / n))
+
+    # create a final fiber length array
+    final_fiberlength_array = fiberlength[final_fibers_idx]
+
+    # Edges in the order of the output graph
+    out_edge_ids, out_edges = order_graph_edges(node_ids, edges)
+
+    # Total volume of the nodes from which at least one edge starts in the output graph
+    node_volumes = np.zeros(max(node_ids) + 1 if node_ids else 1, dtype=np.int64)
+    node_volumes[node_ids[:len(roi_volumes)]] = roi_volumes
+    total_volume = node_volumes[np.unique(out_edges[:, 0])].sum()
+
+    # Compute the fiber metrics of all edges at once
+    edge_metrics = compute_edge_fiber_metrics(edges, fiber_edge, final_fiberlength_array,
+                                              node_volumes.astype(np.float64), total_volume)
+
+    # Edge metrics as arrays in the order of the edges of the output graph
+    # FIXME treat case of self-connection that gives fiber_length_mean = 0.0
+    edge_attrs = {'number_of_fibers': np.ma.array(edge_metrics['number_of_fibers'][out_edge_ids])}
+    for key in ['fiber_length_mean', 'fiber_length_median', 'fiber_length_std',
+                'fiber_proportion', 'fiber_density', 'normalized_fiber_density']:
+        edge_attrs[key] = np.ma.array(edge_metrics[key][out_edge_ids])
+    for k, (count, mean, std, median) in list(map_metrics.items()):
+        no_value = count[out_edge_ids] == 0
+        edge_attrs[k + '_mean'] = np.ma.array(mean[out_edge_ids], mask=no_value)
+        edge_attrs[k + '_std'] = np.ma.array(std[out_edge_ids], mask=no_value)
+        edge_attrs[k + '_median'] = np.ma.array(median[out_edge_ids], mask=no_value)
+
+    print("  ************************************************")
+    print("  >> Save connectome maps as :")
+
+    # Storing network/graph in TSV format (by default to be BIDS compliant)
+    print('    - connectome_%s.tsv' % parkey)
+    save_connectome_tsv('connectome_%s.tsv' % parkey, out_edges, edge_attrs)
+
+    # Storing network/graph in other formats that might be prefered by the user
+    if 'gPickle' in output_types:
+        print('    - connectome_%s.gpickle' % parkey)
+        nx.write_gpickle(create_connectome_graph(node_ids, node_data, out_edges, edge_attrs),
+                         'connectome_%s.gpickle' % parkey)
+    if 'mat' in output_types:
+        print('    - connectome_%s.mat' % parkey)
+        save_connectome_mat('connectome_%s.mat' % parkey, node_ids, node_attrs, out_edges, edge_attrs,
+                            long_field_names=True)
+    if 'graphml' in output_types:
+        print('    - connectome_%s.graphml' % parkey)
+        save_connectome_graphml('connectome_%s.graphml' % parkey, node_ids, node_attrs, out_edges, edge_attrs,
+                                parcellation_scheme)
+    if 'npz' in output_types:
+        print('    - connectome_%s.npz' % parkey)
+        save_connectome_npz('connectome_%s.npz' % parkey, node_ids, node_attrs, out_edges, edge_attrs)
+
+    # print("Storing final fiber length array")
+    fiberlabels_fname = 'final_fiberslength_%s.npy' % str(parkey)
+    np.save(fiberlabels_fname, final_fiberlength_array)
+
+    # print("Storing all fiber labels (with orphans)")
+    fiberlabels_fname = 'filtered_fiberslabel_%s.npy' % str(parkey)
+    np.save(fiberlabels_fname, np.array(fiberlabels, dtype=np.int32), )
+
+    # print("Storing final fiber labels (no orphans)")
+    fiberlabels_noorphans_fname = 'final_fiberlabels_%s.npy' % str(parkey)
+    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+
+
 def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvature=True, additional_maps={},
-         output_types=['gPickle'], atlas_info={}):
+         output_types=['gPickle'], atlas_info={}, streaming=False, chunk_size=100000,
+         store_streamlines=False, streamline_store=None, endpoints_dtype=np.float64, n_procs=1):
     """Create the connection matrix for each resolution using fibers and ROIs.
 
     Parameters
@@ -176,13 +1707,76 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
         A dictionary of key/value for each additional map where the value
         is the path to the map
 
-    output_types : ['gPickle','mat','graphml']
+    output_types : ['gPickle','mat','graphml','npz']
 
     atlas_info : dict
         Dictionary storing information such as path to files related to a
         parcellation atlas / scheme.
-    """
 
+    streaming : Boolean
+        If True, the tractogram is read by chunks of `chunk_size` fibers
+        such that it is never loaded entirely in memory. The per-fiber
+        endpoints, lengths, curvatures, labels and edge indices are
+        written chunk by chunk to a working directory and memory-mapped.
+        In this mode, the median of the additional maps is estimated from
+        a sparse per-edge histogram (See :class:`EdgeScalarAccumulator`)
+
+    chunk_size : int
+        Number of fibers per chunk in streaming mode (Default: 100000)
+
+    store_streamlines : Boolean
+        If True, save the fiber points, endpoints, lengths, curvature and
+        per-resolution labels in a single memory-mappable store file
+        ``streamline_store.npz`` (See :func:`~cmtklib.util.save_array_store`)
+
+    streamline_store : string
+        Path to a store previously saved with `store_streamlines`. If given,
+        fibers are read from the store instead of `intrk` (Default: None)
+
+    endpoints_dtype : numpy.dtype
+        Data type of the voxel index endpoints saved in ``endpoints.npy``,
+        such as ``numpy.int32`` to reduce memory usage (Default: numpy.float64)
+
+    n_procs : int
+        Number of processes used to sample the additional maps and to create
+        the connectome of each resolution in parallel. Arrays are shared with
+        the processes through memory-mapped files. Outputs are identical to
+        the ones of a serial run. Connectomes are computed serially in daemonic
+        processes, such as the workers of the Nipype MultiProc plugin, which
+        cannot create child processes (Default: 1)
+    """
+    # Arrays shared with the pool of processes are memory-mapped from a working directory,
+    # which is removed and whose processes are terminated even if an error occurs
+    work_dir = tempfile.mkdtemp(prefix='cmat_work_', dir=os.getcwd())
+    pool = None
+    try:
+        if n_procs > 1:
+            if multiprocessing.current_process().daemon:
+                print("  ... WARNING - A daemonic process cannot create a pool of processes: "
+                      "connectomes are computed serially")
+            else:
+                print("  >> Use a pool of %i processes" % n_procs)
+                pool = multiprocessing.Pool(processes=n_procs)
+        _compute_connectomes(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvature,
+                             additional_maps, output_types, atlas_info, streaming, chunk_size,
+                             store_streamlines, streamline_store, endpoints_dtype, work_dir, pool)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(work_dir)
+
+
+def _compute_connectomes(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvature, additional_maps,
+                         output_types, atlas_info, streaming, chunk_size, store_streamlines, streamline_store,
+                         endpoints_dtype, work_dir, pool):
+    """Create the connection matrices as described in :func:`cmat`.
+
+    Arrays shared with the processes of `pool` (None for a serial run) are
+    saved in `work_dir`, whose cleanup is left to :func:`cmat`.
+    """
     print("========================")
     print("> Creation of connectome maps")
 
@@ -192,8 +1786,18 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     # ep_fname  = 'lengths.npy'
     curv_fname = 'meancurvature.npy'
     # intrk = op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk')
-    print('... tractogram :' + intrk)
-    fib, hdr = nib.trackvis.read(intrk, False)
+    store_fname = 'streamline_store.npz'
+    if streamline_store is not None:
+        print('... streamline store :' + streamline_store)
+        store = load_array_store(streamline_store)
+        hdr = store['trk_header']
+    elif streaming:
+        print('... tractogram :' + intrk)
+        # Only the header is read, fibers are read later by chunks
+        _, hdr = nib.trackvis.read(intrk, as_generator=True)
+    else:
+        print('... tractogram :' + intrk)
+        fib, hdr = nib.trackvis.read(intrk, False)
 
     # print "Header trackvis : ",hdr
     # print "Header trackvis id_string : ",hdr['id_string']
@@ -201,6 +1805,9 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
 
     print('... parcellation : %s' % parcellation_scheme)
 
+    # Parcellation image data loaded once and shared by all steps
+    roi_data_cache = {}
+
     if parcellation_scheme != "Custom":
         if parcellation_scheme != "Lausanne2018":
             # print "get resolutions from parcellation_scheme"
@@ -218,13 +1825,13 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
                         # print roi_graphml_fname
                 # roi_fname = roi_volumes[r]
                 # r += 1
-                roi = nib.load(roi_fname)
-                roiData = roi.get_data()
+                roiData = nib.load(roi_fname).get_data()
+                roi_data_cache[roi_fname] = roiData
                 resolutions[parkey]['number_of_regions'] = roiData.max()
                 resolutions[parkey]['node_information_graphml'] = op.abspath(
                     roi_graphml_fname)
 
-            del roi, roiData
+            del roiData
             # print("##################################################")
             # print("Atlas info (Lausanne2018) :")
             # print(resolutions)
@@ -248,469 +1855,270 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     roiVoxelSize = firstROI.get_header().get_zooms()
 
     # print "roi Voxel Size",roiVoxelSize
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
+    if streamline_store is not None:
+        # Points stay memory-mapped in the store and are read when needed
+        points, offsets = store['points'], np.asarray(store['offsets'])
+        if np.allclose(store['voxel_size'], roiVoxelSize):
+            endpoints = np.asarray(store['endpoints']).astype(endpoints_dtype)
+            endpointsmm = np.asarray(store['endpointsmm'])
+        else:
+            (endpoints, endpointsmm) = compute_endpoints(points, offsets, roiVoxelSize, endpoints_dtype)
+        fiberlength = np.asarray(store['fiberlength'], dtype=np.float32)
+    elif streaming:
+        print("  >> Reading the tractogram by chunks of %i fibers" % chunk_size)
+        # Per-fiber arrays are appended to files of the working directory and memory-mapped
+        endpoints_writer = _DiskArrayWriter(work_dir, 'endpoints', endpoints_dtype, (2, 3))
+        endpointsmm_writer = _DiskArrayWriter(work_dir, 'endpointsmm', np.float64, (2, 3))
+        fiberlength_writer = _DiskArrayWriter(work_dir, 'fiberlength', np.float32)
+        if compute_curvature:
+            meancurv_writer = _DiskArrayWriter(work_dir, 'meancurvature', np.float64, (1,))
+        offsets_writer = _DiskArrayWriter(work_dir, 'offsets', np.int64)
+        offsets_writer.append([0])
+        n_points = 0
+        for chunk in iter_fiber_chunks(intrk, chunk_size):
+            chunk_points, chunk_offsets = pack_fibers(chunk)
+            (chunk_endpoints, chunk_endpointsmm) = compute_endpoints(chunk_points, chunk_offsets,
+                                                                     roiVoxelSize, endpoints_dtype)
+            endpoints_writer.append(chunk_endpoints)
+            endpointsmm_writer.append(chunk_endpointsmm)
+            fiberlength_writer.append(compute_fiber_lengths(chunk_points, chunk_offsets))
+            offsets_writer.append(n_points + chunk_offsets[1:])
+            n_points += int(chunk_offsets[-1])
+            if compute_curvature:
+                meancurv_writer.append(compute_fiber_curvatures(chunk_points, chunk_offsets))
+            print("     - %i fibers read" % fiberlength_writer.n)
+        endpoints = endpoints_writer.finalize()
+        endpointsmm = endpointsmm_writer.finalize()
+        fiberlength = fiberlength_writer.finalize()
+        offsets = offsets_writer.finalize()
+    else:
+        # Points of all fibers are packed in one array so that endpoints, lengths,
+        # curvatures and map samples are computed for all fibers at once
+        points, offsets = pack_fibers(fib)
+        (endpoints, endpointsmm) = compute_endpoints(points, offsets, roiVoxelSize, endpoints_dtype)
+        fiberlength = compute_fiber_lengths(points, offsets)
     np.save(en_fname, endpoints)
     np.save(en_fnamemm, endpointsmm)
 
     # only compute curvature if required
     if compute_curvature:
-        meancurv = compute_curvature_array(fib)
+        if streamline_store is not None:
+            if 'meancurvature' in store:
+                meancurv = np.asarray(store['meancurvature'])
+            else:
+                meancurv = compute_fiber_curvatures(points, offsets)
+        elif streaming:
+            meancurv = meancurv_writer.finalize()
+        else:
+            meancurv = compute_fiber_curvatures(points, offsets)
         np.save(curv_fname, meancurv)
 
     print("========================")
 
-    n = len(fib)
-
-    # resolution = gconf.parcellation.keys()
+    n = endpoints.shape[0]
 
-    streamline_wrote = False
-    for parkey, parval in list(resolutions.items()):
-        # if parval['number_of_regions'] != 83:
-        #    continue
-
-        # print("Resolution = "+parkey)
-
-        print("------------------------")
-        print("Resolution = " + parkey)
-        print("------------------------")
-
-        # create empty fiber label array
-        fiberlabels = np.zeros((n, 2))
-        final_fiberlabels = []
-        final_fibers_idx = []
-
-        # Open the corresponding ROI (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
-
-        # print("Open the corresponding ROI")
+    # Open the ROI of each resolution once (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
+    parkeys = list(resolutions.keys())
+    roi_data_list = []
+    roi_fname_list = []
+    for parkey in parkeys:
         for vol in roi_volumes:
-            # print parkey
             if (parkey in vol) or (len(roi_volumes) == 1):
                 roi_fname = vol
-                # print roi_fname
-        # roi_fname = roi_volumes[r]
-        # r += 1
-        roi = nib.load(roi_fname)
-        roiData = roi.get_data()
-
-        # affine_vox_to_world = np.matrix(roi.affine[:3, :3])
-
-        # print "roiData shape : %s " % roiData.shape
-        # print "Affine Voxel 2 World transformation : ",affine_vox_to_world
-
-        # affine_world_to_vox = np.linalg.inv(affine_vox_to_world)
-        # origin = np.matrix(roi.affine[:3, 3]).T
-        # print "Affine World 2 Voxel transformation : ",affine_world_to_vox
-
-        # Create the matrix
-        print("  >> Create the connection matrix (%s rois)" %
-              parval['number_of_regions'])
-
-        nROIs = parval['number_of_regions']
-        G = nx.Graph()
-
-        # add node information from parcellation
-        gp = nx.read_graphml(parval['node_information_graphml'])
-        n_nodes = len(gp)
-        pc = -1
-        cnt = -1
-
-        thalamic_labels = []
-        for u, d in gp.nodes(data=True):
-
-            # Percent counter
-            cnt += 1
-            pcN = int(round(float(100 * cnt) / n_nodes))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print('%4.0f%%' % pc)
-
-            G.add_node(int(u))
-            for key in d:
-                G.nodes[int(u)][key] = d[key]
-            # compute a position for the node based on the mean position of the
-            # ROI in voxel coordinates (segmentation volume )
-            if parcellation_scheme != "Lausanne2018":
-                G.nodes[int(u)]['dn_position'] = tuple(
-                    np.mean(np.where(roiData == int(d["dn_correspondence_id"])), axis=1))
-                G.nodes[int(u)]['roi_volume'] = np.sum(
-                    roiData == int(d["dn_correspondence_id"]))
-                # print "Add node %g - roi volume : %g " % (int(u),np.sum( roiData== int(d["dn_correspondence_id"]) ))
-                # Store parcellation labels corresponding to thalamic nuclei
-                # if gp.node[int(u)]['dn_fsname'] == 'thalamus':
-                #     thalamic_labels.append(int(u))
-            else:
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-                G.nodes[int(u)]['dn_position'] = tuple(
-                    np.mean(np.where(roiData == int(d["dn_multiscaleID"])), axis=1))
-                G.nodes[int(u)]['roi_volume'] = np.sum(
-                    roiData == int(d["dn_multiscaleID"]))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-                # print "Add node %g - roi volume (2018): %g " % (int(u),np.sum( roiData== int(d["dn_multiscaleID"]) ))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-
-        thalamic_labels = np.array(thalamic_labels)
-        print("  ************************")
-        print('  >> Labels of thalamic nuclei :')
-        print('  {}'.format(thalamic_labels))
-        print("  ************************")
-
-        dis = 0
-
-        # prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype=np.object)
-
-        mmap = additional_maps
-        mmapdata = {}
-        print('  >> Maps to be processed :')
-        for k, v in list(mmap.items()):
-            print("     - %s map" % k)
-            da = nib.load(v)
-            mdata = da.get_data()
-            print(mdata.max())
-            mdata = np.nan_to_num(mdata)
-            print(mdata.max())
-            mmapdata[k] = (mdata, da.get_header().get_zooms())
-
-        # print("mmapdata size : %g " % len(mmapdata.items()))
-
-        print("  ************************")
-
-        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
-        pc = -1
-        for i in range(n):  # n: number of fibers
-
-            # Percent counter
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print('%4.0f%%' % pc)
-
-            # ROI start => ROI end
-            try:
-                startvox = np.zeros((3, 1)).astype(int)
-                startvox[0] = np.int(endpoints[i, 0, 0])
-                startvox[1] = np.int(endpoints[i, 0, 1])
-                startvox[2] = np.int(endpoints[i, 0, 2])
-
-                endvox = np.zeros((3, 1)).astype(int)
-                endvox[0] = np.int(endpoints[i, 1, 0])
-                endvox[1] = np.int(endpoints[i, 1, 1])
-                endvox[2] = np.int(endpoints[i, 1, 2])
-
-                # print "start point : ",startvox
-                # print "end point : ",endvox
-                # print "roi data shape : ",roiData.shape
-
-                # endpoints from create_endpoints_array
-                startROI = int(roiData[startvox[0], startvox[1], startvox[2]])
-                endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
-
-            except IndexError:
-                print(
-                    "... ERROR: An index error occured for fiber %s. This means that the fiber start or endpoint is outside the volume. Continue." % i)
-                continue
-
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i, 0] = -1
-                continue
-
-            if startROI > nROIs or endROI > nROIs:
-                #                print("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                #                print("than is expected by the parcellation node information.")
-                #                print("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                #                print("This needs bugfixing!")
-                continue
-
-            # Switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-
-            # TODO: Refine fibers ending in thalamus
-            # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
-            # Extract all thalamic nuclei the fiber is passing through
-
-            # Refine start/endROI connecting to the most probable nucleus
-
-            # Update fiber label
-            fiberlabels[i, 0] = startROI
-            fiberlabels[i, 1] = endROI
-
-            final_fiberlabels.append([startROI, endROI])
-            final_fibers_idx.append(i)
-
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G[startROI][endROI]['fiblist'].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist=[i])
-
-        print(
-            "  ... INFO - Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (
-                dis, dis * 100.0 / n, n))
-        print("  ... INFO - Valid fibers: %i (%f percent)" %
-              (n - dis, 100 - dis * 100.0 / n))
-
-        # print "roi : ",roi
-        # print "roiData size : ",roiData.size
-        # print "roiData shape : ",roiData.shape
-
-        # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            # compute length of fiber
-            # print('Fiber %i length: %d' % (idx, length(fib[idx][0])))
-            finalfiberlength.append(length(fib[idx][0]))
-
-        # convert to array
-        final_fiberlength_array = np.array(finalfiberlength)
-
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype=np.int32)
-
-        total_fibers = 0
-        total_volume = 0
-        u_old = -1
-        for u, v, d in G.edges(data=True):
-            total_fibers += len(d['fiblist'])
-            if u != u_old:
-                # print("Node %i"%int(u))
-                # print(G.nodes[int(u)])
-                total_volume += G.nodes[int(u)]['roi_volume']
-            u_old = u
-
-        G_out = copy.deepcopy(G)
-
-        # update edges
-        # measures to add here
-        # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
-        for u, v, d in G.edges(data=True):
-            # Check for diagonal elements that raise an error when the edge is visited a second time
-            # print('({}, {}): {}'.format(u, v, list(G[u][v].keys())))
-            G_out.remove_edge(u, v)
-
-            # print("u / v : {} / {}".format(u,v))
-            if len(list(G[u][v].keys())) == 1:
-                di = {'number_of_fibers': len(G[u][v]['fiblist'])}
-
-                # print("G[u][v]['fiblist'] : {}".format(G[u][v]['fiblist']))
-
-                # additional measures
-                # compute mean/std of fiber measure
-                if u <= v:
-                    idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (
-                        final_fiberlabels_array[:, 1] == int(v)))[0]
-                else:
-                    idx = np.where((final_fiberlabels_array[:, 0] == int(v)) & (
-                        final_fiberlabels_array[:, 1] == int(u)))[0]
-
-                # print("idx : {}".format(idx))
-                # print("final_fiberlength_array[idx] : {}".format(final_fiberlength_array[idx]))
-
-                di['fiber_length_mean'] = float(
-                    np.nanmean(final_fiberlength_array[idx]))
-                di['fiber_length_median'] = float(
-                    np.nanmedian(final_fiberlength_array[idx]))
-                di['fiber_length_std'] = float(
-                    np.nanstd(final_fiberlength_array[idx]))
-
-                di['fiber_proportion'] = float(
-                    100.0 * (di['number_of_fibers'] / float(total_fibers)))
-
-                # Compute density
-                # density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
-
-                # print "G.nodes[int(u)]['roi_volume'] : %i / G.nodes[int(v)]['roi_volume'] : %i"
-                #   % (G.nodes[int(u)]['roi_volume'],G.nodes[int(v)]['roi_volume'])
-                # print "di['number_of_fibers'] : %i / di['fiber_length_mean'] : %i" % (di['number_of_fibers'],di['fiber_length_mean'])
-
-                if di['fiber_length_mean'] > 0.0:
-                    di['fiber_density'] = float((float(di['number_of_fibers']) / float(di['fiber_length_mean'])) * float(
-                        2.0 / (G.nodes[int(u)]['roi_volume'] + G.nodes[int(v)]['roi_volume'])))
-                    di['normalized_fiber_density'] = float(
-                        ((float(di['number_of_fibers']) / float(total_fibers)) / float(di['fiber_length_mean'])) * (
-                            (2.0 * float(total_volume)) / (
-                                G.nodes[int(u)]['roi_volume'] + G.nodes[int(v)]['roi_volume'])))
-                else:
-                    di['fiber_density'] = 0.0
-                    di['normalized_fiber_density'] = 0.0
-                # this is indexed into the fibers that are valid in the sense of touching start
-                # and end roi and not going out of the volume
-                if u <= v:
-                    idx_valid = np.where((fiberlabels[:, 0] == int(u)) & (
-                        fiberlabels[:, 1] == int(v)))[0]
-                else:
-                    idx_valid = np.where((fiberlabels[:, 0] == int(v)) & (
-                        fiberlabels[:, 1] == int(u)))[0]
-
-                for k, vv in list(mmapdata.items()):
-                    val = []
-
-                    # print("Processing %s map..." % k)
-                    # print(vv[1])
-                    for i in idx_valid:
-                        # retrieve indices
-                        try:
-                            # print(h[i])
-                            idx2 = (h[i] / vv[1]).astype(np.uint32)
-                            # print "idx2 : ",idx2
-                            val.append(vv[0][idx2[:, 0], idx2[:, 1], idx2[:, 2]])
-                        except IndexError as e:
-                            print(
-                                "  ... ERROR - Index error occured when trying extract scalar values for measure", k)
-                            print("  ... ERROR - Discard fiber with index",
-                                  i, "Exception: ", e)
-
-                    # print(k)
-                    if len(val) > 0:
-                        da = np.concatenate(val)
-                        # print(da.max())
-                        # print(np.median(da))
-
-                        if k == 'shore_rtop':
-                            di[k + '_mean'] = da.astype(np.float64).mean()
-                            di[k + '_std'] = da.astype(np.float64).std()
-                            di[k + '_median'] = np.median(da.astype(np.float64))
-                        else:
-                            di[k + '_mean'] = da.mean().astype(np.float)
-                            di[k + '_std'] = da.std().astype(np.float)
-                            di[k + '_median'] = np.median(da).astype(np.float)
-
-                        # print(di[k + '_median'])
-                        del da
-                        del val
-
-                G_out.add_edge(u, v)
-                for key in di:
-                    G_out[u][v][key] = di[key]
-                # print('({}, {}): {}'.format(u, v, list(G[u][v].keys())))
-
-        # print("  ************************************************************************")
-        # for u, v, d in G.edges(data=True):
-        #     print('({}, {}): {}'.format(u, v, list(d.keys())))
-        #     if 'fiblist' in list(d.keys()):
-        #         print(G[u][v]['fiblist'])
-        del G
-
-        print("  ************************************************")
-        print("  >> Save connectome maps as :")
-        # Get the edge attributes/keys/weights from the first edge and then break.
-        # Change w.r.t networkx2
-        edge_keys = []
-        for u, v, d in G_out.edges(data=True):
-            # print(list(d.keys()))
-            edge_keys = list(d.keys())
-            break
-
-        # Storing network/graph in TSV format (by default to be BIDS compliant)
-        print('    - connectome_%s.tsv' % parkey)
-        # Write header fields
-        with open('connectome_%s.tsv' % parkey, 'w') as out_file:
-            tsv_writer = csv.writer(out_file, delimiter='\t')
-            header = ['source', 'target']
-            header = header + [key for key in edge_keys]
-            tsv_writer.writerow(header)
-        # Write list of graph edges with all connectivity metrics (edge_keys)
-        with open('connectome_%s.tsv' % parkey, 'ab') as out_file:
-            nx.write_edgelist(G_out,
-                              out_file,
-                              comments='#',
-                              delimiter='\t',
-                              data=edge_keys,
-                              encoding='utf-8')
-
-        # Storing network/graph in other formats that might be prefered by the user
-        if 'gPickle' in output_types:
-            print('    - connectome_%s.gpickle' % parkey)
-            nx.write_gpickle(G_out, 'connectome_%s.gpickle' % parkey)
-        if 'mat' in output_types:
-            # edges
-            # size_edges = (int(parval['number_of_regions']), int(
-            #     parval['number_of_regions']))
-
-            edge_struct = {}
-            for edge_key in edge_keys:
-                if edge_key != 'fiblist':
-                    # print('edge key: %s ' % edge_key)
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G_out, weight=edge_key)
-
-            # nodes
-            size_nodes = int(parval['number_of_regions'])
-
-            # Get the node attributes/keys from the first node and then break.
-            # Change w.r.t networkx2
-            for u, d in G_out.nodes(data=True):
-                node_keys = list(d.keys())
-                break
-
-            # print "size_nodes : "
-            # print size_nodes
-            # print "Number of nodes : %i" % len(G)
-
-            node_struct = {}
-            for node_key in node_keys:
-                if node_key == 'dn_position':
-                    node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                else:
-                    node_arr = np.zeros(size_nodes, dtype=np.object_)
-
-                node_n = 0
-                for _, node_data in G_out.nodes(data=True):
-                    node_arr[node_n] = node_data[node_key]
-                    # print " node_arr[%i]:" % node_n
-                    # print node_arr[node_n]
-                    node_n += 1
-                # print('node key: %s ' % node_key)
-                node_struct[node_key] = node_arr
-            print('    - connectome_%s.mat' % parkey)
-            sio.savemat('connectome_%s.mat' % parkey, long_field_names=True,
-                        mdict={'sc': edge_struct,
-                               'nodes': node_struct})
-        if 'graphml' in output_types:
-            g2 = nx.Graph()
-            for u_gml, v_gml, d_gml in G_out.edges(data=True):
-                g2.add_edge(u_gml, v_gml)
-                for key in d_gml:
-                    g2[u_gml][v_gml][key] = d_gml[key]
-            for u_gml, d_gml in G_out.nodes(data=True):
-                g2.add_node(u_gml)
-                if parcellation_scheme != "Lausanne2018":
-                    g2.nodes[u_gml]['dn_correspondence_id'] = d_gml['dn_correspondence_id']
-                else:
-                    g2.nodes[u_gml]['dn_multiscaleID'] = d_gml['dn_multiscaleID']
-                g2.nodes[u_gml]['dn_fsname'] = d_gml['dn_fsname']
-                g2.nodes[u_gml]['dn_hemisphere'] = d_gml['dn_hemisphere']
-                g2.nodes[u_gml]['dn_name'] = d_gml['dn_name']
-                g2.nodes[u_gml]['dn_position_x'] = d_gml['dn_position'][0]
-                g2.nodes[u_gml]['dn_position_y'] = d_gml['dn_position'][1]
-                g2.nodes[u_gml]['dn_position_z'] = d_gml['dn_position'][2]
-                g2.nodes[u_gml]['dn_region'] = d_gml['dn_region']
-                print('    - connectome_%s.graphml' % parkey)
-            nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
-
-        # print("Storing final fiber length array")
-        fiberlabels_fname = 'final_fiberslength_%s.npy' % str(parkey)
-        np.save(fiberlabels_fname, final_fiberlength_array)
-
-        # print("Storing all fiber labels (with orphans)")
-        fiberlabels_fname = 'filtered_fiberslabel_%s.npy' % str(parkey)
-        np.save(fiberlabels_fname, np.array(fiberlabels, dtype=np.int32), )
-
-        # print("Storing final fiber labels (no orphans)")
-        fiberlabels_noorphans_fname = 'final_fiberlabels_%s.npy' % str(parkey)
-        np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
-
-        if not streamline_wrote:
-            print("  > Filtering tractography - keeping only no orphan fibers")
-            finalfibers_fname = 'streamline_final.trk'
-            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+        if roi_fname not in roi_data_cache:
+            roi_data_cache[roi_fname] = nib.load(roi_fname).get_data()
+        roi_data_list.append(roi_data_cache[roi_fname])
+        roi_fname_list.append(roi_fname)
+    n_rois_list = [resolutions[parkey]['number_of_regions'] for parkey in parkeys]
+
+    # Look up the endpoint labels in all resolutions at once, using the
+    # parcellations stacked as a label tensor when they share the same grid
+    print("  >> Labelling fiber endpoints in %i resolution(s) (%s fibers)" % (len(parkeys), n))
+    roi_shape = roi_data_list[0].shape
+    roi_stack = None
+    if all(roi_data.shape == roi_shape for roi_data in roi_data_list):
+        roi_stack = np.empty((len(parkeys),) + roi_shape, dtype=np.int32)
+        for s, roi_data in enumerate(roi_data_list):
+            roi_stack[s] = roi_data
+
+    def label_fibers(fiber_endpoints):
+        """Label the fibers of `fiber_endpoints` in all resolutions."""
+        if roi_stack is not None:
+            return compute_multiscale_fiber_labels(fiber_endpoints, roi_stack, n_rois_list)
+        return [compute_fiber_labels(fiber_endpoints, roi_data, n_rois)
+                for roi_data, n_rois in zip(roi_data_list, n_rois_list)]
+
+    if streaming:
+        # Fibers are labelled chunk by chunk and their labels are written to the working directory
+        label_writers = [(_DiskArrayWriter(work_dir, 'fiberlabels_%s' % parkey, np.float64, (2,)),
+                          _DiskArrayWriter(work_dir, 'final_fiberlabels_%s' % parkey, np.int32, (2,)),
+                          _DiskArrayWriter(work_dir, 'final_fibers_idx_%s' % parkey, np.int64))
+                         for parkey in parkeys]
+        n_orphans = [0] * len(parkeys)
+        n_outside = 0
+        for start in range(0, n, chunk_size):
+            chunk_labels = label_fibers(np.asarray(endpoints[start:start + chunk_size]))
+            for s, (fiberlabels, final_fiberlabels, final_fibers_idx, chunk_orphans, _) in enumerate(chunk_labels):
+                label_writers[s][0].append(fiberlabels)
+                label_writers[s][1].append(final_fiberlabels)
+                label_writers[s][2].append(start + final_fibers_idx)
+                n_orphans[s] += chunk_orphans
+            n_outside += chunk_labels[0][4]
+        scale_labels = [tuple(writer.finalize() for writer in writers) + (n_orphans[s], n_outside)
+                        for s, writers in enumerate(label_writers)]
+    else:
+        scale_labels = label_fibers(endpoints)
+    del roi_stack
+
+    # Group the fibers of each resolution by edge
+    scale_edges = [group_fibers_by_edge(final_fiberlabels, n_rois)
+                   for (_, final_fiberlabels, _, _, _), n_rois in zip(scale_labels, n_rois_list)]
+    scale_fiber_edge = []
+    for parkey, (_, _, final_fibers_idx, _, _), (_, fiber_edge) in zip(parkeys, scale_labels, scale_edges):
+        if streaming:
+            # Edge index of each fiber, written chunk by chunk to the working directory
+            fiber_edge_writer = _DiskArrayWriter(work_dir, 'fiber_edge_%s' % parkey, np.int32)
+            for start in range(0, n, chunk_size):
+                fiber_edge_chunk = np.full(min(chunk_size, n - start), -1, dtype=np.int32)
+                first, last = np.searchsorted(final_fibers_idx, [start, start + chunk_size])
+                fiber_edge_chunk[final_fibers_idx[first:last] - start] = fiber_edge[first:last]
+                fiber_edge_writer.append(fiber_edge_chunk)
+            scale_fiber_edge.append(fiber_edge_writer.finalize())
+        else:
+            fiber_edge_full = np.full(n, -1, dtype=np.int64)
+            fiber_edge_full[final_fibers_idx] = fiber_edge
+            scale_fiber_edge.append(fiber_edge_full)
+
+    def iter_fiber_points():
+        """Iterate over the packed points and offsets of the fibers by chunks."""
+        if streamline_store is not None or not streaming:
+            return iter_packed_chunks(points, offsets, chunk_size)
+        return (pack_fibers(chunk) for chunk in iter_fiber_chunks(intrk, chunk_size))
+
+    if store_streamlines:
+        if streamline_store is not None and op.abspath(streamline_store) == op.abspath(store_fname):
+            print("  ... WARNING - Streamline store %s is the input store and is not overwritten" % store_fname)
+        else:
+            print("  >> Save streamline store : %s" % store_fname)
+            store_columns = {'trk_header': hdr,
+                             'voxel_size': np.array(roiVoxelSize, dtype=np.float64),
+                             'offsets': offsets,
+                             'points': ((int(offsets[-1]), 3), np.float32,
+                                        (chunk_points for chunk_points, _ in iter_fiber_points())),
+                             'endpoints': endpoints,
+                             'endpointsmm': endpointsmm,
+                             'fiberlength': fiberlength}
+            if compute_curvature:
+                store_columns['meancurvature'] = meancurv
+            for parkey, (fiberlabels, final_fiberlabels, final_fibers_idx, _, _) in zip(parkeys, scale_labels):
+                store_columns['filtered_fiberslabel_%s' % parkey] = np.array(fiberlabels, dtype=np.int32)
+                store_columns['final_fiberlabels_%s' % parkey] = final_fiberlabels
+                store_columns['final_fibers_idx_%s' % parkey] = final_fibers_idx
+            save_array_store(store_fname, store_columns)
+            del store_columns
+
+    # prepare: compute the measures
+    mmap = additional_maps
+    # In parallel, each map is loaded by the process sampling it
+    parallel_maps = pool is not None and not streaming and len(mmap) > 0
+    mmapdata = {}
+    print('  >> Maps to be processed :')
+    for k, v in list(mmap.items()):
+        print("     - %s map" % k)
+        if parallel_maps:
+            continue
+        da = nib.load(v)
+        mdata = da.get_data()
+        print(mdata.max())
+        mdata = np.nan_to_num(mdata)
+        print(mdata.max())
+        mmapdata[k] = (mdata, da.get_header().get_zooms())
+
+    # print("mmapdata size : %g " % len(mmapdata.items()))
+
+    # Compute the scalar map metrics of all edges of all resolutions
+    scale_n_edges = [edges.shape[0] for (edges, _) in scale_edges]
+    scale_map_metrics = [{} for _ in parkeys]
+    n_discarded = dict((k, 0) for k in mmap)
+    if parallel_maps:
+        if streamline_store is not None:
+            points_source = (streamline_store, 'points')
+        else:
+            points_source = _share_array(points, work_dir, 'points')
+        offsets_source = _share_array(offsets, work_dir, 'offsets')
+        fiber_edge_sources = [_share_array(fiber_edge_full, work_dir, 'fiber_edge_%s' % parkey)
+                              for parkey, fiber_edge_full in zip(parkeys, scale_fiber_edge)]
+        results = pool.map(_compute_map_edge_metrics_worker,
+                           [(v, points_source, offsets_source, fiber_edge_sources, scale_n_edges)
+                            for v in list(mmap.values())])
+        for k, (n_discarded[k], scale_metrics) in zip(list(mmap.keys()), results):
+            for s, metrics in enumerate(scale_metrics):
+                scale_map_metrics[s][k] = metrics
+    elif not streaming:
+        # Each map is sampled once for all fibers and all resolutions
+        for k, (mdata, zooms) in list(mmapdata.items()):
+            n_discarded[k], scale_metrics = compute_map_edge_metrics(points, offsets, mdata, zooms,
+                                                                     scale_fiber_edge, scale_n_edges)
+            for s, metrics in enumerate(scale_metrics):
+                scale_map_metrics[s][k] = metrics
+    elif len(mmapdata) > 0:
+        # Maps are sampled chunk by chunk and the edge metrics are accumulated
+        accumulators = [dict((k, EdgeScalarAccumulator(n_edges, (mdata.min(), mdata.max())))
+                             for k, (mdata, _) in list(mmapdata.items()))
+                        for n_edges in scale_n_edges]
+        first_fiber = 0
+        for chunk_points, chunk_offsets in iter_fiber_points():
+            n_chunk = chunk_offsets.shape[0] - 1
+            point_fiber = np.repeat(np.arange(n_chunk), np.diff(chunk_offsets))
+            chunk_point_edge = [np.asarray(fiber_edge_full[first_fiber:first_fiber + n_chunk])[point_fiber]
+                                for fiber_edge_full in scale_fiber_edge]
+            for k, (mdata, zooms) in list(mmapdata.items()):
+                values, valid_fibers = sample_scalar_map(chunk_points, chunk_offsets, mdata, zooms)
+                n_discarded[k] += np.count_nonzero(~valid_fibers)
+                valid_points = valid_fibers[point_fiber]
+                for s, point_edge in enumerate(chunk_point_edge):
+                    accumulators[s][k].add(values, np.where(valid_points, point_edge, -1))
+            first_fiber += n_chunk
+        for s, scale_accumulators in enumerate(accumulators):
+            for k, accumulator in list(scale_accumulators.items()):
+                scale_map_metrics[s][k] = accumulator.get_metrics()
+        del accumulators
+    if not streaming and streamline_store is None:
+        del points
+    for k in mmap:
+        if n_discarded[k] > 0:
+            print("  ... ERROR - Index error occured when trying extract scalar values for measure", k)
+            print("  ... ERROR - Discard %i fibers" % n_discarded[k])
+    del mmapdata
+
+    # Create the connectome of each resolution
+    if pool is not None:
+        fiberlength_source = _share_array(fiberlength, work_dir, 'fiberlength')
+        tasks = []
+        for s, parkey in enumerate(parkeys):
+            (fiberlabels, final_fiberlabels, final_fibers_idx, n_orphans, n_outside) = scale_labels[s]
+            label_sources = [_share_array(fiberlabels, work_dir, 'fiberlabels_%s' % parkey),
+                             _share_array(final_fiberlabels, work_dir, 'final_fiberlabels_%s' % parkey),
+                             _share_array(final_fibers_idx, work_dir, 'final_fibers_idx_%s' % parkey)]
+            tasks.append((parkey, resolutions[parkey], roi_fname_list[s], parcellation_scheme, label_sources,
+                          n_orphans, n_outside, fiberlength_source, scale_map_metrics[s], output_types))
+        pool.map(_create_scale_connectome_worker, tasks)
+    else:
+        for s, parkey in enumerate(parkeys):
+            create_scale_connectome(parkey, resolutions[parkey], roi_data_list[s], parcellation_scheme,
+                                    scale_labels[s], scale_edges[s], fiberlength, scale_map_metrics[s],
+                                    output_types)
+    final_fibers_idx = scale_labels[-1][2]
+
+    # Fibers kept in the last resolution are written once all connectomes are created
+    print("  > Filtering tractography - keeping only no orphan fibers")
+    finalfibers_fname = 'streamline_final.trk'
+    if streamline_store is not None:
+        save_packed_fibers(hdr, points, offsets, finalfibers_fname, final_fibers_idx)
+    elif streaming:
+        save_fibers_subset(intrk, finalfibers_fname, final_fibers_idx)
+    else:
+        save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
 
     print("Done.")
     print("========================")
@@ -739,6 +2147,27 @@ class CMTK_cmatInputSpec(BaseInterfaceInputSpec):
     output_types = traits.List(
         Str, desc='Output types of the connectivity matrices')
 
+    streaming = traits.Bool(
+        False, desc='Read the tractogram in chunks of fibers instead of loading it at once '
+                    '(medians of additional maps are then estimated from histograms)',
+        usedefault=True)
+
+    chunk_size = traits.Int(
+        100000, desc='Number of fibers per chunk when streaming is enabled', usedefault=True)
+
+    store_streamlines = traits.Bool(
+        False, desc='Save fiber points, endpoints, lengths, curvature and labels '
+                    'in a single memory-mappable store file', usedefault=True)
+
+    streamline_store = File(exists=True,
+                            desc='Streamline store to read the fibers from instead of the tractogram')
+
+    endpoints_dtype = traits.Enum('float64', ['float64', 'int32'], usedefault=True,
+                                  desc='Data type of the voxel index endpoints')
+
+    n_procs = traits.Int(1, usedefault=True,
+                         desc='Number of processes used to compute the connectomes of all resolutions and maps')
+
     # probtrackx = traits.Bool(False, desc="MUST be set to True if probtrackx was used (Not used anymore in CMP3)")
 
     voxel_connectivity = InputMultiPath(File(exists=True),
@@ -759,7 +2188,11 @@ class CMTK_cmatOutputSpec(TraitedSpec):
 
     streamline_final_file = File(desc="Final tractogram of fibers considered in the creation of connectivity matrices")
 
-    connectivity_matrices = OutputMultiPath(File(), desc="Connectivity matrices")
+    connectivity_matrices = OutputMultiPath(File(), desc="Connectivity matrices. In streaming mode, the median of "
+                                                          "the additional maps along the fibers of each edge is "
+                                                          "an approximation interpolated from a 256-bin histogram")
+
+    streamline_store_file = File(desc="Memory-mappable store of fiber points, endpoints, lengths, curvature and labels")
 
 
 class CMTK_cmat(BaseInterface):
@@ -801,7 +2234,13 @@ class CMTK_cmat(BaseInterface):
              parcellation_scheme=self.inputs.parcellation_scheme, atlas_info=self.inputs.atlas_info,
              compute_curvature=self.inputs.compute_curvature,
              additional_maps=additional_maps,
-             output_types=self.inputs.output_types)
+             output_types=self.inputs.output_types,
+             streaming=self.inputs.streaming,
+             chunk_size=self.inputs.chunk_size,
+             store_streamlines=self.inputs.store_streamlines,
+             streamline_store=self.inputs.streamline_store if isdefined(self.inputs.streamline_store) else None,
+             endpoints_dtype=np.dtype(self.inputs.endpoints_dtype),
+             n_procs=self.inputs.n_procs)
 
         return runtime
 
@@ -819,6 +2258,8 @@ class CMTK_cmat(BaseInterface):
             'streamline_final.trk')
         outputs['connectivity_matrices'] = glob.glob(
             os.path.abspath('connectome*'))
+        if self.inputs.store_streamlines:
+            outputs['streamline_store_file'] = os.path.abspath('streamline_store.npz')
 
         return outputs
 
@@ -848,9 +2289,49 @@ class rsfmri_conmat_InputSpec(BaseInterfaceInputSpec):
 
     DVARS_th = Float(desc="DVARS threshold")
 
+    scrubbing_interpolation = traits.Enum('none', ['none', 'linear', 'spectral'], usedefault=True,
+                                          desc="If 'linear' or 'spectral', the censored time points are "
+                                               "replaced by interpolated values instead of being discarded "
+                                               "(See :func:`cmtklib.functionalMRI.interpolate_censored_timepoints`) "
+                                               "(Default: 'none')")
+
     output_types = traits.List(Str,
                                desc='Output types of the connectivity matrices')
 
+    connectivity_metrics = traits.List(traits.Enum(*FUNCTIONAL_CONNECTIVITY_METRICS), ['corr'], usedefault=True,
+                                       desc="Functional connectivity metrics computed from the ROI time-series, "
+                                            "among %s, which are saved as edge attributes "
+                                            "(See :func:`compute_functional_connectivity`) (Default: ['corr'])"
+                                            % ", ".join(FUNCTIONAL_CONNECTIVITY_METRICS))
+
+    max_lag = traits.Int(3, usedefault=True,
+                         desc="Maximal lag in number of time points of the lagged correlation (Default: 3)")
+
+    coherence_segment_length = traits.Int(64, usedefault=True,
+                                          desc="Number of time points of the Welch segments "
+                                               "of the coherence (Default: 64)")
+
+    dynamic_fc = Bool(False, usedefault=True,
+                      desc="If `True`, also save the correlations of the ROI pairs in sliding windows "
+                           "of each resolution as a float32 [#windows x #edges] ``connectome_<scale>_dynamic.npy`` "
+                           "file (See :func:`sliding_window_correlation`)")
+
+    window_length = traits.Int(30, usedefault=True,
+                               desc="Number of time points of the sliding windows (Default: 30)")
+
+    window_step = traits.Int(1, usedefault=True,
+                             desc="Number of time points between two sliding windows (Default: 1)")
+
+    window_taper = traits.Enum('none', ['none', 'hamming', 'hann', 'tukey'], usedefault=True,
+                               desc="Taper of the sliding windows (Default: 'none')")
+
+    dense_only = Bool(False, usedefault=True,
+                      desc="If `True`, only save the dense matrix of each resolution and connectivity metric "
+                           "as a float32 ``connectome_<scale>.npy`` file for the correlation and "
+                           "``connectome_<scale>_<metric>.npy`` for the other metrics, whose rows and columns "
+                           "follow the ROI labels, with the ``connectome_<scale>.tsv`` edge list, instead "
+                           "of the connectome graph in the `output_types` formats")
+
 
 class rsfmri_conmat_OutputSpec(TraitedSpec):
     avg_timeseries = OutputMultiPath(File(exists=True),
@@ -867,7 +2348,8 @@ class rsfmri_conmat(BaseInterface):
     """Creates the functional connectivity matrices for a given parcellation scheme.
 
     It applies scrubbing (if enabled), computes the average GM ROI time-series and computes
-    the Pearson's correlation coefficient between each GM ROI time-series poir.
+    the Pearson's correlation coefficient between each GM ROI time-series poir, and optionally
+    other connectivity metrics (See :func:`compute_functional_connectivity`).
 
     Examples
     --------
@@ -887,6 +2369,7 @@ class rsfmri_conmat(BaseInterface):
     >>>                             '/path/to/sub-01_atlas-L2018_desc-scale5_dseg.graphml']
     >>> cmat.inputs.parcellation scheme = 'Lausanne2018'
     >>> cmat.inputs.apply_scrubbing = False
+    >>> cmat.inputs.connectivity_metrics = ['corr', 'partial_corr']
     >>> cmat.inputs.output_types = ['gPickle','mat','graphml']
     >>> cmat.run() # doctest: +SKIP
     """
@@ -898,10 +2381,6 @@ class rsfmri_conmat(BaseInterface):
         print("Compute average rs-fMRI signal for each cortical ROI")
         print("====================================================")
 
-        fdata = nib.load(self.inputs.func_file).get_data()
-
-        tp = fdata.shape[3]
-
         # OLD
         # if self.inputs.parcellation_scheme != "Custom":
         #     resolutions = get_parcellation(self.inputs.parcellation_scheme)
@@ -944,27 +2423,8 @@ class rsfmri_conmat(BaseInterface):
             resolutions = self.inputs.atlas_info
             print(resolutions)
 
-        index = np.linspace(0, tp - 1, tp).astype('int')
-
-        # if self.inputs.apply_scrubbing:
-        #     # load scrubbing FD and DVARS series
-        #     FD = np.load( self.inputs.FD )
-        #     DVARS = np.load( self.inputs.DVARS )
-        #     # evaluate scrubbing mask
-        #     FD_th = self.inputs.FD_th
-        #     DVARS_th = self.inputs.DVARS_th
-        #     FD_mask = np.array(np.nonzero(FD < FD_th))[0,:]
-        #     DVARS_mask = np.array(np.nonzero(DVARS < DVARS_th))[0,:]
-        #     index = np.sort(np.unique(np.concatenate((FD_mask,DVARS_mask)))) + 1
-        #     index = np.concatenate(([0],index))
-        #     log_scrubbing = "DISCARDED time points after scrubbing: " + str(FD.shape[0]-index.shape[0]+1) + " over " + str(FD.shape[0]+1)
-        #     print(log_scrubbing)
-        #     np.save( os.path.abspath( 'tp_after_scrubbing.npy'), index )
-        #     sio.savemat( os.path.abspath('tp_after_scrubbing.mat'), {'index':index} )
-        # else:
-        #     index = np.linspace(0,tp-1,tp).astype('int')
-
         # loop throughout all the resolutions ('scale33', ..., 'scale500')
+        roi_data = {}
         for parkey, parval in list(resolutions.items()):
             print("Resolution = " + parkey)
 
@@ -974,97 +2434,67 @@ class rsfmri_conmat(BaseInterface):
                 if (parkey in vol) or (len(self.inputs.roi_volumes) == 1):
                     roi_fname = vol
                     print(roi_fname)
-
-            roi = nib.load(roi_fname)
-            mask = roi.get_data()
-
-            # Compute average time-series
-            # nROIs: number of ROIs for current resolution
-            nROIs = parval['number_of_regions']
-
+            roi_data[parkey] = np.asanyarray(nib.load(roi_fname).dataobj)
+
+        # Compute the average time-series of the ROIs of all resolutions at once,
+        # from the time series of the voxels belonging to at least one ROI
+        roi_stack = np.stack([roi_data[parkey] for parkey in resolutions])
+        timeseries = MaskedTimeSeries.from_nifti(self.inputs.func_file, mask=np.any(roi_stack > 0, axis=0))
+        scale_timeseries = compute_roi_timeseries(timeseries, roi_stack,
+                                                  [parval['number_of_regions'] for parval in resolutions.values()])
+        del timeseries, roi_stack
+
+        average_timeseries = {}
+        for parkey, ts in zip(resolutions, scale_timeseries):
             # matrix number of rois vs timepoints
-            ts = np.zeros((nROIs, tp), dtype=np.float32)
-
-            # loop throughout all the ROIs (current resolution)
-            for i in range(1, nROIs + 1):
-                ts[i - 1, :] = fdata[mask == i].mean(axis=0)
             print("ts_shape:", ts.shape)
+            average_timeseries[parkey] = ts
 
             np.save(os.path.abspath('averageTimeseries_%s.npy' % parkey), ts)
             sio.savemat(os.path.abspath(
                 'averageTimeseries_%s.mat' % parkey), {'ts': ts})
 
+        # Censoring mask, shared by all the resolutions
+        if self.inputs.apply_scrubbing:
+            # load scrubbing FD and DVARS series
+            FD = np.load(self.inputs.FD)
+            DVARS = np.load(self.inputs.DVARS)
+            # evaluate scrubbing mask: the first time point and the time points
+            # following a FD or a DVARS value below its threshold are kept
+            n_timepoints = next(iter(average_timeseries.values())).shape[1]
+            keep = np.zeros(n_timepoints, dtype=bool)
+            keep[0] = True
+            keep[np.flatnonzero(FD < self.inputs.FD_th) + 1] = True
+            keep[np.flatnonzero(DVARS < self.inputs.DVARS_th) + 1] = True
+            index = np.flatnonzero(keep)
+            log_scrubbing = "DISCARDED time points after scrubbing: " + str(
+                FD.shape[0] - index.shape[0] + 1) + " over " + str(FD.shape[0] + 1)
+            print(log_scrubbing)
+            np.save(os.path.abspath('tp_after_scrubbing.npy'), index)
+            sio.savemat(os.path.abspath(
+                'tp_after_scrubbing.mat'), {'index': index})
+
         # Apply scrubbing (if enabled) and compute correlation
         # loop throughout all the resolutions ('scale33', ..., 'scale500')
         for parkey, parval in list(resolutions.items()):
             print("Resolution = " + parkey)
-
-            # Open the corresponding ROI
-            print("Open the corresponding ROI")
-            for vol in self.inputs.roi_volumes:
-                if parkey in vol:
-                    roi_fname = vol
-                    print(roi_fname)
-            roi = nib.load(roi_fname)
-            roiData = roi.get_data()
+            roiData = roi_data[parkey]
 
             # Average roi time-series
-            ts = np.load(os.path.abspath('averageTimeseries_%s.npy' % parkey))
+            ts = average_timeseries[parkey]
 
             # nROIs: number of ROIs for current resolution
             nROIs = parval['number_of_regions']
 
-            # Create matrix, add node information from parcellation and recover ROI indexes
-            print("Create the connection matrix (%s rois)" % nROIs)
-            G = nx.Graph()
-            gp = nx.read_graphml(parval['node_information_graphml'])
-            ROI_idx = []
-            for u, d in gp.nodes(data=True):
-                G.add_node(int(u))
-                for key in d:
-                    G.nodes[int(u)][key] = d[key]
-                # compute a position for the node based on the mean position of the
-                # ROI in voxel coordinates (segmentation volume )
-                if self.inputs.parcellation_scheme != "Lausanne2018":
-                    G.nodes[int(u)]['dn_position'] = tuple(
-                        np.mean(np.where(mask == int(d["dn_correspondence_id"])), axis=1))
-                    ROI_idx.append(int(d["dn_correspondence_id"]))
-                else:
-                    G.nodes[int(u)]['dn_position'] = tuple(
-                        np.mean(np.where(mask == int(d["dn_multiscaleID"])), axis=1))
-                    ROI_idx.append(int(d["dn_multiscaleID"]))
-            # # matrix number of rois vs timepoints
-            # ts = np.zeros( (nROIs,tp), dtype = np.float32 )
-            #
-            # # loop throughout all the ROIs (current resolution)
-            # roi_line = 0
-            # for i in ROI_idx:
-            #     ts[roi_line,:] = fdata[roiData==i].mean( axis = 0 )
-            #     roi_line += 1
-            #
-            # np.save( os.path.abspath('averageTimeseries_%s.npy' % parkey), ts )
-            # sio.savemat( os.path.abspath('averageTimeseries_%s.mat' % parkey), {'TCS':ts} )
-
             # Censoring time-series
             if self.inputs.apply_scrubbing:
-                # load scrubbing FD and DVARS series
-                FD = np.load(self.inputs.FD)
-                DVARS = np.load(self.inputs.DVARS)
-                # evaluate scrubbing mask
-                FD_th = self.inputs.FD_th
-                DVARS_th = self.inputs.DVARS_th
-                FD_mask = np.array(np.nonzero(FD < FD_th))[0, :]
-                DVARS_mask = np.array(np.nonzero(DVARS < DVARS_th))[0, :]
-                index = np.sort(
-                    np.unique(np.concatenate((FD_mask, DVARS_mask)))) + 1
-                index = np.concatenate(([0], index))
-                log_scrubbing = "DISCARDED time points after scrubbing: " + str(
-                    FD.shape[0] - index.shape[0] + 1) + " over " + str(FD.shape[0] + 1)
-                print(log_scrubbing)
-                np.save(os.path.abspath('tp_after_scrubbing.npy'), index)
-                sio.savemat(os.path.abspath(
-                    'tp_after_scrubbing.mat'), {'index': index})
-                ts_after_scrubbing = ts[:, index]
+                if self.inputs.scrubbing_interpolation == 'none':
+                    ts_after_scrubbing = ts[:, index]
+                else:
+                    # Censored time points are replaced by values interpolated from the kept ones
+                    ts_after_scrubbing = interpolate_censored_timepoints(ts, keep,
+                                                                         self.inputs.scrubbing_interpolation,
+                                                                         out=np.empty_like(ts))
                 np.save(os.path.abspath(
                     'averageTimeseries_%s_after_scrubbing.npy' % parkey), ts_after_scrubbing)
                 sio.savemat(os.path.abspath('averageTimeseries_%s_after_scrubbing.mat' % parkey),
@@ -1072,119 +2502,78 @@ class rsfmri_conmat(BaseInterface):
                 ts = ts_after_scrubbing
                 print('ts.shape : ', ts.shape)
 
-                # initialize connectivity matrix
-                nnodes = ts.shape[0]
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in range(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s_after_scrubbing.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(),
-                #    'fconnectome_%s_after_scrubbing.mat' % s), {'fmat':fmat} )
-            else:
-                nnodes = ts.shape[0]
-
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in range(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(), 'fconnectome_%s.mat' % s), {'fmat':fmat} )
-
-            # Get the edge attributes/keys/weights from the first edge and then break.
-            # Change w.r.t networkx2
-            edge_keys = []
-            for _, _, d in G.edges(data=True):
-                # print(list(d.keys()))
-                edge_keys = list(d.keys())
-                break
+            if self.inputs.dynamic_fc:
+                # Windows are written one at a time in the memory-mapped output
+                n_windows = max((ts.shape[1] - self.inputs.window_length) // self.inputs.window_step + 1, 0)
+                print('    - connectome_%s_dynamic.npy (%i windows)' % (parkey, n_windows))
+                dynamic_fc = np.lib.format.open_memmap('connectome_%s_dynamic.npy' % parkey, mode='w+',
+                                                       dtype=np.float32,
+                                                       shape=(n_windows, ts.shape[0] * (ts.shape[0] - 1) // 2))
+                sliding_window_correlation(ts, self.inputs.window_length, step=self.inputs.window_step,
+                                           taper=self.inputs.window_taper, out=dynamic_fc)
+                del dynamic_fc
+
+            # Connectivity matrices between all the pairs of ROI time-series at once
+            # (Pearson's correlation by default)
+            metrics = list(self.inputs.connectivity_metrics)
+            matrices = compute_functional_connectivity(ts, metrics, max_lag=self.inputs.max_lag,
+                                                       coherence_segment_length=self.inputs.coherence_segment_length)
+
+            # Edges between each pair of ROIs (including self-connections)
+            # in the row-major order of the upper triangle of the matrix
+            gp = nx.read_graphml(parval['node_information_graphml'])
+            node_ids = [int(u) for u in gp.nodes()]
+            id_key = 'dn_multiscaleID' if self.inputs.parcellation_scheme == "Lausanne2018" else 'dn_correspondence_id'
+            ROI_idx = [int(d[id_key]) for _, d in gp.nodes(data=True)]
+            rows, cols = np.triu_indices(ts.shape[0])
+            roi_labels = np.array(ROI_idx, dtype=np.int64)
+            edges = np.column_stack((roi_labels[rows], roi_labels[cols]))
+            edge_attrs = dict((metric, np.ma.array(matrices[metric][rows, cols])) for metric in metrics)
 
             print('    - connectome_%s.tsv' % parkey)
+            save_connectome_tsv('connectome_%s.tsv' % parkey, edges, edge_attrs)
+
+            if self.inputs.dense_only:
+                for metric in metrics:
+                    fname = 'connectome_%s.npy' % parkey if metric == 'corr' else \
+                        'connectome_%s_%s.npy' % (parkey, metric)
+                    print('    - %s' % fname)
+                    np.save(fname, matrices[metric].astype(np.float32))
+                continue
 
-            with open('connectome_%s.tsv' % parkey, 'w') as out_file:
-                tsv_writer = csv.writer(out_file, delimiter='\t')
-                header = ['source', 'target']
-                header = header + [key for key in edge_keys]
-                tsv_writer.writerow(header)
-
-            with open('connectome_%s.tsv' % parkey, 'ab') as out_file:
-                nx.write_edgelist(G,
-                                  out_file,
-                                  comments='#',
-                                  delimiter='\t',
-                                  data=edge_keys,
-                                  encoding='utf-8')
+            # Create matrix, add node information from parcellation
+            print("Create the connection matrix (%s rois)" % nROIs)
+            # compute a position for the node based on the mean position of the
+            # ROI in voxel coordinates (segmentation volume )
+            roi_positions, _ = compute_roi_positions(roiData, ROI_idx)
+
+            node_data = []
+            for n_node, (_, d) in enumerate(gp.nodes(data=True)):
+                d = dict(d)
+                d['dn_position'] = tuple(roi_positions[n_node])
+                node_data.append(d)
+            node_attrs = {}
+            if node_data:
+                node_attrs = dict((key, [d[key] for d in node_data]) for key in node_data[0])
+
+            # Nodes without information in the parcellation graphml are added as the edges refer to them
+            known_nodes = set(node_ids)
+            for u in edges.ravel().tolist():
+                if u not in known_nodes:
+                    node_ids.append(u)
+                    known_nodes.add(u)
 
             # storing network
             if 'gPickle' in self.inputs.output_types:
-                nx.write_gpickle(G, 'connectome_%s.gpickle' % parkey)
+                nx.write_gpickle(create_connectome_graph(node_ids, node_data, edges, edge_attrs),
+                                 'connectome_%s.gpickle' % parkey)
             if 'mat' in self.inputs.output_types:
-                # edges
-                # size_edges = (int(parval['number_of_regions']), int(
-                #     parval['number_of_regions']))
-
-                edge_struct = {}
-                for edge_key in edge_keys:
-                    edge_struct[edge_key] = nx.to_numpy_matrix(
-                        G, weight=edge_key)
-
-                # nodes
-                size_nodes = int(parval['number_of_regions'])
-
-                # Get the node attributes/keys from the first node and then break.
-                # Change w.r.t networkx2
-                for u, d in G.nodes(data=True):
-                    node_keys = list(d.keys())
-                    break
-
-                node_struct = {}
-                for node_key in node_keys:
-                    if node_key == 'dn_position':
-                        node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                    else:
-                        node_arr = np.zeros(size_nodes, dtype=np.object_)
-                    node_n = 0
-                    for _, node_data in G.nodes(data=True):
-                        node_arr[node_n] = node_data[node_key]
-                        node_n += 1
-                    node_struct[node_key] = node_arr
-
-                sio.savemat('connectome_%s.mat' % parkey, mdict={
-                            'sc': edge_struct, 'nodes': node_struct})
+                save_connectome_mat('connectome_%s.mat' % parkey, node_ids, node_attrs, edges, edge_attrs)
             if 'graphml' in self.inputs.output_types:
-                g2 = nx.Graph()
-                # Create graph nodes
-                for u_gml, d_gml in G.nodes(data=True):
-                    g2.add_node(u_gml)
-                    if self.inputs.parcellation_scheme != "Lausanne2018":
-                        g2.nodes[u_gml]['dn_correspondence_id'] = d_gml['dn_correspondence_id']
-                    else:
-                        g2.nodes[u_gml]['dn_multiscaleID'] = d_gml['dn_multiscaleID']
-                    g2.nodes[u_gml]['dn_fsname'] = d_gml['dn_fsname']
-                    g2.nodes[u_gml]['dn_hemisphere'] = d_gml['dn_hemisphere']
-                    g2.nodes[u_gml]['dn_name'] = d_gml['dn_name']
-                    g2.nodes[u_gml]['dn_position_x'] = d_gml['dn_position'][0]
-                    g2.nodes[u_gml]['dn_position_y'] = d_gml['dn_position'][1]
-                    g2.nodes[u_gml]['dn_position_z'] = d_gml['dn_position'][2]
-                    g2.nodes[u_gml]['dn_region'] = d_gml['dn_region']
-                # Create graph edges
-                for u_gml, v_gml, d_gml in G.edges(data=True):
-                    g2.add_edge(u_gml, v_gml)
-                    g2[u_gml][v_gml]['corr'] = float(d_gml['corr'])
-                # Save the graph
-                nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
+                save_connectome_graphml('connectome_%s.graphml' % parkey, node_ids, node_attrs, edges, edge_attrs,
+                                        self.inputs.parcellation_scheme, nodes_first=True)
+            if 'npz' in self.inputs.output_types:
+                save_connectome_npz('connectome_%s.npz' % parkey, node_ids, node_attrs, edges, edge_attrs)
 
         print("[ DONE ]")
         return runtime
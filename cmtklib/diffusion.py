@@ -18,7 +18,7 @@ from nipype.utils.filemanip import split_filename
 
 from traits.trait_types import List, Str, Int, Enum
 
-from .util import length
+from .util import length, save_fibers_subset
 
 
 def compute_length_array(trkfile=None, streams=None, savefname='lengths.npy'):
@@ -96,23 +96,11 @@ def filter_fibers(intrk, outtrk='', fiber_cutoff_lower=20, fiber_cutoff_upper=50
     reducedidx = np.where((le > fiber_cutoff_lower) &
                           (le < fiber_cutoff_upper))[0]
 
-    # load trackfile (downside, needs everything in memory)
-    fibold, hdrold = tv.read(intrk)
-
-    # rewrite the track vis file with the reduced number of fibers
-    outstreams = []
-    for i in reducedidx:
-        outstreams.append(fibold[i])
-
-    n_fib_out = len(outstreams)
-    hdrnew = hdrold.copy()
-    hdrnew['n_count'] = n_fib_out
-
-    # print("Compute length array for cutted fibers")
-    # le = compute_length_array(streams=outstreams)
+    # rewrite the track vis file with the reduced number of fibers,
+    # streaming the fibers from the input trackfile
     print("Write out file: %s" % outtrk)
-    print("Number of fibers out : %d" % hdrnew['n_count'])
-    tv.write(outtrk, outstreams, hdrnew)
+    print("Number of fibers out : %d" % reducedidx.shape[0])
+    save_fibers_subset(intrk, outtrk, reducedidx)
     print("File wrote : %d" % os.path.exists(outtrk))
 
     # ----
@@ -14,6 +14,416 @@ import nibabel as nib
 import scipy.io as sio
 from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, InputMultiPath
 
+from .util import save_array_store, load_array_store
+
+
+def regress_out(data, regressors, chunk_size=10000, out=None):
+    """Regress out a design matrix shared by all the time series of `data` with ordinary least squares.
+
+    The pseudo-inverse of the design matrix is computed once and
+    the voxels are fitted together by chunks of `chunk_size` voxels.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Time series of shape (n_voxels, n_timepoints)
+
+    regressors : numpy.ndarray
+        Design matrix of shape (n_timepoints, n_regressors)
+
+    chunk_size : int
+        Number of voxels fitted at once
+        (Default: 10000)
+
+    out : numpy.ndarray
+        Optional array of shape (n_voxels, n_timepoints) in which the
+        residuals are written. It can be `data` itself.
+
+    Returns
+    -------
+    residuals : numpy.ndarray
+        Residuals of the fit of shape (n_voxels, n_timepoints)
+    """
+    regressors = np.asarray(regressors, dtype=np.float64)
+    # Transposed projection matrix onto the space spanned by the regressors
+    projection = np.linalg.pinv(regressors).T.dot(regressors.T)
+
+    residuals = np.empty(data.shape, dtype=np.float64) if out is None else out
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+        residuals[start:start + chunk_size] = chunk - chunk.dot(projection)
+    return residuals
+
+
+def polynomial_basis(n_timepoints, order):
+    """Return the Legendre polynomials up to `order` sampled at `n_timepoints` regularly spaced time points.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of time points
+
+    order : int
+        Maximal order of the polynomials (1: linear, 2: quadratic, 3: cubic)
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        Polynomials of shape (n_timepoints, order + 1), including the constant term
+    """
+    return np.polynomial.legendre.legvander(np.linspace(-1, 1, n_timepoints), order)
+
+
+def spline_basis(n_timepoints, knot_spacing, degree=3):
+    """Return the B-spline basis sampled at `n_timepoints` time points.
+
+    The basis spans the splines of the given `degree` with interior
+    knots placed every `knot_spacing` time points.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of time points
+
+    knot_spacing : int
+        Number of time points between two knots
+
+    degree : int
+        Degree of the splines
+        (Default: 3)
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        B-splines of shape (n_timepoints, n_basis)
+    """
+    from scipy.interpolate import BSpline
+
+    t = np.arange(n_timepoints, dtype=np.float64)
+    interior_knots = np.arange(knot_spacing, n_timepoints - 1, knot_spacing, dtype=np.float64)
+    knots = np.concatenate(([t[0]] * (degree + 1), interior_knots, [t[-1]] * (degree + 1)))
+    n_basis = len(knots) - degree - 1
+    return BSpline(knots, np.eye(n_basis), degree)(t)
+
+
+def bandpass_filter(data, tr, highpass=0.0, lowpass=0.0, chunk_size=10000, out=None):
+    """Apply an ideal bandpass filter to the time series of `data` in the frequency domain.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Time series of shape (n_voxels, n_timepoints)
+
+    tr : float
+        Repetition time in seconds
+
+    highpass : float
+        Frequencies below `highpass` (in Hz) are removed, including
+        the mean of the signal if `highpass` is positive
+        (Default: 0.0)
+
+    lowpass : float
+        Frequencies above `lowpass` (in Hz) are removed if positive
+        (Default: 0.0)
+
+    chunk_size : int
+        Number of voxels filtered at once
+        (Default: 10000)
+
+    out : numpy.ndarray
+        Optional array of shape (n_voxels, n_timepoints) in which the
+        filtered time series are written. It can be `data` itself.
+
+    Returns
+    -------
+    filtered : numpy.ndarray
+        Filtered time series of shape (n_voxels, n_timepoints)
+    """
+    n_timepoints = data.shape[1]
+    frequencies = np.fft.rfftfreq(n_timepoints, d=tr)
+    stopband = frequencies < highpass
+    if lowpass > 0:
+        stopband |= frequencies > lowpass
+
+    filtered = np.empty(data.shape, dtype=np.float64) if out is None else out
+    for start in range(0, data.shape[0], chunk_size):
+        spectrum = np.fft.rfft(np.asarray(data[start:start + chunk_size], dtype=np.float64), axis=1)
+        spectrum[:, stopband] = 0
+        filtered[start:start + chunk_size] = np.fft.irfft(spectrum, n=n_timepoints, axis=1)
+    return filtered
+
+
+def interpolate_censored_timepoints(data, keep, method='linear', highest_frequency=0.5, chunk_size=10000, out=None):
+    """Replace the censored time points of all the time series of `data` by interpolated values.
+
+    The interpolation weights only depend on the censored time points,
+    which are shared by all the time series, so that they are computed
+    once and applied by chunks of `chunk_size` voxels with matrix products.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Time series of shape (n_voxels, n_timepoints)
+
+    keep : numpy.ndarray
+        Boolean array of shape (n_timepoints,) that is `False` for the censored time points
+
+    method : 'linear' or 'spectral'
+        Linear interpolation between the nearest kept time points, or
+        spectral interpolation by a least-squares fit of the kept time
+        points with the Fourier basis of the frequencies up to `highest_frequency`
+        (Default: 'linear')
+
+    highest_frequency : float
+        Highest frequency of the Fourier basis of the spectral interpolation as
+        a fraction of the Nyquist frequency. It is reduced so that the basis
+        has at most half as many functions as kept time points.
+        (Default: 0.5)
+
+    chunk_size : int
+        Number of voxels interpolated at once
+        (Default: 10000)
+
+    out : numpy.ndarray
+        Optional array of shape (n_voxels, n_timepoints) in which the
+        interpolated time series are written. It can be `data` itself.
+
+    Returns
+    -------
+    interpolated : numpy.ndarray
+        Time series of shape (n_voxels, n_timepoints) where censored time points are interpolated
+    """
+    keep = np.asarray(keep, dtype=bool)
+    n_timepoints = keep.shape[0]
+    kept = np.flatnonzero(keep)
+    censored = np.flatnonzero(~keep)
+
+    if method == 'linear':
+        # Censored time points before the first or after the last kept one take its value
+        right = np.clip(np.searchsorted(kept, censored), 0, kept.shape[0] - 1)
+        left = np.clip(right - 1 + (kept[right] <= censored), 0, kept.shape[0] - 1)
+        gap = (kept[right] - kept[left]).astype(np.float64)
+        weights = np.divide(censored - kept[left], gap, out=np.zeros(gap.shape), where=gap > 0)
+    else:
+        n_frequencies = min(int(highest_frequency * n_timepoints / 2.), kept.shape[0] // 4)
+        phases = 2 * np.pi * np.outer(np.arange(n_timepoints), np.arange(1, n_frequencies + 1)) / n_timepoints
+        basis = np.column_stack((np.ones(n_timepoints), np.cos(phases), np.sin(phases)))
+        # The censored time points are predicted from the kept ones with a single matrix
+        prediction = basis[censored].dot(np.linalg.pinv(basis[kept]))
+
+    interpolated = np.empty(data.shape, dtype=np.float64) if out is None else out
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.array(data[start:start + chunk_size], dtype=np.float64)
+        if method == 'linear':
+            chunk[:, censored] = (1 - weights) * chunk[:, kept[left]] + weights * chunk[:, kept[right]]
+        else:
+            chunk[:, censored] = chunk[:, kept].dot(prediction.T)
+        interpolated[start:start + chunk_size] = chunk
+    return interpolated
+
+
+def compute_dvars(data, n_voxels=None, standardized=True, chunk_size=10000):
+    """Compute DVARS and its standardized variants from time series.
+
+    DVARS is the root mean square of the differences between successive
+    time points over the voxels. The standardized variants follow [Nichols2013]_:
+    the standard deviation of the differences of each voxel is predicted
+    from its robust standard deviation (interquartile range / 1.349) and
+    lag-1 autocorrelation. DVARS is divided by the mean predicted standard
+    deviation (standardized DVARS), or the differences of each voxel are
+    divided by their predicted standard deviation before computing DVARS
+    (voxelwise standardized DVARS). Voxels with a null standard deviation
+    are ignored by the standardized variants, which are null if no voxel
+    has a non-null standard deviation.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Time series of shape (n_voxels, n_timepoints)
+
+    n_voxels : int
+        Number of voxels DVARS is averaged over, which can include
+        voxels with a null signal not in `data`
+        (Default: number of rows of `data`)
+
+    standardized : bool
+        If `False`, only compute DVARS
+        (Default: True)
+
+    chunk_size : int
+        Number of voxels processed at once
+        (Default: 10000)
+
+    Returns
+    -------
+    dvars : numpy.ndarray
+        DVARS of shape (n_timepoints - 1,)
+
+    dvars_std : numpy.ndarray
+        Standardized DVARS of shape (n_timepoints - 1,),
+        or `None` if `standardized` is `False`
+
+    dvars_vx_std : numpy.ndarray
+        Voxelwise standardized DVARS of shape (n_timepoints - 1,),
+        or `None` if `standardized` is `False`
+
+    References
+    ----------
+    .. [Nichols2013] Nichols T., Notes on creating a standardized version of DVARS, 2013.
+    """
+    if n_voxels is None:
+        n_voxels = data.shape[0]
+
+    sum_sq_diff = np.zeros(data.shape[1] - 1)
+    sum_sq_diff_nz = np.zeros(data.shape[1] - 1)
+    sum_sq_diff_vx_std = np.zeros(data.shape[1] - 1)
+    sum_diff_sd = 0.0
+    n_nz = 0
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+        sq_diff = np.square(np.diff(chunk, axis=1))
+        sum_sq_diff += sq_diff.sum(axis=0)
+        if not standardized:
+            continue
+
+        # Predicted standard deviation of the differences of each voxel
+        q75, q25 = np.percentile(chunk, [75, 25], axis=1)
+        sd = (q75 - q25) / 1.349
+        nz = sd != 0
+        centered = chunk[nz] - chunk[nz].mean(axis=1, keepdims=True)
+        ar1 = (centered[:, :-1] * centered[:, 1:]).sum(axis=1) / np.square(centered).sum(axis=1)
+        diff_sd = np.sqrt(2 * (1 - ar1)) * sd[nz]
+
+        sum_sq_diff_nz += sq_diff[nz].sum(axis=0)
+        sum_sq_diff_vx_std += (sq_diff[nz] / np.square(diff_sd)[:, None]).sum(axis=0)
+        sum_diff_sd += diff_sd.sum()
+        n_nz += np.count_nonzero(nz)
+
+    dvars = np.sqrt(sum_sq_diff / max(n_voxels, 1))
+    if not standardized:
+        return dvars, None, None
+    if n_nz == 0:
+        # No voxel can be standardized, as for time series that are constant
+        return dvars, np.zeros_like(dvars), np.zeros_like(dvars)
+    dvars_std = np.sqrt(sum_sq_diff_nz / n_nz) / (sum_diff_sd / n_nz)
+    dvars_vx_std = np.sqrt(sum_sq_diff_vx_std / n_nz)
+    return dvars, dvars_std, dvars_vx_std
+
+
+class MaskedTimeSeries(object):
+    """Time series of the voxels of a brain mask stored as a 2D (voxels x time points) array.
+
+    Functional interfaces exchange masked time series saved with :meth:`save`
+    in an uncompressed ``.npz`` file, which is memory-mapped by :meth:`load`,
+    instead of full 4D NIfTI volumes. Only the last step converts them back
+    to a volume with :meth:`to_nifti`.
+
+    Attributes
+    ----------
+    data : numpy.ndarray
+        Time series of the voxels of the mask of shape (n_voxels, n_timepoints)
+
+    mask : numpy.ndarray
+        3D boolean mask of the voxels
+
+    affine : numpy.ndarray
+        Affine of the original volume
+
+    header : nibabel.Nifti1Header
+        Header of the original volume
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import MaskedTimeSeries
+    >>> timeseries = MaskedTimeSeries.load('/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz')
+    >>> timeseries.save('fMRI_timeseries.npz') # doctest: +SKIP
+    >>> timeseries.to_nifti('fMRI.nii.gz') # doctest: +SKIP
+    """
+
+    def __init__(self, data, mask, affine, header):
+        self.data = data
+        self.mask = mask
+        self.affine = affine
+        self.header = header
+
+    @property
+    def n_timepoints(self):
+        """Number of time points."""
+        return self.data.shape[1]
+
+    @classmethod
+    def from_nifti(cls, fname, mask=None, dtype=np.float32):
+        """Load the time series of a 4D NIfTI volume.
+
+        Parameters
+        ----------
+        fname : string
+            4D NIfTI volume
+
+        mask : numpy.ndarray
+            3D mask of the voxels to keep. By default, all the voxels
+            with a non-null time series are kept.
+
+        dtype : numpy.dtype
+            Data type of the time series
+            (Default: numpy.float32)
+        """
+        # Volumes are read one at a time so that the 4D volume is never held in memory
+        img = nib.load(fname, keep_file_open=True)
+        if mask is None:
+            mask = np.zeros(img.shape[:3], dtype=bool)
+            for i in range(img.shape[3]):
+                mask |= np.asanyarray(img.dataobj[..., i]) != 0
+        mask = np.asarray(mask, dtype=bool)
+        data = np.empty((np.count_nonzero(mask), img.shape[3]), dtype=dtype)
+        for i in range(img.shape[3]):
+            data[:, i] = np.asanyarray(img.dataobj[..., i])[mask]
+        return cls(data, mask, img.affine, img.header)
+
+    @classmethod
+    def load(cls, fname, mmap_mode='r'):
+        """Load masked time series saved with :meth:`save` or, otherwise, from a 4D NIfTI volume.
+
+        Parameters
+        ----------
+        fname : string
+            Masked time series (``.npz``) or 4D NIfTI volume
+
+        mmap_mode : string
+            Memory-map mode of the time series of a ``.npz`` file
+            (Default: 'r')
+        """
+        if not fname.endswith('.npz'):
+            return cls.from_nifti(fname)
+        columns = load_array_store(fname, mmap_mode=mmap_mode)
+        header = nib.Nifti1Header(np.asarray(columns['header']).tobytes())
+        return cls(columns['data'], np.asarray(columns['mask']), np.asarray(columns['affine']), header)
+
+    def save(self, fname):
+        """Save the masked time series in an uncompressed, memory-mappable ``.npz`` file."""
+        # Time series are written by blocks of voxels to avoid a copy of the whole array
+        blocks = (self.data[start:start + 10000] for start in range(0, self.data.shape[0], 10000))
+        save_array_store(fname, {'data': (self.data.shape, self.data.dtype, blocks),
+                                      'mask': self.mask,
+                                      'affine': self.affine,
+                                      'header': np.frombuffer(self.header.binaryblock, dtype=np.uint8)})
+
+    def mean(self, roi):
+        """Return the average time series over the voxels of a 3D ROI mask.
+
+        Voxels of the ROI outside the mask count as null time series.
+        """
+        roi = np.asarray(roi, dtype=bool)
+        return self.data[roi[self.mask]].sum(axis=0) / np.count_nonzero(roi)
+
+    def to_nifti(self, fname):
+        """Save the time series as a 4D NIfTI volume, where voxels outside the mask are null."""
+        volume = np.zeros(self.mask.shape + (self.n_timepoints,), dtype=self.data.dtype)
+        volume[self.mask] = self.data
+        header = self.header.copy()
+        header.set_data_dtype(volume.dtype)
+        nib.save(nib.Nifti1Image(volume, self.affine, header), fname)
+
 
 class Discard_tp_InputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="Input 4D fMRI image")
@@ -43,12 +453,11 @@ class Discard_tp(BaseInterface):
 
     def _run_interface(self, runtime):
         dataimg = nib.load(self.inputs.in_file)
-        data = dataimg.get_data()
 
         n_discard = int(self.inputs.n_discard) - 1
 
-        new_data = data.copy()
-        new_data = new_data[:, :, :, n_discard:-1]
+        # Read only the kept frames, without an intermediate copy of the volume
+        new_data = dataimg.dataobj[:, :, :, n_discard:-1]
 
         hd = dataimg.get_header()
         hd.set_data_shape([hd.get_data_shape()[0], hd.get_data_shape()[1], hd.get_data_shape()[2],
@@ -64,7 +473,7 @@ class Discard_tp(BaseInterface):
 
 
 class Nuisance_InputSpec(BaseInterfaceInputSpec):
-    in_file = File(exists=True, desc="Input fMRI volume")
+    in_file = File(exists=True, desc="Input fMRI volume or masked time series (`.npz`)")
 
     brainfile = File(desc='Eroded brain mask registered to fMRI space')
 
@@ -90,6 +499,9 @@ class Nuisance_InputSpec(BaseInterfaceInputSpec):
     n_discard = Int(
         desc='Number of volumes discarded from the fMRI sequence during preprocessing')
 
+    chunk_size = Int(10000, usedefault=True,
+                     desc='Number of voxels regressed at once (Default: 10000)')
+
 
 class Nuisance_OutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Output fMRI Volume")
@@ -140,14 +552,29 @@ class Nuisance_regression(BaseInterface):
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
+        timeseries = MaskedTimeSeries.load(ref_path)
+        X = self._nuisance_regressors(timeseries)
+
+        # GLM: regress out nuisance covariates from all the voxels at once.
+        # Voxels with a null time series, outside the mask, have null residuals.
+        residuals = np.empty(timeseries.data.shape, dtype=np.float32)
+        timeseries.data = regress_out(timeseries.data, X, chunk_size=self.inputs.chunk_size, out=residuals)
+        timeseries.to_nifti(os.path.abspath('fMRI_nuisance.nii.gz'))
+
+        return runtime
+
+    def _nuisance_regressors(self, timeseries):
+        """Extract the nuisance signals of `timeseries` and return the design matrix of the GLM.
+
+        The average signals are also saved in ``.npy`` and ``.mat`` format.
+        """
+        tp = timeseries.n_timepoints
+
         # Extract whole brain average signal
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
         if self.inputs.global_nuisance:
             brainfile = self.inputs.brainfile  # load eroded whole brain mask
             brain = nib.load(brainfile).get_data().astype(np.uint32)
-            global_values = data[brain == 1].mean(axis=0)
+            global_values = timeseries.mean(brain == 1)
             global_values = global_values - np.mean(global_values)
             np.save(os.path.abspath('averageGlobal.npy'), global_values)
             sio.savemat(os.path.abspath('averageGlobal.mat'),
@@ -157,7 +584,7 @@ class Nuisance_regression(BaseInterface):
         if self.inputs.csf_nuisance:
             csffile = self.inputs.csf_file  # load eroded CSF mask
             csf = nib.load(csffile).get_data().astype(np.uint32)
-            csf_values = data[csf == 1].mean(axis=0)
+            csf_values = timeseries.mean(csf == 1)
             csf_values = csf_values - np.mean(csf_values)
             np.save(os.path.abspath('averageCSF.npy'), csf_values)
             sio.savemat(os.path.abspath('averageCSF.mat'),
@@ -167,7 +594,7 @@ class Nuisance_regression(BaseInterface):
         if self.inputs.wm_nuisance:
             WMfile = self.inputs.wm_file  # load eroded WM mask
             WM = nib.load(WMfile).get_data().astype(np.uint32)
-            wm_values = data[WM == 1].mean(axis=0)
+            wm_values = timeseries.mean(WM == 1)
             wm_values = wm_values - np.mean(wm_values)
             np.save(os.path.abspath('averageWM.npy'), wm_values)
             sio.savemat(os.path.abspath('averageWM.mat'), {'avgWM': wm_values})
@@ -201,12 +628,8 @@ class Nuisance_regression(BaseInterface):
                 move = np.hstack((move, move_der2))
                 move = np.hstack((move, move_der2_sq))
 
-        # GLM: regress out nuisance covariates
-        new_data = data.copy()
-
         # s = gconf.parcellation.keys()[0]
 
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         # if float(self.inputs.n_discard) > 0:
         #     n_discard = int(self.inputs.n_discard) - 1
         #     if self.inputs.motion_nuisance:
@@ -265,25 +688,10 @@ class Nuisance_regression(BaseInterface):
             X = move
             print('> Detrend motion average signals')
 
-        import statsmodels.api as sm
-        X = sm.add_constant(X)
+        X = np.column_stack((np.ones(tp), X))
         # print('Shape X GLM')
         # print(X.shape)
-
-        # loop throughout all GM voxels
-        for index, _ in np.ndenumerate(gm):
-            Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
-            gls_model = sm.GLS(Y, X)
-            gls_results = gls_model.fit()
-            # new_data[index[0],index[1],index[2],:] = gls_results.resid
-            new_data[index[0], index[1], index[2],
-                     :] = gls_results.resid  # + gls_results.params[8]
-
-        img = nib.Nifti1Image(
-            new_data, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath('fMRI_nuisance.nii.gz'))
-
-        return runtime
+        return X
 
     def _list_outputs(self):
         outputs = self._outputs().get()
@@ -301,16 +709,25 @@ class Nuisance_regression(BaseInterface):
 
 
 class Detrending_InputSpec(BaseInterfaceInputSpec):
-    in_file = File(exists=True, mandatory=True, desc="fMRI volume to detrend")
+    in_file = File(exists=True, mandatory=True, desc="fMRI volume or masked time series (`.npz`) to detrend")
 
     gm_file = InputMultiPath(
         File(exists=True), desc="ROI files registered to fMRI space")
 
     mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
 
+    spline_knot_spacing = Int(1000, usedefault=True,
+                              desc="Number of volumes between two knots of the cubic spline. Runs shorter "
+                                   "than this spacing have no interior knot, so that a single cubic "
+                                   "polynomial is removed over the whole run (Default: 1000)")
+
+    save_masked_timeseries = Bool(False, usedefault=True,
+                                  desc="If `True`, save the detrended fMRI as masked time series (`.npz`) "
+                                       "instead of a NIfTI volume")
+
 
 class Detrending_OutputSpec(TraitedSpec):
-    out_file = File(exists=True, desc="Detrended fMRI volume")
+    out_file = File(exists=True, desc="Detrended fMRI volume or masked time series (`.npz`)")
 
 
 class Detrending(BaseInterface):
@@ -335,80 +752,60 @@ class Detrending(BaseInterface):
     output_spec = Detrending_OutputSpec
 
     def _run_interface(self, runtime):
-        print("Linear detrending")
-        print("=================")
-
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
         # Load data
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
-
-        # GLM: regress out nuisance covariates
-        new_data_det = data.copy()
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
-
-        from scipy import signal
+        timeseries = MaskedTimeSeries.load(ref_path)
+        self._detrend(timeseries)
 
-        for index, value in np.ndenumerate(gm):
-            if value == 0:
-                continue
+        if self.inputs.save_masked_timeseries:
+            timeseries.save(os.path.abspath('fMRI_detrending.npz'))
+        else:
+            timeseries.to_nifti(os.path.abspath('fMRI_detrending.nii.gz'))
 
-            Ydet = signal.detrend(
-                data[index[0], index[1], index[2], :].reshape(tp, 1), axis=0)
-            new_data_det[index[0], index[1], index[2], :] = Ydet[:, 0]
-
-        img = nib.Nifti1Image(
-            new_data_det, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-
-        if self.inputs.mode == 'quadratic':
-            print("Quadratic detrending")
-            print("=================")
-            from obspy.signal.detrend import polynomial
+        print("[ DONE ]")
+        return runtime
 
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = polynomial(
-                    new_data_det2[index[0], index[1], index[2], :], order=2)
+    def _detrend(self, timeseries):
+        """Remove the trends from the time series of the GM voxels of `timeseries` in place."""
+        tp = timeseries.n_timepoints
 
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
+        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
+        voxels = gm[timeseries.mask] != 0
 
+        # Linear and quadratic trends are modeled by polynomials and
+        # cubic trends by a cubic spline
         if self.inputs.mode == 'cubic':
             print("Cubic-spline detrending")
             print("=================")
-            from obspy.signal.detrend import spline
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = spline(
-                    new_data_det2[index[0], index[1], index[2], :], order=3)
+            trends = spline_basis(tp, self.inputs.spline_knot_spacing)
+        elif self.inputs.mode == 'quadratic':
+            print("Quadratic detrending")
+            print("=================")
+            trends = polynomial_basis(tp, 2)
+        else:
+            print("Linear detrending")
+            print("=================")
+            trends = polynomial_basis(tp, 1)
 
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-
-        print("[ DONE ]")
-        return runtime
+        # Remove the trends from all the GM voxels at once
+        detrended = np.require(timeseries.data, requirements='W')
+        gm_data = detrended[voxels]
+        detrended[voxels] = regress_out(gm_data, trends, out=gm_data)
+        timeseries.data = detrended
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs["out_file"] = os.path.abspath("fMRI_detrending.nii.gz")
+        if self.inputs.save_masked_timeseries:
+            outputs["out_file"] = os.path.abspath("fMRI_detrending.npz")
+        else:
+            outputs["out_file"] = os.path.abspath("fMRI_detrending.nii.gz")
         return outputs
 
 
 class Scrubbing_InputSpec(BaseInterfaceInputSpec):
-    in_file = File(exists=True, mandatory=True, desc="fMRI volume to scrubb")
+    in_file = File(exists=True, mandatory=True, desc="fMRI volume or masked time series (`.npz`) to scrubb")
 
     wm_mask = File(exists=True, desc='WM mask registered to fMRI space')
 
@@ -418,6 +815,10 @@ class Scrubbing_InputSpec(BaseInterfaceInputSpec):
     motion_parameters = File(
         exists=True, desc='Motion parameters from preprocessing stage')
 
+    standardized_dvars = Bool(False, usedefault=True,
+                              desc="If `True`, also save the standardized and voxelwise standardized DVARS "
+                                   "(Default: False)")
+
 
 class Scrubbing_OutputSpec(TraitedSpec):
     fd_mat = File(exists=True, desc="FD matrix for scrubbing")
@@ -428,9 +829,17 @@ class Scrubbing_OutputSpec(TraitedSpec):
 
     dvars_npy = File(exists=True, desc="DVARS in .npy format")
 
+    dvars_std_mat = File(exists=True, desc="Standardized DVARS matrix")
+
+    dvars_vx_std_mat = File(exists=True, desc="Voxelwise standardized DVARS matrix")
+
+    dvars_std_npy = File(exists=True, desc="Standardized DVARS in .npy format")
+
+    dvars_vx_std_npy = File(exists=True, desc="Voxelwise standardized DVARS in .npy format")
+
 
 class Scrubbing(BaseInterface):
-    """Computes scrubbing parameters: `FD` and `DVARS`.
+    """Computes scrubbing parameters: `FD`, `DVARS` and optionally its standardized variants.
 
     Examples
     --------
@@ -460,44 +869,46 @@ class Scrubbing(BaseInterface):
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
         WMfile = self.inputs.wm_mask
         WM = nib.load(WMfile).get_data().astype(np.uint32)
         GM = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         mask = WM + GM
+        # Time series of the WM and GM voxels
+        if ref_path.endswith('.npz'):
+            timeseries = MaskedTimeSeries.load(ref_path)
+            data = timeseries.data[(mask > 0)[timeseries.mask]]
+        else:
+            data = MaskedTimeSeries.from_nifti(ref_path, mask=mask > 0).data
+        tp = data.shape[1]
+        n_voxels = np.count_nonzero(mask)
         move = np.genfromtxt(self.inputs.motion_parameters)
 
         # initialize motion measures
         FD = np.zeros((tp - 1, 1))
         DVARS = np.zeros((tp - 1, 1))
 
-        # loop throughout all the time points
-        FD[0] = 0
-        DVARS[0] = 0
-        for i in range(1, tp - 1):
-            # FD
-            move0 = move[i - 1, :]
-            move1 = move[i, :]
-            this_move = move1 - move0
-            this_move = np.absolute(this_move)
-            FD[i] = this_move.sum()
-
-            # DVARS
-            # extract current and following time points
-            temp0 = data[:, :, :, i - 1]
-            temp1 = data[:, :, :, i]
-            temp = temp1 - temp0
-            temp = np.power(temp, 2)
-            temp = temp[mask > 0]
-            DVARS[i] = np.power(temp.mean(), 0.5)
+        # Element i measures the change between time points i - 1 and i,
+        # for all the time points but the last one
+        FD[1:, 0] = np.absolute(np.diff(move[:tp - 1], axis=0)).sum(axis=1)
+        dvars, dvars_std, dvars_vx_std = compute_dvars(data, n_voxels=n_voxels,
+                                                       standardized=self.inputs.standardized_dvars)
+        DVARS[1:, 0] = dvars[:-1]
 
         np.save(os.path.abspath('FD.npy'), FD)
         np.save(os.path.abspath('DVARS.npy'), DVARS)
         sio.savemat(os.path.abspath('FD.mat'), {'FD': FD})
         sio.savemat(os.path.abspath('DVARS.mat'), {'DVARS': DVARS})
 
+        if self.inputs.standardized_dvars:
+            DVARS_std = np.zeros((tp - 1, 1))
+            DVARS_vx_std = np.zeros((tp - 1, 1))
+            DVARS_std[1:, 0] = dvars_std[:-1]
+            DVARS_vx_std[1:, 0] = dvars_vx_std[:-1]
+            np.save(os.path.abspath('DVARS_std.npy'), DVARS_std)
+            np.save(os.path.abspath('DVARS_vx_std.npy'), DVARS_vx_std)
+            sio.savemat(os.path.abspath('DVARS_std.mat'), {'DVARS_std': DVARS_std})
+            sio.savemat(os.path.abspath('DVARS_vx_std.mat'), {'DVARS_vx_std': DVARS_vx_std})
+
         print("[ DONE ]")
         return runtime
 
@@ -507,4 +918,137 @@ class Scrubbing(BaseInterface):
         outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
         outputs["fd_npy"] = os.path.abspath("FD.npy")
         outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+        if self.inputs.standardized_dvars:
+            outputs["dvars_std_mat"] = os.path.abspath("DVARS_std.mat")
+            outputs["dvars_vx_std_mat"] = os.path.abspath("DVARS_vx_std.mat")
+            outputs["dvars_std_npy"] = os.path.abspath("DVARS_std.npy")
+            outputs["dvars_vx_std_npy"] = os.path.abspath("DVARS_vx_std.npy")
+        return outputs
+
+
+class Cleaning_InputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="fMRI volume or masked time series (`.npz`) to clean")
+
+    gm_file = InputMultiPath(
+        File(exists=True), desc="ROI files registered to fMRI space")
+
+    detrending = Bool(True, usedefault=True, desc="If `True` perform detrending")
+
+    mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
+
+    spline_knot_spacing = Int(1000, usedefault=True,
+                              desc="Number of volumes between two knots of the cubic spline. Runs shorter "
+                                   "than this spacing have no interior knot, so that a single cubic "
+                                   "polynomial is removed over the whole run (Default: 1000)")
+
+    brainfile = File(desc='Eroded brain mask registered to fMRI space')
+
+    csf_file = File(desc='Eroded CSF mask registered to fMRI space')
+
+    wm_file = File(desc='Eroded WM mask registered to fMRI space')
+
+    motion_file = File(desc='motion nuisance effect')
+
+    global_nuisance = Bool(desc='If `True` perform global nuisance regression')
+
+    csf_nuisance = Bool(desc='If `True` perform CSF nuisance regression')
+
+    wm_nuisance = Bool(desc='If `True` perform WM nuisance regression')
+
+    motion_nuisance = Bool(desc='If `True` perform motion nuisance regression')
+
+    nuisance_motion_nb_reg = Int('36', desc="Number of reg to use in motion nuisance regression")
+
+    highpass = Float(0.0, usedefault=True,
+                     desc="Frequencies below this cutoff (in Hz) are removed (Default: 0.0)")
+
+    lowpass = Float(0.0, usedefault=True,
+                    desc="Frequencies above this cutoff (in Hz) are removed if positive (Default: 0.0)")
+
+    tr = Float(desc="Repetition time in seconds (Default: from the header of `in_file`)")
+
+    chunk_size = Int(10000, usedefault=True,
+                     desc='Number of voxels processed at once (Default: 10000)')
+
+
+class Cleaning_OutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Cleaned fMRI volume")
+
+    averageGlobal_npy = File(desc="Output of global regression in `.npy` format")
+
+    averageCSF_npy = File(desc="Output of CSF regression in `.npy` format")
+
+    averageWM_npy = File(desc="Output of WM regression in `.npy` format")
+
+    averageGlobal_mat = File(desc="Output matrix of global regression")
+
+    averageCSF_mat = File(desc="Output matrix of CSF regression")
+
+    averageWM_mat = File(desc="Output matrix of WM regression")
+
+
+class Cleaning(Detrending, Nuisance_regression):
+    """Apply detrending, nuisance regression and bandpass filtering on the Functional MRI signal in a single pass.
+
+    The steps of :class:`Detrending`, :class:`Nuisance_regression` and the bandpass
+    filtering are applied in turn to the masked time series held in memory, and
+    only the cleaned volume is saved. Bandpass filtering is performed with an
+    ideal filter in the frequency domain.
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import Cleaning
+    >>> cleaning = Cleaning()
+    >>> cleaning.inputs.base_dir = '/my_directory'
+    >>> cleaning.inputs.in_file = '/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz'
+    >>> cleaning.inputs.gm_file = ['/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale1_dseg.nii.gz']
+    >>> cleaning.inputs.mode = 'linear'
+    >>> cleaning.inputs.wm_file = '/path/to/sub-01_space-meanBOLD_label-WM_dseg.nii.gz'
+    >>> cleaning.inputs.csf_file = '/path/to/sub-01_space-meanBOLD_label-CSF_dseg.nii.gz'
+    >>> cleaning.inputs.motion_file = '/path/to/sub-01_motions.par'
+    >>> cleaning.inputs.csf_nuisance = True
+    >>> cleaning.inputs.wm_nuisance = True
+    >>> cleaning.inputs.motion_nuisance = True
+    >>> cleaning.inputs.highpass = 0.01
+    >>> cleaning.inputs.lowpass = 0.1
+    >>> cleaning.run() # doctest: +SKIP
+    """
+
+    input_spec = Cleaning_InputSpec
+    output_spec = Cleaning_OutputSpec
+
+    def _run_interface(self, runtime):
+        timeseries = MaskedTimeSeries.load(self.inputs.in_file)
+        timeseries.data = np.require(timeseries.data, requirements='W')
+
+        if self.inputs.detrending:
+            self._detrend(timeseries)
+
+        if self.inputs.global_nuisance or self.inputs.csf_nuisance or \
+                self.inputs.wm_nuisance or self.inputs.motion_nuisance:
+            print("Nuisance regression")
+            print("=================")
+            X = self._nuisance_regressors(timeseries)
+            regress_out(timeseries.data, X, chunk_size=self.inputs.chunk_size, out=timeseries.data)
+
+        if self.inputs.highpass > 0 or self.inputs.lowpass > 0:
+            print("Bandpass filtering")
+            print("=================")
+            if self.inputs.tr:
+                tr = self.inputs.tr
+            else:
+                tr = timeseries.header.get_zooms()[3]
+                if timeseries.header.get_xyzt_units()[1] == 'msec':
+                    tr = tr / 1000.0
+            bandpass_filter(timeseries.data, tr, self.inputs.highpass, self.inputs.lowpass,
+                            chunk_size=self.inputs.chunk_size, out=timeseries.data)
+
+        timeseries.to_nifti(os.path.abspath('fMRI_cleaned.nii.gz'))
+
+        print("[ DONE ]")
+        return runtime
+
+    def _list_outputs(self):
+        outputs = Nuisance_regression._list_outputs(self)
+        outputs["out_file"] = os.path.abspath("fMRI_cleaned.nii.gz")
         return outputs
@@ -6,21 +6,42 @@
 #  This software is distributed under the open-source license Modified BSD.
 """The Dipy module provides Nipype interfaces to the algorithms in dipy."""
 
+import os
 import os.path as op
 from future import standard_library
 import time
 import gzip
+import hashlib
+import json
+import multiprocessing
+import shutil
+import tempfile
 import nibabel as nib
 import numpy as np
 
 from nipype.interfaces.dipy.base import DipyDiffusionInterface, DipyBaseInterface, DipyBaseInterfaceInputSpec
-from nipype.interfaces.base import TraitedSpec, File, traits, isdefined, BaseInterfaceInputSpec, InputMultiPath
+from nipype.interfaces.base import TraitedSpec, File, Directory, traits, isdefined, BaseInterfaceInputSpec, \
+    InputMultiPath
 from nipype import logging
 
+from cmtklib.util import StreamingTractogramWriter
 
 standard_library.install_aliases()
 IFLOGGER = logging.getLogger('nipype.interface')
 
+MAPMRI_METRICS = ['rtop', 'rtap', 'rtpp', 'msd', 'qiv', 'ng', 'ng_perp', 'ng_para']
+
+# Spherical harmonics basis expected by the Dipy direction getters
+DIPY_SH_BASIS = 'descoteaux07'
+
+
+def _sh_coeff_sidecar(sh_coeff_file):
+    """Return the JSON sidecar recording the basis and order of a spherical harmonics coefficients image."""
+    for ext in ['.nii.gz', '.nii']:
+        if sh_coeff_file.endswith(ext):
+            return sh_coeff_file[:-len(ext)] + '.json'
+    return op.splitext(sh_coeff_file)[0] + '.json'
+
 
 class DTIEstimateResponseSHInputSpec(DipyBaseInterfaceInputSpec):
     in_mask = File(
@@ -316,6 +337,9 @@ class CSD(DipyDiffusionInterface):
             # IFLOGGER.info(fods.shape)
             IFLOGGER.info('Save Spherical Harmonics image')
             nib.Nifti1Image(csd_peaks.shm_coeff, img.affine, None).to_filename(self._gen_filename('shm_coeff'))
+            # Basis and order are recorded so that the coefficients are only reused if they match
+            with open(_sh_coeff_sidecar(self._gen_filename('shm_coeff')), 'w') as f:
+                json.dump({'sh_basis_type': sh_basis_type, 'sh_order': self.inputs.sh_order}, f)
 
             # FIXME: dipy 1.1.0 and fury 0.5.1 with vtk 8.2.0 -> error:
             #
@@ -343,6 +367,125 @@ class CSD(DipyDiffusionInterface):
         return outputs
 
 
+def _iter_voxel_chunks(worker, voxel_data, params, n_procs=1, chunk_size=10000, name='voxel chunks'):
+    """Apply a worker function to consecutive chunks of voxels, in a pool of processes if `n_procs` > 1.
+
+    In parallel, the voxel data are saved in a temporary directory from which
+    each process memory-maps the voxels of its chunk.
+
+    Parameters
+    ----------
+    worker : function
+        Module-level function called with a tuple ``(voxel_data, start, stop, params)``,
+        where `voxel_data` is either the array or the file of the voxel data,
+        and returning the results of the voxels ``start:stop``
+
+    voxel_data : numpy.ndarray
+        Array of shape (n_voxels, n_volumes) of the data of the voxels
+
+    params : dict
+        Parameters passed to the worker
+
+    n_procs : int
+        Number of processes (Default: 1)
+
+    chunk_size : int
+        Number of voxels per chunk (Default: 10000)
+
+    name : string
+        Description of the processing used in log messages (Default: 'voxel chunks')
+
+    Yields
+    ------
+    start, stop : int
+        Range of the voxels of the chunk
+
+    results
+        Results of the worker for the chunk
+    """
+    n_voxels = voxel_data.shape[0]
+    bounds = list(range(0, n_voxels, chunk_size)) + [n_voxels]
+    if n_procs > 1 and multiprocessing.current_process().daemon:
+        IFLOGGER.warn('A daemonic process cannot create a pool of processes: %s are processed serially' % name)
+        n_procs = 1
+    shared_dir = None
+    pool = None
+    try:
+        if n_procs > 1:
+            shared_dir = tempfile.mkdtemp(prefix='voxel_chunks_shared_', dir=os.getcwd())
+            source = op.join(shared_dir, 'voxel_data.npy')
+            np.save(source, voxel_data)
+            pool = multiprocessing.Pool(processes=n_procs)
+            imap = pool.imap
+        else:
+            source = voxel_data
+            imap = map
+        start_time = time.time()
+        chunks = [(source, start, stop, params) for start, stop in zip(bounds[:-1], bounds[1:])]
+        for (_, start, stop, _), (results, run_time) in zip(chunks, imap(worker, chunks)):
+            IFLOGGER.info('%s: voxels %i to %i of %i processed in %.1f s (elapsed: %.1f s)' % (
+                name, start, stop, n_voxels, run_time, time.time() - start_time))
+            yield start, stop, results
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if shared_dir is not None:
+            shutil.rmtree(shared_dir)
+
+
+def _read_voxel_data(img, voxels, dtype=np.float32):
+    """Read the data of some voxels of a 4D image one volume at a time.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        4D image, loaded with ``keep_file_open=True`` to read compressed files efficiently
+
+    voxels : tuple of numpy.ndarray
+        Indices of the voxels as returned by ``numpy.nonzero``
+
+    dtype : numpy.dtype
+        Data type of the voxel data (Default: numpy.float32)
+
+    Returns
+    -------
+    voxel_data : numpy.ndarray
+        Array of shape (n_voxels, n_volumes) of the data of the voxels
+    """
+    # The 4D volume is never held in memory
+    voxel_data = np.empty((voxels[0].shape[0], img.shape[3]), dtype=dtype)
+    for i in range(img.shape[3]):
+        voxel_data[:, i] = np.asanyarray(img.dataobj[..., i])[voxels]
+    return voxel_data
+
+
+def _fit_shore_chunk(args):
+    """Worker of :class:`SHORE` fitting the model on a chunk of voxels and computing its maps."""
+    from dipy.data import get_sphere
+    from dipy.reconst.odf import gfa
+    from dipy.reconst.csdeconv import odf_sh_to_sharp
+    from dipy.reconst.shm import sf_to_sh
+
+    source, start, stop, params = args
+    start_time = time.time()
+    data = (np.load(source, mmap_mode='r') if isinstance(source, str) else source)[start:stop]
+    sphere = get_sphere('symmetric724')
+
+    shorefit = params['model'].fit(np.asarray(data, dtype=np.float32))
+    odf = shorefit.odf(sphere)
+    odf_sh = sf_to_sh(odf, sphere, sh_order=params['sh_order'], basis_type=params['basis'])
+    results = {'GFA': np.nan_to_num(gfa(odf)),
+               'MSD': np.nan_to_num(shorefit.msd()),
+               'RTOP': np.nan_to_num(shorefit.rtop_signal()),
+               'dodf': odf_sh,
+               'fodf': odf_sh_to_sharp(odf_sh, sphere, basis=params['basis'], ratio=0.2,
+                                       sh_order=params['sh_order'], lambda_=1.0, tau=0.1, r2_term=True)}
+    return results, time.time() - start_time
+
+
 class SHOREInputSpec(DipyBaseInterfaceInputSpec):
     in_mask = File(exists=True, desc=(
         'input mask in which compute SHORE solution'))
@@ -362,6 +505,10 @@ class SHOREInputSpec(DipyBaseInterfaceInputSpec):
         'Constrain the optimization such that E(0) = 1.'))
     positive_constraint = traits.Bool(False, usedefault=True, desc=(
         'Constrain the optimization such that E(0) = 1.'))
+    n_procs = traits.Int(1, usedefault=True,
+                         desc='Number of processes fitting chunks of voxels in parallel (Default: 1)')
+    chunk_size = traits.Int(10000, usedefault=True,
+                            desc='Number of voxels fitted per chunk (Default: 10000)')
 
 
 class SHOREOutputSpec(TraitedSpec):
@@ -404,17 +551,11 @@ class SHORE(DipyDiffusionInterface):
 
         import pickle as pickle
 
-        from dipy.data import get_sphere
         from dipy.io import read_bvals_bvecs
         from dipy.core.gradients import gradient_table
         from dipy.reconst.shore import ShoreModel
-        from dipy.reconst.odf import gfa
-        from dipy.reconst.csdeconv import odf_sh_to_sharp
-        from dipy.reconst.shm import sf_to_sh
-        from dipy.core.ndindex import ndindex
 
-        img = nib.load(self.inputs.in_file)
-        imref = nib.four_to_three(img)[0]
+        img = nib.load(self.inputs.in_file, keep_file_open=True)
         affine = img.affine
 
         def clipMask(mask):
@@ -431,10 +572,11 @@ class SHORE(DipyDiffusionInterface):
             msk = clipMask(
                 nib.load(self.inputs.in_mask).get_data().astype('float32'))
         else:
-            msk = clipMask(np.ones(imref.shape).astype('float32'))
+            msk = clipMask(np.ones(img.shape[:3]).astype('float32'))
 
-        data = img.get_data().astype(np.float32)
-        data[msk == 0] *= 0
+        # Only the voxels of the mask are fitted
+        voxels = np.nonzero(msk)
+        voxel_data = _read_voxel_data(img, voxels)
 
         # hdr = imref.header.copy()
 
@@ -443,7 +585,6 @@ class SHORE(DipyDiffusionInterface):
         bvecs = np.array([-bvecs[:, 0], bvecs[:, 1], bvecs[:, 2]]).transpose()
         gtab = gradient_table(bvals, bvecs)
 
-        sphere = get_sphere('symmetric724')
         shore_model = ShoreModel(gtab, radial_order=self.inputs.radial_order, zeta=self.inputs.zeta,
                                  lambdaN=self.inputs.lambda_n, lambdaL=self.inputs.lambda_l)
 
@@ -452,13 +593,12 @@ class SHORE(DipyDiffusionInterface):
         f.close()
 
         lmax = self.inputs.radial_order
-        datashape = data.shape
-        dimsODF = list(datashape)
-        dimsODF[3] = int((lmax + 1) * (lmax + 2) / 2)
-        shODF = np.zeros(dimsODF)
-        GFA = np.zeros(dimsODF[:3])
-        RTOP = np.zeros(dimsODF[:3])
-        MSD = np.zeros(dimsODF[:3])
+        n_coeffs = int((lmax + 1) * (lmax + 2) / 2)
+        maps = {'GFA': np.zeros(msk.shape, dtype=np.float32),
+                'MSD': np.zeros(msk.shape, dtype=np.float32),
+                'RTOP': np.zeros(msk.shape, dtype=np.float32),
+                'dodf': np.zeros(msk.shape + (n_coeffs,), dtype=np.float32),
+                'fodf': np.zeros(msk.shape + (n_coeffs,), dtype=np.float32)}
 
         # Dipy >= 0.16 - basis : {None, ‘tournier07’, ‘descoteaux07’}
         if self.inputs.tracking_processing_tool == "mrtrix":
@@ -466,38 +606,27 @@ class SHORE(DipyDiffusionInterface):
         else:
             basis = 'descoteaux07'
 
-        # calculate odf per slice
-        IFLOGGER.info('Fitting SHORE model')
-        for i in ndindex(data.shape[:1]):
-            print("Processing slice #%i " % i)
-            start_time = time.time()
-            shorefit = shore_model.fit(data[i])
-            sliceODF = shorefit.odf(sphere)
-            sliceGMSD = shorefit.msd()
-            sliceRTOP = shorefit.rtop_signal()
-            sliceGFA = gfa(sliceODF)
-            shODF[i] = sf_to_sh(
-                sliceODF, sphere, sh_order=lmax, basis_type=basis)
-            GFA[i] = np.nan_to_num(sliceGFA)
-            MSD[i] = np.nan_to_num(sliceGMSD)
-            RTOP[i] = np.nan_to_num(sliceRTOP)
-            print("Computation Time (slice %s): " %
-                  str(i) + str(time.time() - start_time) + " seconds")
-
-        shFODF = odf_sh_to_sharp(shODF, sphere, basis=basis, ratio=0.2, sh_order=lmax, lambda_=1.0, tau=0.1,
-                                 r2_term=True)
+        IFLOGGER.info('Fitting SHORE model on %i voxels' % voxel_data.shape[0])
+        params = {'model': shore_model, 'sh_order': lmax, 'basis': basis}
+        for start, stop, results in _iter_voxel_chunks(_fit_shore_chunk, voxel_data, params,
+                                                       n_procs=self.inputs.n_procs,
+                                                       chunk_size=self.inputs.chunk_size,
+                                                       name='SHORE fit'):
+            chunk_voxels = tuple(v[start:stop] for v in voxels)
+            for name, values in results.items():
+                maps[name][chunk_voxels] = values
 
         IFLOGGER.info('Save Spherical Harmonics / MSD / GFA images')
 
-        nib.Nifti1Image(GFA, affine).to_filename(
+        nib.Nifti1Image(maps['GFA'], affine).to_filename(
             op.abspath('shore_gfa.nii.gz'))
-        nib.Nifti1Image(MSD, affine).to_filename(
+        nib.Nifti1Image(maps['MSD'], affine).to_filename(
             op.abspath('shore_msd.nii.gz'))
-        nib.Nifti1Image(RTOP, affine).to_filename(
+        nib.Nifti1Image(maps['RTOP'], affine).to_filename(
             op.abspath('shore_rtop_signal.nii.gz'))
-        nib.Nifti1Image(shODF, affine).to_filename(
+        nib.Nifti1Image(maps['dodf'], affine).to_filename(
             op.abspath('shore_dodf.nii.gz'))
-        nib.Nifti1Image(shFODF, affine).to_filename(
+        nib.Nifti1Image(maps['fodf'], affine).to_filename(
             op.abspath('shore_fodf.nii.gz'))
 
         return runtime
@@ -566,8 +695,6 @@ class TensorInformedEudXTractography(DipyBaseInterface):
         from dipy.tracking.stopping_criterion import ThresholdStoppingCriterion
         from dipy.tracking.local_tracking import LocalTracking
         from dipy.data import get_sphere
-        from dipy.io.stateful_tractogram import Space, StatefulTractogram
-        from dipy.io.streamline import save_trk
         # import marshal as pickle
         import pickle as pickle
 
@@ -679,8 +806,8 @@ class TensorInformedEudXTractography(DipyBaseInterface):
                                     max_cross=1)
 
         IFLOGGER.info('Saving tracks')
-        sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-        save_trk(sft, self._gen_filename('tracked', ext='.trk'))
+        with StreamingTractogramWriter(self._gen_filename('tracked', ext='.trk'), imref) as writer:
+            writer.write(streamlines)
 
         return runtime
 
@@ -709,6 +836,66 @@ class TensorInformedEudXTractography(DipyBaseInterface):
         return out_prefix + '_' + name + ext
 
 
+def _track_seed_shard(args):
+    """Worker process of :class:`DirectionGetterTractography` tracking the streamlines of one shard of seeds."""
+    from dipy.data import get_sphere
+    from dipy.direction import DeterministicMaximumDirectionGetter, ProbabilisticDirectionGetter
+    from dipy.tracking.stopping_criterion import BinaryStoppingCriterion, CmcStoppingCriterion
+    from dipy.tracking.local_tracking import LocalTracking, ParticleFilteringTracking
+
+    shared_files, shared_dir, shard, start, stop, batch_size, params = args
+    # Copy-on-write memory maps are shared between processes and writable as required by Dipy
+    shared = dict((name, np.load(fname, mmap_mode='c')) for name, fname in shared_files.items())
+
+    sphere = get_sphere('symmetric724')
+    if params['algo'] == 'deterministic':
+        dg = DeterministicMaximumDirectionGetter.from_shcoeff(shared['sh'], max_angle=params['max_angle'],
+                                                              sphere=sphere)
+    else:
+        dg = ProbabilisticDirectionGetter.from_shcoeff(shared['sh'], max_angle=params['max_angle'],
+                                                       sphere=sphere)
+
+    seeds = shared['seeds'][start:stop]
+    if params['use_act']:
+        criterion = CmcStoppingCriterion.from_pve(shared['pve_wm'], shared['pve_gm'], shared['pve_csf'],
+                                                  step_size=params['step_size'],
+                                                  average_voxel_size=params['voxel_size'])
+        tracking = ParticleFilteringTracking(dg, criterion, seeds, params['affine'],
+                                             max_cross=1,
+                                             step_size=params['step_size'],
+                                             maxlen=200,
+                                             pft_back_tracking_dist=2,
+                                             pft_front_tracking_dist=1,
+                                             particle_count=15,
+                                             return_all=False,
+                                             random_seed=params['random_seed'])
+    else:
+        criterion = BinaryStoppingCriterion(shared['tracking_mask'])
+        tracking = LocalTracking(dg, criterion, seeds, params['affine'],
+                                 step_size=params['step_size'],
+                                 max_cross=1,
+                                 random_seed=params['random_seed'])
+
+    # Points and lengths of the streamlines are appended to raw files by batches
+    points_fname = op.join(shared_dir, 'shard%05d_points.dat' % shard)
+    lengths_fname = op.join(shared_dir, 'shard%05d_lengths.dat' % shard)
+    with open(points_fname, 'wb') as points_file, open(lengths_fname, 'wb') as lengths_file:
+
+        def append_batch(batch):
+            np.concatenate(batch).tofile(points_file)
+            np.array([len(points) for points in batch], dtype=np.int64).tofile(lengths_file)
+
+        batch = []
+        for streamline in tracking:
+            batch.append(np.asarray(streamline, dtype=np.float32))
+            if len(batch) == batch_size:
+                append_batch(batch)
+                batch = []
+        if batch:
+            append_batch(batch)
+    return points_fname, lengths_fname
+
+
 class DirectionGetterTractographyInputSpec(BaseInterfaceInputSpec):
     algo = traits.Enum(["deterministic", "probabilistic"],
                        usedefault=True,
@@ -762,6 +949,21 @@ class DirectionGetterTractographyInputSpec(BaseInterfaceInputSpec):
     num_seeds = traits.Int(10000,
                            mandatory=True, usedefault=True,
                            desc='desired number of tracks in tractography')
+    n_procs = traits.Int(1, usedefault=True,
+                         desc='Number of processes tracking shards of the seeds in parallel. '
+                              'The direction getter and stopping criterion data are shared with '
+                              'the processes through memory-mapped arrays (Default: 1)')
+    sh_coeff_file = File(exists=True,
+                         desc='Spherical harmonics coefficients of the fODFs precomputed by the CSD '
+                              'interface (`out_shm_coeff`). If provided and if its JSON sidecar records the '
+                              'descoteaux07 basis of order `recon_order`, the CSD model is not fitted again')
+    sh_cache_dir = Directory(exists=True,
+                             desc='Directory in which the spherical harmonics coefficients computed from '
+                                  'the CSD model are cached under a hash of the content of the DWI data, '
+                                  'the tracking mask, the model, and the spherical harmonics basis and order')
+    random_seed = traits.Int(desc='Seed of the random number generator, which is reset for each seed point '
+                                  'from its position so that the streamlines do not depend on the number '
+                                  'of processes. If undefined, 0 is used when `n_procs` > 1')
     out_prefix = traits.Str(desc='output prefix for file names')
 
 
@@ -796,13 +998,7 @@ class DirectionGetterTractography(DipyBaseInterface):
         # from dipy.tracking.local import ThresholdStoppingCriterion, ActStoppingCriterion
         from dipy.tracking.stopping_criterion import BinaryStoppingCriterion, CmcStoppingCriterion
         from dipy.tracking.local_tracking import LocalTracking, ParticleFilteringTracking
-        from dipy.direction.peaks import peaks_from_model
         from dipy.data import get_sphere
-        from dipy.tracking.streamline import Streamlines
-        from dipy.io.stateful_tractogram import Space, StatefulTractogram
-        from dipy.io.streamline import save_trk
-        import pickle
-        import gzip
 
         if not (isdefined(self.inputs.in_model)):
             raise RuntimeError('in_model should be supplied')
@@ -850,14 +1046,6 @@ class DirectionGetterTractography(DipyBaseInterface):
             voxel_size = np.average(img_pve_wm.header['pixdim'][1:4])
             step_size = self.inputs.step_size
 
-            IFLOGGER.info('Building CMC Tissue Classifier')
-
-            cmc_classifier = CmcStoppingCriterion.from_pve(img_pve_wm.get_data(),
-                                                           img_pve_gm.get_data(),
-                                                           img_pve_csf.get_data(),
-                                                           step_size=step_size,
-                                                           average_voxel_size=voxel_size)
-
             if self.inputs.recon_model == 'CSD':
                 IFLOGGER.info('Creating mask used by CSD model from partial volume maps of GM and WM')
 
@@ -906,10 +1094,6 @@ class DirectionGetterTractography(DipyBaseInterface):
             nib.Nifti1Image(fa.astype(np.float32), affine, hdr).to_filename(
                 self._gen_filename('fa_masked'))
 
-            IFLOGGER.info('Building Binary Tissue Classifier')
-            # classifier = ThresholdStoppingCriterion(fa,self.inputs.fa_thresh)
-            classifier = BinaryStoppingCriterion(tmsk)
-
         seeds = self.inputs.num_seeds
 
         if isdefined(self.inputs.seed_mask[0]) or (self.inputs.seed_from_gmwmi and isdefined(self.inputs.gmwmi_file)):
@@ -963,37 +1147,27 @@ class DirectionGetterTractography(DipyBaseInterface):
                                            )
 
         if self.inputs.recon_model == 'CSD':
-            IFLOGGER.info('Loading CSD model')
-            f = gzip.open(self.inputs.in_model, 'rb')
-            csd_model = pickle.load(f)
-            f.close()
-
-            IFLOGGER.info('Generating peaks from CSD model')
-            pfm = peaks_from_model(model=csd_model,
-                                   data=data,
-                                   sphere=sphere,
-                                   relative_peak_threshold=.2,
-                                   min_separation_angle=self.inputs.max_angle,
-                                   mask=tmsk,
-                                   return_sh=True,
-                                   # sh_basis_type=args.basis,
-                                   sh_order=self.inputs.recon_order,
-                                   normalize_peaks=False,  # changed
-                                   parallel=True)
+            sh = None
+            if isdefined(self.inputs.sh_coeff_file):
+                sh = self._load_precomputed_sh_coeff(tmsk)
 
-            if self.inputs.algo == 'deterministic':
-                dg = DeterministicMaximumDirectionGetter.from_shcoeff(pfm.shm_coeff,
-                                                                      max_angle=self.inputs.max_angle,
-                                                                      sphere=sphere)
-            else:
-                dg = ProbabilisticDirectionGetter.from_shcoeff(pfm.shm_coeff,
-                                                               max_angle=self.inputs.max_angle,
-                                                               sphere=sphere)
+            if sh is None:
+                sh = self._compute_csd_sh_coeff(data, tmsk, sphere)
         else:
             IFLOGGER.info('Loading SHORE FOD')
             sh = nib.load(self.inputs.fod_file).get_data()
             sh = np.nan_to_num(sh)
             IFLOGGER.info('Generating peaks from SHORE model')
+
+        random_seed = self.inputs.random_seed if isdefined(self.inputs.random_seed) else None
+
+        n_procs = self.inputs.n_procs
+        if n_procs > 1 and multiprocessing.current_process().daemon:
+            IFLOGGER.warn('A daemonic process cannot create a pool of processes: tracking is performed serially')
+            n_procs = 1
+
+        # The direction getter and the stopping criterion are built by each process in parallel
+        if n_procs == 1:
             if self.inputs.algo == 'deterministic':
                 dg = DeterministicMaximumDirectionGetter.from_shcoeff(sh,
                                                                       max_angle=self.inputs.max_angle,
@@ -1003,7 +1177,24 @@ class DirectionGetterTractography(DipyBaseInterface):
                                                                max_angle=self.inputs.max_angle,
                                                                sphere=sphere)
 
-        if not self.inputs.use_act:
+        if n_procs > 1:
+            IFLOGGER.info('Performing %s tractography with %i processes' % (
+                'PFT' if self.inputs.use_act else self.inputs.algo, n_procs))
+            if self.inputs.use_act:
+                criterion_arrays = {'pve_wm': img_pve_wm.get_data(),
+                                    'pve_gm': img_pve_gm.get_data(),
+                                    'pve_csf': img_pve_csf.get_data()}
+            else:
+                criterion_arrays = {'tracking_mask': tmsk}
+            IFLOGGER.info('Saving tracks')
+            with StreamingTractogramWriter(self._gen_filename('tracked', ext='.trk'), imref) as writer:
+                self._track_seed_shards(tseeds, affine, sh, criterion_arrays,
+                                        random_seed if random_seed is not None else 0, writer)
+        elif not self.inputs.use_act:
+            IFLOGGER.info('Building Binary Tissue Classifier')
+            # classifier = ThresholdStoppingCriterion(fa,self.inputs.fa_thresh)
+            classifier = BinaryStoppingCriterion(tmsk)
+
             IFLOGGER.info('Performing %s tractography' % self.inputs.algo)
 
             streamlines = LocalTracking(dg,
@@ -1011,12 +1202,21 @@ class DirectionGetterTractography(DipyBaseInterface):
                                         tseeds,
                                         affine,
                                         step_size=self.inputs.step_size,
-                                        max_cross=1)
+                                        max_cross=1,
+                                        random_seed=random_seed)
 
             IFLOGGER.info('Saving tracks')
-            sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-            save_trk(sft, self._gen_filename('tracked', ext='.trk'))
+            # Streamlines are written by batches as they are generated
+            with StreamingTractogramWriter(self._gen_filename('tracked', ext='.trk'), imref) as writer:
+                writer.write(streamlines)
         else:
+            IFLOGGER.info('Building CMC Tissue Classifier')
+            cmc_classifier = CmcStoppingCriterion.from_pve(img_pve_wm.get_data(),
+                                                           img_pve_gm.get_data(),
+                                                           img_pve_csf.get_data(),
+                                                           step_size=step_size,
+                                                           average_voxel_size=voxel_size)
+
             IFLOGGER.info('Performing PFT tractography')
             # Particle Filtering Tractography
             pft_streamline_generator = ParticleFilteringTracking(dg,
@@ -1029,12 +1229,12 @@ class DirectionGetterTractography(DipyBaseInterface):
                                                                  pft_back_tracking_dist=2,
                                                                  pft_front_tracking_dist=1,
                                                                  particle_count=15,
-                                                                 return_all=False)
+                                                                 return_all=False,
+                                                                 random_seed=random_seed)
             IFLOGGER.info('Saving tracks')
-            # streamlines = list(pft_streamline_generator)
-            streamlines = Streamlines(pft_streamline_generator)
-            sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-            save_trk(sft, self._gen_filename('tracked', ext='.trk'))
+            # Streamlines are written by batches as they are generated
+            with StreamingTractogramWriter(self._gen_filename('tracked', ext='.trk'), imref) as writer:
+                writer.write(pft_streamline_generator)
 
             # from nibabel.streamlines import Field, Tractogram
             # from nibabel.orientations import aff2axcodes
@@ -1052,6 +1252,186 @@ class DirectionGetterTractography(DipyBaseInterface):
 
         return runtime
 
+    def _load_precomputed_sh_coeff(self, mask):
+        """Load the spherical harmonics coefficients of `sh_coeff_file` if they can be reused.
+
+        The coefficients are reused only if their JSON sidecar written by the
+        :class:`CSD` interface records the basis of the Dipy direction getters
+        and the order `recon_order`, and if their shape matches the mask.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray
+            Tracking mask
+
+        Returns
+        -------
+        sh : numpy.ndarray
+            Spherical harmonics coefficients masked by the tracking mask,
+            or None if they cannot be reused
+        """
+        sidecar = _sh_coeff_sidecar(self.inputs.sh_coeff_file)
+        sh_info = None
+        if op.exists(sidecar):
+            with open(sidecar) as f:
+                sh_info = json.load(f)
+        if sh_info != {'sh_basis_type': DIPY_SH_BASIS, 'sh_order': self.inputs.recon_order}:
+            IFLOGGER.warn('Basis and order of the spherical harmonics coefficients (%s) do not match the %s basis '
+                          'of order %i. Fitting the CSD model again.' % (sh_info, DIPY_SH_BASIS,
+                                                                         self.inputs.recon_order))
+            return None
+
+        IFLOGGER.info('Loading precomputed spherical harmonics coefficients of the CSD model')
+        sh = nib.load(self.inputs.sh_coeff_file).get_data()
+        n_coeffs = (self.inputs.recon_order + 1) * (self.inputs.recon_order + 2) // 2
+        if sh.shape != mask.shape + (n_coeffs,):
+            IFLOGGER.warn('Shape %s of the spherical harmonics coefficients does not match the tracking '
+                          'mask and order %i. Fitting the CSD model again.' % (sh.shape, self.inputs.recon_order))
+            return None
+        # Coefficients are zero outside the tracking mask, as if computed by peaks_from_model
+        return sh * (mask > 0)[..., np.newaxis]
+
+    def _compute_csd_sh_coeff(self, data, mask, sphere):
+        """Compute the spherical harmonics coefficients of the fODFs of the CSD model.
+
+        If a cache directory is provided, the coefficients are stored in it
+        under a hash of the content of the DWI data, of the mask, of the
+        pickled CSD model and of the spherical harmonics basis and order, so that
+        repeated tracking runs load them instead of fitting the model again.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            DWI data
+
+        mask : numpy.ndarray
+            Mask of the voxels in which the model is fitted
+
+        sphere : dipy.core.sphere.Sphere
+            Sphere on which the fODFs are evaluated
+
+        Returns
+        -------
+        sh : numpy.ndarray
+            Spherical harmonics coefficients of the fODFs
+        """
+        from dipy.direction.peaks import peaks_from_model
+        import pickle
+
+        IFLOGGER.info('Loading CSD model')
+        with gzip.open(self.inputs.in_model, 'rb') as f:
+            model_bytes = f.read()
+
+        cache_file = None
+        if isdefined(self.inputs.sh_cache_dir):
+            digest = hashlib.sha1()
+            for array in [data, mask > 0]:
+                digest.update(('%s %s' % (array.dtype, array.shape)).encode())
+                digest.update(np.ascontiguousarray(array).data)
+            digest.update(model_bytes)
+            digest.update(('sh_order %i sh_basis_type %s' % (self.inputs.recon_order, DIPY_SH_BASIS)).encode())
+            cache_file = op.join(self.inputs.sh_cache_dir, 'csd_shm_coeff_%s.npy' % digest.hexdigest())
+            if op.exists(cache_file):
+                IFLOGGER.info('Loading cached spherical harmonics coefficients %s' % cache_file)
+                return np.load(cache_file)
+
+        csd_model = pickle.loads(model_bytes)
+
+        IFLOGGER.info('Generating peaks from CSD model')
+        pfm = peaks_from_model(model=csd_model,
+                               data=data,
+                               sphere=sphere,
+                               relative_peak_threshold=.2,
+                               min_separation_angle=self.inputs.max_angle,
+                               mask=mask,
+                               return_sh=True,
+                               sh_basis_type=DIPY_SH_BASIS,
+                               sh_order=self.inputs.recon_order,
+                               normalize_peaks=False,  # changed
+                               parallel=True)
+
+        if cache_file is not None:
+            IFLOGGER.info('Caching spherical harmonics coefficients in %s' % cache_file)
+            # Write to a temporary file first so that concurrent runs never load a partial cache file
+            fd, tmp_file = tempfile.mkstemp(suffix='.npy', dir=self.inputs.sh_cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, pfm.shm_coeff)
+            os.replace(tmp_file, cache_file)
+
+        return pfm.shm_coeff
+
+    def _track_seed_shards(self, seeds, affine, sh, criterion_arrays, random_seed, writer, shard_size=10000):
+        """Track the streamlines of shards of the seeds in a pool of processes.
+
+        The seeds, the spherical harmonics coefficients of the direction getter and
+        the arrays of the stopping criterion are saved in a temporary directory,
+        from which each process memory-maps them. Each process tracks the seeds
+        of a shard and saves its streamlines, which are appended to the tractogram
+        in the order of the seeds as soon as the previous shards are written.
+
+        Parameters
+        ----------
+        seeds : numpy.ndarray
+            Seed points of shape (n_seeds, 3) in world coordinates
+
+        affine : numpy.ndarray
+            Affine of the diffusion volume
+
+        sh : numpy.ndarray
+            Spherical harmonics coefficients of the direction getter
+
+        criterion_arrays : dict
+            Arrays of the stopping criterion, either 'tracking_mask' for the binary
+            stopping criterion or 'pve_wm', 'pve_gm' and 'pve_csf' for the CMC one
+
+        random_seed : int
+            Seed of the random number generator
+
+        writer : cmtklib.util.StreamingTractogramWriter
+            Writer of the output tractogram. Each process saves its streamlines
+            by batches of ``writer.batch_size`` streamlines
+
+        shard_size : int
+            Number of seeds of each shard (Default: 10000)
+        """
+        shared_dir = tempfile.mkdtemp(prefix='tracking_shared_', dir=os.getcwd())
+        shared_files = {}
+        for name, array in dict(criterion_arrays, seeds=seeds, sh=sh).items():
+            shared_files[name] = op.join(shared_dir, name + '.npy')
+            np.save(shared_files[name], np.ascontiguousarray(array, dtype=np.float64))
+
+        params = {'algo': self.inputs.algo,
+                  'max_angle': self.inputs.max_angle,
+                  'step_size': self.inputs.step_size,
+                  'use_act': self.inputs.use_act,
+                  'voxel_size': np.average(nib.load(self.inputs.in_partial_volume_files[2]).header['pixdim'][1:4])
+                  if self.inputs.use_act else None,
+                  'affine': affine,
+                  'random_seed': random_seed}
+
+        # Shards of a fixed number of seeds balance the load between seeds of various
+        # tracking times, and bound the size of the streamlines saved by each process
+        shards = [(shared_files, shared_dir, shard, start, min(start + shard_size, len(seeds)),
+                   writer.batch_size, params)
+                  for shard, start in enumerate(range(0, len(seeds), shard_size))]
+
+        pool = multiprocessing.Pool(processes=self.inputs.n_procs)
+        try:
+            for points_fname, lengths_fname in pool.imap(_track_seed_shard, shards):
+                lengths = np.fromfile(lengths_fname, dtype=np.int64)
+                if lengths.size:
+                    points = np.memmap(points_fname, dtype=np.float32, mode='r').reshape(-1, 3)
+                    offsets = np.concatenate(([0], np.cumsum(lengths)))
+                    writer.write(np.array(points[offsets[i]:offsets[i + 1]]) for i in range(lengths.size))
+                    del points
+                os.remove(points_fname)
+                os.remove(lengths_fname)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(shared_dir)
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['streamlines'] = self._gen_filename('streamlines', ext='.npy')
@@ -1080,7 +1460,21 @@ class DirectionGetterTractography(DipyBaseInterface):
         return out_prefix + '_' + name + ext
 
 
+def _fit_mapmri_chunk(args):
+    """Worker of :class:`MAPMRI` fitting the model on a chunk of voxels and computing the selected maps."""
+    source, start, stop, params = args
+    start_time = time.time()
+    data = (np.load(source, mmap_mode='r') if isinstance(source, str) else source)[start:stop]
+
+    mapfit = params['model'].fit(np.asarray(data, dtype=np.float32))
+    methods = {'ng_perp': 'ng_perpendicular', 'ng_para': 'ng_parallel'}
+    results = dict((metric, getattr(mapfit, methods.get(metric, metric))()) for metric in params['metrics'])
+    return results, time.time() - start_time
+
+
 class MAPMRIInputSpec(DipyBaseInterfaceInputSpec):
+    in_mask = File(exists=True,
+                   desc='input mask in which the MAP-MRI model is fitted')
     laplacian_regularization = traits.Bool(
         True, usedefault=True, desc='Apply laplacian regularization')
 
@@ -1099,6 +1493,15 @@ class MAPMRIInputSpec(DipyBaseInterfaceInputSpec):
     big_delta = traits.Float(0.5, mandatory=True,
                              desc='Small data for gradient table')
 
+    metrics = traits.List(traits.Enum(*MAPMRI_METRICS), value=MAPMRI_METRICS, usedefault=True,
+                          desc='Scalar maps computed from the model fit (Default: all)')
+
+    n_procs = traits.Int(1, usedefault=True,
+                         desc='Number of processes fitting chunks of voxels in parallel (Default: 1)')
+
+    chunk_size = traits.Int(10000, usedefault=True,
+                            desc='Number of voxels fitted per chunk (Default: 10000)')
+
 
 class MAPMRIOutputSpec(TraitedSpec):
     model = File(desc='Python pickled object of the MAP-MRI model fitted.')
@@ -1139,13 +1542,17 @@ class MAPMRI(DipyDiffusionInterface):
         import pickle as pickle
         import gzip
 
-        img = nib.load(self.inputs.in_file)
-        imref = nib.four_to_three(img)[0]
+        img = nib.load(self.inputs.in_file, keep_file_open=True)
         affine = img.affine
 
-        data = img.get_data().astype(np.float32)
+        if isdefined(self.inputs.in_mask):
+            msk = nib.load(self.inputs.in_mask).get_data() > 0
+        else:
+            msk = np.ones(img.shape[:3], dtype=bool)
 
-        hdr = imref.header.copy()
+        # Only the voxels of the mask are fitted
+        voxels = np.nonzero(msk)
+        voxel_data = _read_voxel_data(img, voxels)
 
         gtab = self._get_gradient_table()
         gtab = gradient_table(bvals=gtab.bvals, bvecs=gtab.bvecs,
@@ -1160,43 +1567,56 @@ class MAPMRI(DipyDiffusionInterface):
                                                   positivity_constraint=self.inputs.positivity_constraint
                                                   )
 
-        IFLOGGER.info('Fitting MAP-MRI model')
-        mapfit_both_aniso = map_model_both_aniso.fit(data)
-
-        '''maps'''
-        maps = {}
-        maps["rtop"] = mapfit_both_aniso.rtop()  # '''1/Volume of pore'''
-        maps["rtap"] = mapfit_both_aniso.rtap()  # '''1/AREA ...'''
-        maps["rtpp"] = mapfit_both_aniso.rtpp()  # '''1/length ...'''
-        maps["msd"] = mapfit_both_aniso.msd(
-        )  # '''similar to mean diffusivity'''
-        maps["qiv"] = mapfit_both_aniso.qiv(
-        )  # '''almost reciprocal of rtop'''
-        maps["ng"] = mapfit_both_aniso.ng()  # '''general non Gaussianity'''
-        maps[
-            "ng_perp"] = mapfit_both_aniso.ng_perpendicular()  # '''perpendicular to main direction (likely to be non gaussian in white matter)'''
-        maps["ng_para"] = mapfit_both_aniso.ng_parallel(
-        )  # '''along main direction (likely to be gaussian)'''
-
-        ''' The most related to white matter anisotropy are:
+        f = gzip.open(self._gen_filename('mapmri', ext='.pklz'), 'wb')
+        pickle.dump(map_model_both_aniso, f, -1)
+        f.close()
+
+        '''maps
+            rtop: 1/Volume of pore
+            rtap: 1/AREA ...
+            rtpp: 1/length ...
+            msd: similar to mean diffusivity
+            qiv: almost reciprocal of rtop
+            ng: general non Gaussianity
+            ng_perp: perpendicular to main direction (likely to be non gaussian in white matter)
+            ng_para: along main direction (likely to be gaussian)
+
+        The most related to white matter anisotropy are:
             rtpp, for anisotropy
             rtap, for axonal diameter
             MIGHT BE WORTH DIVINDING RTPP BY (1/RTOP): THAT IS:
             length/VOLUME = RTOP/RTPP
         '''
-
-        f = gzip.open(self._gen_filename('mapmri', ext='.pklz'), 'wb')
-        pickle.dump(map_model_both_aniso, f, -1)
-        f.close()
-
-        # "rtop", "rtap", "rtpp", "msd", "qiv", "ng", "ng_perp", "ng_para"
-        for metric, data in list(maps.items()):
-            out_name = self._gen_filename(metric)
-            nib.Nifti1Image(data, affine).to_filename(out_name)
-            IFLOGGER.info(
-                'MAP-MRI {metric} image saved as {i}'.format(i=out_name, metric=metric))
-            IFLOGGER.info('Shape :')
-            IFLOGGER.info(data.shape)
+        # Maps are written in memory-mapped volumes so that only the
+        # fit of the current chunk of voxels is held in memory
+        maps_dir = tempfile.mkdtemp(prefix='mapmri_maps_', dir=os.getcwd())
+        try:
+            maps = {}
+            for metric in self.inputs.metrics:
+                maps[metric] = np.lib.format.open_memmap(op.join(maps_dir, metric + '.npy'), mode='w+',
+                                                         dtype=np.float32, shape=msk.shape)
+
+            IFLOGGER.info('Fitting MAP-MRI model on %i voxels' % voxel_data.shape[0])
+            params = {'model': map_model_both_aniso, 'metrics': list(self.inputs.metrics)}
+            for start, stop, results in _iter_voxel_chunks(_fit_mapmri_chunk, voxel_data, params,
+                                                           n_procs=self.inputs.n_procs,
+                                                           chunk_size=self.inputs.chunk_size,
+                                                           name='MAP-MRI fit'):
+                chunk_voxels = tuple(v[start:stop] for v in voxels)
+                for metric, values in results.items():
+                    maps[metric][chunk_voxels] = values
+
+            # "rtop", "rtap", "rtpp", "msd", "qiv", "ng", "ng_perp", "ng_para"
+            for metric, metric_map in list(maps.items()):
+                out_name = self._gen_filename(metric)
+                nib.Nifti1Image(metric_map, affine).to_filename(out_name)
+                IFLOGGER.info(
+                    'MAP-MRI {metric} image saved as {i}'.format(i=out_name, metric=metric))
+                IFLOGGER.info('Shape :')
+                IFLOGGER.info(metric_map.shape)
+            del maps
+        finally:
+            shutil.rmtree(maps_dir)
 
         return runtime
 
@@ -1204,6 +1624,6 @@ class MAPMRI(DipyDiffusionInterface):
         outputs = self._outputs().get()
         outputs['model'] = self._gen_filename('mapmri', ext='.pklz')
 
-        for metric in ["rtop", "rtap", "rtpp", "msd", "qiv", "ng", "ng_perp", "ng_para"]:
+        for metric in self.inputs.metrics:
             outputs["{}_file".format(metric)] = self._gen_filename(metric)
         return outputs
@@ -14,10 +14,15 @@ from glob import glob
 
 # import pickle
 import gzip
+import io
 import json
+import itertools
+import struct
+import zipfile
 
 import networkx as nx
 import numpy as np
+import nibabel as nib
 
 warnings.simplefilter("ignore")
 
@@ -323,6 +328,310 @@ def mean_curvature(xyz):
     return np.mean(k)
 
 
+class SizedIterable(object):
+    """Iterable of known length, used to stream fibers to ``nibabel.trackvis.write``."""
+
+    def __init__(self, iterable, size):
+        self.iterable = iterable
+        self.size = size
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def __len__(self):
+        return self.size
+
+
+def iter_fiber_chunks(trkfile, chunk_size=100000):
+    """Iterate over the fibers of a TRK tractogram by chunks of fibers.
+
+    Fibers are read from the file as they are consumed so that only one
+    chunk of fibers is held in memory at a time.
+
+    Parameters
+    ----------
+    trkfile : TRK file
+        Path to the tractogram in TRK format
+
+    chunk_size : int
+        Maximal number of fibers per chunk (Default: 100000)
+
+    Yields
+    ------
+    chunk : list
+        List of fibers as returned by ``nibabel.trackvis.read``
+    """
+    streams, _ = nib.trackvis.read(trkfile, as_generator=True)
+    while True:
+        chunk = list(itertools.islice(streams, chunk_size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+def save_fibers_subset(trkfile, fname, indices):
+    """Stores a new trackvis file fname using only given indices of the fibers in trkfile.
+
+    Fibers are streamed from `trkfile` to `fname` so that the
+    tractogram is never loaded entirely in memory.
+
+    Parameters
+    ----------
+    trkfile : TRK file
+        Path to the input tractogram in TRK format
+
+    fname : string
+        Output tractogram filename
+
+    indices : list
+        Indices of fibers included
+    """
+    indices = np.unique(indices)
+    streams, hdr = nib.trackvis.read(trkfile, as_generator=True)
+
+    def selected_fibers():
+        j = 0
+        for i, fi in enumerate(streams):
+            if j == indices.shape[0]:
+                break
+            if i == indices[j]:
+                j += 1
+                yield fi
+
+    hdrnew = hdr.copy()
+    hdrnew['n_count'] = indices.shape[0]
+    nib.trackvis.write(fname, SizedIterable(selected_fibers(), indices.shape[0]), hdrnew)
+
+
+def save_array_store(fname, columns):
+    """Save arrays, such as per-fiber data, as named columns of a single memory-mappable store file.
+
+    The store is an uncompressed ``.npz`` archive, so it can still be read
+    with ``numpy.load``. Each column is written to the archive as a
+    ``.npy`` member, either at once or chunk by chunk, so a column never
+    has to be held entirely in memory.
+
+    Parameters
+    ----------
+    fname : string
+        Output store filename
+
+    columns : dict
+        Dictionary of column name / data, where data is either an array or
+        a tuple ``(shape, dtype, chunks)`` where `chunks` is an iterable of
+        arrays that are concatenated along the first axis
+
+    See Also
+    --------
+    load_array_store
+    """
+    with zipfile.ZipFile(fname, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name, column in list(columns.items()):
+            if isinstance(column, tuple):
+                shape, dtype, chunks = column
+                dtype = np.dtype(dtype)
+            else:
+                column = np.asanyarray(column)
+                shape, dtype, chunks = column.shape, column.dtype, [column]
+                if column.ndim > 0 and column.shape[0] > 0:
+                    # Arrays, possibly memory-mapped, are copied by slices of about 64 MB
+                    step = max(1, (64 << 20) // max(1, column[:1].nbytes))
+                    chunks = (column[i:i + step] for i in range(0, column.shape[0], step))
+            header = {'descr': np.lib.format.dtype_to_descr(dtype),
+                      'fortran_order': False,
+                      'shape': tuple(int(d) for d in shape)}
+            n_bytes = 0
+            with zf.open(name + '.npy', mode='w', force_zip64=True) as fp:
+                np.lib.format.write_array_header_2_0(fp, header)
+                for chunk in chunks:
+                    data = np.ascontiguousarray(chunk, dtype=dtype).tobytes()
+                    fp.write(data)
+                    n_bytes += len(data)
+            if n_bytes != int(np.prod(header['shape'])) * dtype.itemsize:
+                raise ValueError('Column %s: %i bytes written for shape %s' % (name, n_bytes, header['shape']))
+
+
+def load_array_store(fname, columns=None, mmap_mode='r'):
+    """Load the columns of a store created by :func:`save_array_store`.
+
+    Columns are memory-mapped directly from the archive so that only the
+    data that is actually accessed is read from disk.
+
+    Parameters
+    ----------
+    fname : string
+        Store filename
+
+    columns : list
+        Names of the columns to load. All columns are loaded if None (Default: None)
+
+    mmap_mode : {None, 'r', 'r+', 'c'}
+        Memory-map mode of the columns. If None, columns are read in memory (Default: 'r')
+
+    Returns
+    -------
+    store : dict
+        Dictionary of column name / array
+    """
+    store = {}
+    with zipfile.ZipFile(fname) as zf, open(fname, 'rb') as fp:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if columns is not None and name not in columns:
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Column %s of %s is compressed and cannot be memory-mapped' % (name, fname))
+            # Skip the zip local file header, whose name and extra field lengths are stored in its last 4 bytes
+            fp.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', fp.read(30)[26:30])
+            fp.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+            order = 'F' if fortran_order else 'C'
+            n_bytes = int(np.prod(shape)) * dtype.itemsize
+            if mmap_mode is None or n_bytes == 0 or len(shape) == 0:
+                store[name] = np.frombuffer(fp.read(n_bytes), dtype=dtype).reshape(shape, order=order).copy()
+            else:
+                store[name] = np.memmap(fname, dtype=dtype, mode=mmap_mode, shape=shape,
+                                        order=order, offset=fp.tell())
+    return store
+
+
+class StreamingTractogramWriter(object):
+    """Write streamlines to a TRK or TCK tractogram by batches as they are generated.
+
+    The header of the tractogram is written when the writer is created, with
+    a streamline count of zero which stands for an unknown count in both
+    formats. Streamlines are then buffered and appended to the file by
+    batches, and the count is only fixed up in the header when the writer is
+    closed. Only one batch of streamlines is thus held in memory, and the
+    tractogram written up to the last flushed batch remains readable if the
+    process is interrupted.
+
+    Parameters
+    ----------
+    fname : string
+        Output tractogram filename, whose extension (``.trk`` or ``.tck``) sets the format
+
+    reference : nibabel.Nifti1Image
+        Image defining the voxel space of the tractogram header
+
+    batch_size : int
+        Number of streamlines buffered before being written to the file (Default: 10000)
+
+    Examples
+    --------
+    >>> from cmtklib.util import StreamingTractogramWriter
+    >>> with StreamingTractogramWriter('tracked.trk', nib.load('fa.nii.gz')) as writer:  # doctest: +SKIP
+    ...     writer.write(streamlines)
+    """
+
+    def __init__(self, fname, reference, batch_size=10000):
+        from nibabel.streamlines import Field, Tractogram
+        from nibabel.orientations import aff2axcodes
+
+        self.fname = fname
+        self.batch_size = batch_size
+        self.count = 0
+        self._batch = []
+
+        tractogram_file = nib.streamlines.detect_format(fname)
+        if tractogram_file not in (nib.streamlines.TrkFile, nib.streamlines.TckFile):
+            raise ValueError('Unsupported tractogram format for streaming: %s' % fname)
+        self.format = 'trk' if tractogram_file is nib.streamlines.TrkFile else 'tck'
+
+        header = {Field.VOXEL_TO_RASMM: reference.affine.copy(), Field.VOXEL_SIZES: reference.header.get_zooms()[:3],
+                  Field.DIMENSIONS: reference.shape[:3], Field.VOXEL_ORDER: "".join(aff2axcodes(reference.affine))}
+
+        # Let nibabel write the header of an empty tractogram, which is then used as is
+        buffer = io.BytesIO()
+        tractogram_file(Tractogram(affine_to_rasmm=np.eye(4)), header=header).save(buffer)
+        empty_file = buffer.getvalue()
+        if self.format == 'trk':
+            self._header = empty_file
+            self._count_offset = 988
+            # Streamlines are saved in RAS+ mm and written in the TrackVis voxmm space
+            self._affine = nib.streamlines.trk.get_affine_rasmm_to_trackvis(
+                nib.streamlines.TrkFile._read_header(io.BytesIO(empty_file)))
+        else:
+            # An empty TCK file ends with the end of file delimiter triplet
+            self._header = empty_file[:-12]
+            self._count_offset = self._header.index(b'count: ') + len(b'count: ')
+            self._affine = None
+
+        self._file = open(fname, 'wb')
+        self._file.write(empty_file)
+        self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, streamlines):
+        """Append streamlines to the tractogram.
+
+        Parameters
+        ----------
+        streamlines : iterable
+            Streamlines as arrays of shape (n_points, 3) in RAS+ mm coordinates
+        """
+        for streamline in streamlines:
+            self._batch.append(np.asarray(streamline, dtype=np.float32))
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered streamlines to the file."""
+        if len(self._batch) == 0:
+            return
+        lengths = np.array([len(streamline) for streamline in self._batch], dtype=np.int64)
+        points = np.concatenate(self._batch).astype(np.float64)
+        if self._affine is not None:
+            points = nib.affines.apply_affine(self._affine, points)
+
+        if self.format == 'trk':
+            # Each record is the number of points stored as an int32, followed by the points
+            starts = np.cumsum(np.concatenate(([0], lengths[:-1] * 3 + 1)))
+            data = np.empty(len(points) * 3 + len(lengths), dtype='<f4')
+            data.view('<i4')[starts] = lengths
+            mask = np.ones(data.shape, dtype=bool)
+            mask[starts] = False
+            data[mask] = points.ravel()
+        else:
+            # Streamlines are separated by a delimiter triplet of NaN and the
+            # end of file delimiter of the previous batch is overwritten
+            starts = np.cumsum(lengths) + np.arange(len(lengths))
+            data = np.full((len(points) + len(lengths) + 1, 3), np.nan, dtype='<f4')
+            mask = np.ones(len(data), dtype=bool)
+            mask[starts] = False
+            mask[-1] = False
+            data[mask] = points
+            data[-1] = np.inf
+            self._file.seek(-12, os.SEEK_END)
+
+        self._file.write(data.tobytes())
+        self._file.flush()
+        self.count += len(self._batch)
+        self._batch = []
+
+    def close(self):
+        """Write the remaining streamlines and fix up the streamline count in the header."""
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.seek(self._count_offset)
+        if self.format == 'trk':
+            self._file.write(struct.pack('<i', self.count))
+        else:
+            self._file.write(('%010i' % self.count).encode())
+        self._file.close()
+
+
 def extract_freesurfer_subject_dir(reconall_report, local_output_dir=None, debug=False):
     """Extract Freesurfer subject directory from the report created by Nipype Freesurfer Recon-all node.
 
@@ -0,0 +1,146 @@
+# Copyright (C) 2009-2021, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Benchmark the peak memory usage of :func:`cmtklib.connectome.cmat` on a synthetic tractogram.
+
+A synthetic tractogram of random walk fibers and a parcellation with two
+resolutions are generated in the working directory, then ``cmat()`` is run
+in a separate process for each given source tree, which reports its peak
+resident set size (RSS) and run time.
+
+Without ``--streaming``, the whole tractogram is loaded as a list of
+fibers, which takes about 2.5 GB for 1M fibers of 20 points. The default
+5M fibers are then only practical with ``--streaming``.
+
+Examples
+--------
+Compare the current tree with another checkout of the repository on the
+default 5M fibers read by chunks::
+
+    $ git worktree add /tmp/cmp3-ref <revision>
+    $ python tests/benchmark_cmat_memory.py --work-dir /tmp/cmat_bench \\
+        --repos . /tmp/cmp3-ref --streaming
+
+Compare them with the whole tractogram loaded on 1M fibers::
+
+    $ python tests/benchmark_cmat_memory.py --work-dir /tmp/cmat_bench_1m \\
+        --n-fibers 1000000 --repos . /tmp/cmp3-ref
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import nibabel as nib
+import networkx as nx
+
+
+SHAPE = (96, 114, 96)
+VOXEL_SIZE = (2.0, 2.0, 2.0)
+RESOLUTIONS = {'scale1': (4, 4, 4), 'scale2': (8, 8, 8)}
+
+CHILD_CODE = """
+import json, os, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+work_dir, out_dir, kwargs = sys.argv[2], sys.argv[3], json.loads(sys.argv[4])
+from cmtklib.connectome import cmat
+atlas_info = json.load(open(os.path.join(work_dir, 'atlas_info.json')))
+os.makedirs(out_dir, exist_ok=True)
+os.chdir(out_dir)
+start = time.time()
+cmat(os.path.join(work_dir, 'tracks.trk'),
+     [os.path.join(work_dir, 'roi_%s.nii.gz' % parkey) for parkey in sorted(atlas_info)],
+     [atlas_info[parkey]['node_information_graphml'] for parkey in sorted(atlas_info)],
+     'Custom', compute_curvature=False, additional_maps={'fa': os.path.join(work_dir, 'fa.nii.gz')},
+     output_types=['gPickle'], atlas_info=atlas_info, **kwargs)
+print('BENCHMARK %.1f %.1f' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, time.time() - start))
+"""
+
+
+class _FiberGenerator(object):
+    """Generate random walk fibers by chunks so that the tractogram is never held in memory."""
+
+    def __init__(self, n_fibers, n_points, seed=0):
+        self.n_fibers = n_fibers
+        self.n_points = n_points
+        self.seed = seed
+
+    def __len__(self):
+        return self.n_fibers
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed)
+        extent = np.array(SHAPE) * np.array(VOXEL_SIZE)
+        for start in range(0, self.n_fibers, 100000):
+            n = min(100000, self.n_fibers - start)
+            origins = rng.uniform(0, extent, size=(n, 1, 3))
+            steps = rng.normal(0, 1.5, size=(n, self.n_points, 3)).cumsum(axis=1)
+            points = np.clip(origins + steps, 0, extent - 0.01).astype(np.float32)
+            for pts in points:
+                yield pts, None, None
+
+
+def create_data(work_dir, n_fibers, n_points):
+    """Create the synthetic tractogram, parcellations and FA map in `work_dir`."""
+    os.makedirs(work_dir, exist_ok=True)
+    affine = np.diag(list(VOXEL_SIZE) + [1])
+    grid = np.indices(SHAPE)
+    atlas_info = {}
+    for parkey, blocks in sorted(RESOLUTIONS.items()):
+        cells = [grid[axis] * blocks[axis] // SHAPE[axis] for axis in range(3)]
+        labels = (1 + cells[0] + blocks[0] * (cells[1] + blocks[1] * cells[2])).astype(np.int16)
+        nib.save(nib.Nifti1Image(labels, affine), os.path.join(work_dir, 'roi_%s.nii.gz' % parkey))
+        n_regions = int(np.prod(blocks))
+        graph = nx.Graph()
+        for label in range(1, n_regions + 1):
+            graph.add_node(str(label), dn_correspondence_id=str(label), dn_fsname='roi%i' % label,
+                           dn_hemisphere='left', dn_name='roi%i' % label, dn_region='cortical')
+        graphml = os.path.join(work_dir, '%s.graphml' % parkey)
+        nx.write_graphml(graph, graphml)
+        atlas_info[parkey] = {'number_of_regions': n_regions, 'node_information_graphml': graphml}
+    with open(os.path.join(work_dir, 'atlas_info.json'), 'w') as f:
+        json.dump(atlas_info, f)
+
+    fa = np.random.RandomState(1).uniform(0, 1, SHAPE).astype(np.float32)
+    nib.save(nib.Nifti1Image(fa, affine), os.path.join(work_dir, 'fa.nii.gz'))
+
+    hdr = nib.trackvis.empty_header()
+    hdr['voxel_size'] = VOXEL_SIZE
+    hdr['dim'] = SHAPE
+    hdr['vox_to_ras'] = affine
+    nib.trackvis.write(os.path.join(work_dir, 'tracks.trk'), _FiberGenerator(n_fibers, n_points), hdr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the peak memory usage of cmat()')
+    parser.add_argument('--work-dir', required=True, help='Directory of the synthetic data and outputs')
+    parser.add_argument('--n-fibers', type=int, default=5000000, help='Number of fibers (Default: 5000000)')
+    parser.add_argument('--n-points', type=int, default=20, help='Number of points per fiber (Default: 20)')
+    parser.add_argument('--repos', nargs='+', default=[os.path.dirname(os.path.dirname(os.path.abspath(__file__)))],
+                        help='Source trees containing the cmtklib package to benchmark (Default: this tree)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Read the tractogram by chunks (only for trees supporting the streaming option)')
+    args = parser.parse_args()
+    kwargs = json.dumps({'streaming': True} if args.streaming else {})
+
+    if not os.path.exists(os.path.join(args.work_dir, 'tracks.trk')):
+        print('Create %i synthetic fibers in %s' % (args.n_fibers, args.work_dir))
+        create_data(args.work_dir, args.n_fibers, args.n_points)
+
+    for n_repo, repo in enumerate(args.repos):
+        out_dir = os.path.join(args.work_dir, 'output_%i' % n_repo)
+        output = subprocess.run([sys.executable, '-c', CHILD_CODE, os.path.abspath(repo), args.work_dir, out_dir,
+                                 kwargs],
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        peak_rss, run_time = output.split('BENCHMARK')[-1].split()
+        print('%s : peak RSS %s MB, %s s' % (repo, peak_rss, run_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Copyright (C) 2009-2021, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Check the detrending on a shared basis against the former per-voxel formulas."""
+
+import numpy as np
+import nibabel as nib
+from scipy import signal
+from scipy.interpolate import LSQUnivariateSpline
+
+from cmtklib.functionalMRI import Detrending, polynomial_basis, regress_out, spline_basis
+
+
+def make_data(n_voxels=2000, n_timepoints=150, seed=0):
+    """Return random time series with polynomial trends."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_timepoints, dtype=np.float64) / n_timepoints
+    trends = rng.normal(size=(n_voxels, 4)).dot(np.vstack((np.ones(n_timepoints), t, t ** 2, t ** 3)))
+    return 100.0 + 10.0 * trends + rng.normal(size=(n_voxels, n_timepoints))
+
+
+def polyfit_residuals(data, order):
+    """Remove a polynomial of the given order fitted voxel by voxel."""
+    t = np.arange(data.shape[1], dtype=np.float64)
+    return np.array([y - np.polyval(np.polyfit(t, y, order), t) for y in data])
+
+
+def assert_close(actual, expected, rtol=1e-8):
+    np.testing.assert_allclose(actual, expected, rtol=rtol, atol=rtol * np.abs(expected).max())
+
+
+def test_linear_detrending_matches_scipy():
+    data = make_data()
+    assert_close(regress_out(data, polynomial_basis(data.shape[1], 1)), signal.detrend(data, axis=1))
+
+
+def test_quadratic_detrending_matches_polyfit():
+    data = make_data()
+    assert_close(regress_out(data, polynomial_basis(data.shape[1], 2)), polyfit_residuals(data, 2))
+
+
+def test_spline_detrending_matches_voxelwise_spline():
+    data = make_data(n_voxels=200, n_timepoints=200)
+    t = np.arange(data.shape[1], dtype=np.float64)
+    knots = np.arange(50, data.shape[1] - 1, 50)
+    expected = np.array([y - LSQUnivariateSpline(t, y, knots, k=3)(t) for y in data])
+    assert_close(regress_out(data, spline_basis(data.shape[1], 50)), expected)
+
+
+def test_spline_without_interior_knot_is_cubic_polynomial():
+    data = make_data(n_voxels=200)
+    assert spline_basis(data.shape[1], 1000).shape == (data.shape[1], 4)
+    assert_close(regress_out(data, spline_basis(data.shape[1], 1000)), polyfit_residuals(data, 3))
+
+
+def test_detrending_interface_cubic_mode(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = make_data(n_voxels=6 * 6 * 4, n_timepoints=120).reshape((6, 6, 4, 120))
+    gm = np.zeros((6, 6, 4), dtype=np.uint8)
+    gm[1:5, 1:5, 1:3] = 1
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), 'bold.nii.gz')
+    nib.save(nib.Nifti1Image(gm, np.eye(4)), 'gm.nii.gz')
+
+    Detrending(in_file='bold.nii.gz', gm_file=['gm.nii.gz'], mode='cubic').run()
+
+    detrended = nib.load('fMRI_detrending.nii.gz').get_fdata()
+    expected = polyfit_residuals(data[gm > 0].astype(np.float32).astype(np.float64), 3)
+    assert_close(detrended[gm > 0], expected, rtol=1e-5)
+    np.testing.assert_array_equal(detrended[gm == 0], data[gm == 0].astype(np.float32))
@@ -0,0 +1,60 @@
+# Copyright (C) 2009-2021, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Check the grouped edge fiber metrics of the connectome stage against the former loop over the edges."""
+
+import numpy as np
+
+from cmtklib.connectome import compute_edge_fiber_metrics, group_fibers_by_edge
+
+
+def edge_fiber_metrics_loop(final_fiberlabels, final_fiberlength, node_volumes, total_volume):
+    """Compute the fiber metrics of each edge with the former loop over the edges."""
+    edge_codes = final_fiberlabels[:, 0] * (final_fiberlabels.max() + 1) + final_fiberlabels[:, 1]
+    _, edge_first = np.unique(edge_codes, return_index=True)
+    total_fibers = final_fiberlabels.shape[0]
+    metrics = dict((key, []) for key in ['number_of_fibers', 'fiber_length_mean', 'fiber_length_median',
+                                         'fiber_length_std', 'fiber_proportion', 'fiber_density',
+                                         'normalized_fiber_density'])
+    for u, v in final_fiberlabels[np.sort(edge_first)]:
+        idx = np.where((final_fiberlabels[:, 0] == u) & (final_fiberlabels[:, 1] == v))[0]
+        di = {'number_of_fibers': len(idx),
+              'fiber_length_mean': float(np.nanmean(final_fiberlength[idx])),
+              'fiber_length_median': float(np.nanmedian(final_fiberlength[idx])),
+              'fiber_length_std': float(np.nanstd(final_fiberlength[idx]))}
+        di['fiber_proportion'] = float(100.0 * (di['number_of_fibers'] / float(total_fibers)))
+        if di['fiber_length_mean'] > 0.0:
+            di['fiber_density'] = float((float(di['number_of_fibers']) / float(di['fiber_length_mean'])) * float(
+                2.0 / (node_volumes[u] + node_volumes[v])))
+            di['normalized_fiber_density'] = float(
+                ((float(di['number_of_fibers']) / float(total_fibers)) / float(di['fiber_length_mean'])) * (
+                    (2.0 * float(total_volume)) / (node_volumes[u] + node_volumes[v])))
+        else:
+            di['fiber_density'] = 0.0
+            di['normalized_fiber_density'] = 0.0
+        for key, value in di.items():
+            metrics[key].append(value)
+    return dict((key, np.array(values)) for key, values in metrics.items())
+
+
+def test_edge_fiber_metrics_match_loop():
+    rng = np.random.RandomState(0)
+    n_fibers, n_rois = 20000, 40
+    final_fiberlabels = np.sort(rng.randint(1, n_rois + 1, size=(n_fibers, 2)), axis=1)
+    final_fiberlength = rng.gamma(2.0, 20.0, size=n_fibers)
+    # Fibers of null length exercise the null density of the edges of null mean length
+    final_fiberlength[np.all(final_fiberlabels == final_fiberlabels[0], axis=1)] = 0.0
+    node_volumes = np.zeros(n_rois + 1)
+    node_volumes[1:] = rng.randint(100, 5000, size=n_rois)
+    total_volume = node_volumes.sum()
+
+    expected = edge_fiber_metrics_loop(final_fiberlabels, final_fiberlength, node_volumes, total_volume)
+    edges, fiber_edge = group_fibers_by_edge(final_fiberlabels, n_rois)
+    actual = compute_edge_fiber_metrics(edges, fiber_edge, final_fiberlength, node_volumes, total_volume)
+
+    assert sorted(actual) == sorted(expected)
+    for key in expected:
+        np.testing.assert_allclose(actual[key], expected[key], rtol=1e-10, err_msg=key)
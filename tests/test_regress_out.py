@@ -0,0 +1,44 @@
+# Copyright (C) 2009-2021, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Check the batched nuisance regression against the former per-voxel fit."""
+
+import numpy as np
+import pytest
+
+from cmtklib.functionalMRI import regress_out
+
+
+def make_data(n_voxels=2000, n_timepoints=150, seed=0):
+    """Return random time series and motion parameters."""
+    rng = np.random.RandomState(seed)
+    motion = rng.normal(size=(n_timepoints, 6)).cumsum(axis=0)
+    data = 100.0 + 10.0 * rng.normal(size=(n_voxels, 6)).dot(motion.T) + rng.normal(size=(n_voxels, n_timepoints))
+    return data, motion
+
+
+def test_regress_out_matches_voxelwise_least_squares():
+    data, motion = make_data()
+    X = np.column_stack((np.ones(motion.shape[0]), motion))
+    expected = np.array([y - X.dot(np.linalg.lstsq(X, y, rcond=None)[0]) for y in data])
+    np.testing.assert_allclose(regress_out(data, X), expected, rtol=1e-8, atol=1e-8 * np.abs(expected).max())
+
+
+def test_regress_out_matches_voxelwise_gls():
+    sm = pytest.importorskip('statsmodels.api')
+    data, motion = make_data(n_voxels=200)
+    X = sm.add_constant(motion)
+    expected = np.array([sm.GLS(y.reshape(-1, 1), X).fit().resid for y in data])
+    np.testing.assert_allclose(regress_out(data, X), expected, rtol=1e-8, atol=1e-8 * np.abs(expected).max())
+
+
+def test_regress_out_in_place_by_chunks():
+    data, motion = make_data(n_voxels=250)
+    X = np.column_stack((np.ones(motion.shape[0]), motion))
+    expected = regress_out(data, X)
+    out = regress_out(data, X, chunk_size=64, out=data)
+    assert out is data
+    np.testing.assert_allclose(data, expected, rtol=1e-10, atol=1e-10 * np.abs(expected).max())